@@ -0,0 +1,108 @@
+"""
+Stream a top-down view of the floor in front of the vehicle over RTSP.
+
+Frames from the camera (or a recording) are deskewed with the saved
+calibration and published at the camera's frame rate. Decoding, warping
+and encoding each run on their own thread.
+
+python3 birdseye.py [--video video/RobotsEyeView.mov] [--port 8554]
+
+Then point a media player at rtsp://<hostname>:8554/birdseye
+"""
+
+import argparse
+import calibration
+import camera
+import cv2
+import logging
+import os
+import pipeline
+import rtsp
+import time
+import vehctl
+
+_logger = logging.getLogger(__name__)
+
+
+class _LiveFrames(object):
+    """
+    Iterate over a live camera, taking each frame once. Camera.read()
+    alone returns the latest frame, which may repeat one already seen.
+    """
+
+    def __init__(self, source):
+        self.source = source
+
+    def __iter__(self):
+        last = None
+        while True:
+            try:
+                frame = self.source.read(newer_than=last)
+            except camera.EndOfFrames:
+                return
+            last = time.monotonic()
+            yield frame
+
+
+def stream_birdseye(source, calibrated, writer, report_interval=5.0):
+    """
+    Deskew every frame from `source` and write it to `writer` (anything
+    with a cv2.VideoWriter-style write method taking BGR frames). Returns
+    per-stage throughput stats.
+    """
+
+    def warp(rgb):
+        return calibrated.deskew(rgb)
+
+    def encode(top_down):
+        writer.write(cv2.cvtColor(top_down, cv2.COLOR_RGB2BGR))
+
+    pipe = pipeline.Pipeline(source, name="decode")
+    pipe.then("warp", warp).then("encode", encode)
+    return pipe.run(report_interval=report_interval)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--video", help="Replay a recorded video or image directory instead of the camera"
+    )
+    parser.add_argument("--port", type=int, default=8554)
+    parser.add_argument("--path", default="/birdseye")
+    parser.add_argument("--width", type=int, default=560)
+    parser.add_argument("--height", type=int, default=440)
+    parser.add_argument("--ppi", type=int, default=20, help="Output pixels per inch")
+    parser.add_argument(
+        "--y-offset",
+        type=float,
+        default=20,
+        help="Distance in inches from the vehicle origin to the bottom of the output",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    output_size = (args.width, args.height)
+    calibrated = calibration.CalibratedCamera.load(
+        output_size=output_size, output_ppi=args.ppi, output_y_offset=args.y_offset
+    )
+
+    if args.video:
+        # Replay at the recorded rate like a live camera would.
+        source = camera.open_camera(args.video, realtime=True, prefetch=4)
+    else:
+        config = vehctl.CONFIGS.get(os.getenv("USER"), vehctl.CONFIGS["default"])
+        source = camera.open_camera(orientation=config.vehicle.cameraOrientation)
+
+    server = rtsp.RtspServer(args.port)
+    writer = server.mount_writer(args.path, source.fps, output_size)
+    server.start()
+    print(f"Server listening at rtsp://localhost:{args.port}{args.path}")
+
+    with source:
+        stats = stream_birdseye(_LiveFrames(source), calibrated, writer)
+    print(stats)
+
+
+if __name__ == "__main__":
+    main()
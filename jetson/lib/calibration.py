@@ -1,14 +1,14 @@
 import argparse
+import camera
 import cv2
-import dt_apriltags
 import enum
 import json
 import logging
 import numpy as np
 import os
-import subprocess
 import sys
-import tempfile
+import tagdetect
+import time
 
 """
 Calibration protocol:
@@ -60,16 +60,10 @@ def get_tag_rects_world(panel_dist):
     return [ctr2rect(ctr) for ctr in centers]
 
 
-def deskew(img, hmat, output_size, output_ppi=20, output_y_offset=20):
+def deskew_matrix(hmat, output_size, output_ppi=20, output_y_offset=20):
     """
-    Uses a calibrated homography matrix to de-skew an image taken
-    by the vehicle.
-
-    - img: input image from the vehicle
-    - hmat: homography matrix representing transform from image coordinates to vehicle coordinates.
-    - output_size: pair of (width, height) of desired output in pixels, as a list or tuple.
-    - output_ppi: number of pixels in the output representation that represent one inch in the world.
-    - output_y_offset: distance in inches from the vehicle origin to the bottom of the output image.
+    Compose the homography with the transform from vehicle coordinates to
+    pixels of the deskewed output. See deskew for the arguments.
     """
     world2output = np.array(
         [
@@ -82,7 +76,23 @@ def deskew(img, hmat, output_size, output_ppi=20, output_y_offset=20):
             [0.0, 0.0, 1.0],
         ]
     )
-    deskew_mat = np.matmul(world2output, hmat)
+    return np.matmul(world2output, hmat)
+
+
+def deskew(img, hmat, output_size, output_ppi=20, output_y_offset=20):
+    """
+    Uses a calibrated homography matrix to de-skew an image taken
+    by the vehicle.
+
+    - img: input image from the vehicle
+    - hmat: homography matrix representing transform from image coordinates to vehicle coordinates.
+    - output_size: pair of (width, height) of desired output in pixels, as a list or tuple.
+    - output_ppi: number of pixels in the output representation that represent one inch in the world.
+    - output_y_offset: distance in inches from the vehicle origin to the bottom of the output image.
+
+    For deskewing many frames with the same calibration, CalibratedCamera is faster.
+    """
+    deskew_mat = deskew_matrix(hmat, output_size, output_ppi, output_y_offset)
     return cv2.warpPerspective(img, deskew_mat, output_size, flags=cv2.INTER_LINEAR)
 
 
@@ -90,62 +100,132 @@ def apply_homography(hmat, points):
     """
     Apply homography matrix hmat to a set of points in image coordinates
     (e.g. detected corners of tags).  This is weirdly fussy, steps are:
-    - Extend points to have 1s as the third element.
+    - Treat points as having 1s as the third element.
     - Perform the matrix multiplication.
     - Scale the points based on the third coordinate.
     """
     # Note -- it turns out the function cv2.perspectiveTransform also does this operation.
     # The following gives the same result other than some small numeric differences.
     # cv2.perspectiveTransform(points.reshape(1,len(points),2), hmat).reshape(len(points),2)
-    points = np.array(points)
-    points = np.concatenate([points, np.ones((points.shape[0], 1))], axis=1)
-    pred_raw = np.matmul(hmat, points.transpose()).transpose()
-    pred, scale = np.split(pred_raw, [2], axis=1)
-    return pred / scale
+    points = np.asarray(points, dtype="float64")
+    # Multiplying by the 2x2 part and adding the last column is the same as
+    # appending the 1s, without building the extended array.
+    pred = points @ hmat[:2, :2].T + hmat[:2, 2]
+    scale = points @ hmat[2, :2] + hmat[2, 2]
+    return pred / scale[:, np.newaxis]
 
 
-class TagsNotDetectedException(Exception):
-    pass
+class CalibratedCamera(object):
+    """
+    Holds a fixed calibration for a run, with everything that can be
+    precomputed for deskewing frames and mapping points to vehicle
+    coordinates done once up front.
 
+    deskew() uses cv2.remap with fixed-point lookup tables computed for
+    the output size, rather than cv2.warpPerspective recomputing the
+    mapping for every frame. to_vehicle() is apply_homography with
+    reusable buffers.
 
-def capture_image(tmpdir, orientation):
-    subprocess.run(
-        [
-            "nvgstcapture",
-            "-m",
-            "1",
-            f"--orientation={orientation}",
-            "-A",
-            "--capture-auto=1",
-            "--file-name",
-            tmpdir + "/",
-        ],
-        check=True,
-        stderr=subprocess.DEVNULL,
-        stdout=subprocess.DEVNULL,
-    )
-    image_file = sorted(
-        [fn for fn in os.listdir(tmpdir) if fn.endswith(".jpg")],
-        key=lambda fn: os.stat(os.path.join(tmpdir, fn)).st_ctime,
-    )[-1]
-    return cv2.cvtColor(cv2.imread(os.path.join(tmpdir, image_file)), cv2.COLOR_BGR2RGB)
+    Basic use:
 
+    cam = CalibratedCamera.load()
+    top_down = cam.deskew(frame)
+    """
 
-class CalibrationSession(object):
-    def __init__(self, panel_dist, orientation=0, desired_tags=3, max_tries=3):
-        self.tmpdir = tempfile.mkdtemp()
-
-        self.at_detector = dt_apriltags.Detector(
-            searchpath=["apriltags"],
-            families="tagStandard41h12",
-            nthreads=1,
-            quad_decimate=1.0,
-            quad_sigma=0.0,
-            refine_edges=1,
-            decode_sharpening=0.25,
-            debug=0,
+    def __init__(self, hmat, output_size=(560, 440), output_ppi=20, output_y_offset=20):
+        self.hmat = np.array(hmat, dtype="float64")
+        self.output_size = tuple(output_size)
+        self.output_ppi = output_ppi
+        self.output_y_offset = output_y_offset
+
+        deskew_mat = deskew_matrix(self.hmat, output_size, output_ppi, output_y_offset)
+        self.map1, self.map2 = self._remap_tables(np.linalg.inv(deskew_mat), output_size)
+
+        self._scale_buf = np.empty((0,), dtype="float64")
+        self._inv_hmat = np.linalg.inv(self.hmat)
+
+    @classmethod
+    def load(cls, **kwargs):
+        """
+        Create an instance from the saved calibration.
+        """
+        return cls(read_hmat(), **kwargs)
+
+    @staticmethod
+    def _remap_tables(output2img, output_size):
+        # For each output pixel find where it comes from in the input image,
+        # which is what warpPerspective does internally on every call.
+        width, height = output_size
+        xs, ys = np.meshgrid(
+            np.arange(width, dtype="float64"), np.arange(height, dtype="float64")
+        )
+        src = np.stack([xs, ys, np.ones_like(xs)], axis=-1) @ output2img.T
+        w = src[:, :, 2]
+        # Points at or behind the horizon map to nothing; send them off-image.
+        valid = w > 1e-12
+        safe_w = np.where(valid, w, 1.0)
+        map_x = np.where(valid, src[:, :, 0] / safe_w, -1.0).astype("float32")
+        map_y = np.where(valid, src[:, :, 1] / safe_w, -1.0).astype("float32")
+        return cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+
+    def deskew(self, img, out=None):
+        """
+        Equivalent to deskew(img, hmat, ...) with the parameters given to
+        the constructor. If given, `out` receives the result.
+        """
+        return cv2.remap(
+            img,
+            self.map1,
+            self.map2,
+            interpolation=cv2.INTER_LINEAR,
+            dst=out,
+            borderMode=cv2.BORDER_CONSTANT,
         )
 
+    def to_vehicle(self, points, out=None):
+        """
+        Equivalent to apply_homography(hmat, points) for an (N, 2) float64
+        array of points. If `out` is an (N, 2) float64 array the result is
+        written there and no new arrays are allocated.
+        """
+        n = len(points)
+        if out is None:
+            out = np.empty((n, 2), dtype="float64")
+        if len(self._scale_buf) < n:
+            self._scale_buf = np.empty((n,), dtype="float64")
+        scale = self._scale_buf[:n]
+
+        np.dot(points, self.hmat[:2, :2].T, out=out)
+        out += self.hmat[:2, 2]
+        np.dot(points, self.hmat[2, :2], out=scale)
+        scale += self.hmat[2, 2]
+        out /= scale[:, np.newaxis]
+        return out
+
+    def to_image(self, points):
+        """
+        Inverse of to_vehicle: map (N, 2) points on the floor in vehicle
+        coordinates to image coordinates.
+        """
+        return apply_homography(self._inv_hmat, points)
+
+
+class TagsNotDetectedException(Exception):
+    pass
+
+
+class CalibrationSession(object):
+    def __init__(
+        self, panel_dist, orientation=0, desired_tags=3, max_tries=3, cam=None
+    ):
+        # The camera is opened on demand if not supplied, and then closed
+        # by close(). A camera passed in is left for the caller to close.
+        self.cam = cam
+        self.owns_cam = False
+
+        # Favor accuracy over speed here, so no decimation.
+        self.at_detector = tagdetect.TagDetector(coarse_decimate=1.0)
+
         self.panel_dist = panel_dist
         self.orientation = orientation
         self.desired_tags = desired_tags
@@ -159,11 +239,18 @@ class CalibrationSession(object):
         best_tags = []
         remaining_tries = self.max_tries
 
+        if self.cam is None:
+            self.cam = camera.open_camera(orientation=self.orientation)
+            self.owns_cam = True
+
+        last_capture = None
         while len(best_tags) < self.desired_tags and remaining_tries > 0:
 
-            img = capture_image(self.tmpdir, self.orientation)
+            # Make sure each try gets a different frame.
+            img = self.cam.read(newer_than=last_capture)
+            last_capture = time.monotonic()
             img_gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
-            tags = self.at_detector.detect(img_gray)
+            tags = self.at_detector.detect(img_gray, full_scan=True)
 
             if len(tags) > len(best_tags):
                 best_tags = tags
@@ -197,6 +284,18 @@ class CalibrationSession(object):
             output_y_offset=self.panel_dist + 11.0,
         )
 
+    def close(self):
+        if self.owns_cam:
+            self.cam.close()
+            self.cam = None
+            self.owns_cam = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
     @property
     def error(self):
         return (
@@ -219,13 +318,17 @@ def write_calibration(hmat, input_img, calibrated_img):
         json.dump(list(hmat.reshape((9,))), f)
 
 
-def read_calibration():
+def read_hmat():
     with open(os.path.join(CALIBRATION_DIR, "hmat.json"), "rt") as f:
-        return (
-            np.array(json.load(f)).reshape((3, 3)),
-            cv2.imread(os.path.join(CALIBRATION_DIR, "input.png")),
-            cv2.imread(os.path.join(CALIBRATION_DIR, "calibrated.png")),
-        )
+        return np.array(json.load(f)).reshape((3, 3))
+
+
+def read_calibration():
+    return (
+        read_hmat(),
+        cv2.imread(os.path.join(CALIBRATION_DIR, "input.png")),
+        cv2.imread(os.path.join(CALIBRATION_DIR, "calibrated.png")),
+    )
 
 
 def main():
@@ -234,15 +337,20 @@ def main():
     parser.add_argument("--desired-tags", type=int, default=3)
     parser.add_argument("--max-tries", type=int, default=3)
     parser.add_argument("--orientation", type=int, default=0)
+    parser.add_argument(
+        "--video", help="Replay a recorded video or image directory instead of the camera"
+    )
     args = parser.parse_args()
 
-    sess = CalibrationSession(
-        panel_dist=args.panel_dist,
-        orientation=args.orientation,
-        desired_tags=args.desired_tags,
-        max_tries=args.max_tries,
-    )
-    sess.calibrate()
+    with camera.open_camera(args.video, orientation=args.orientation) as cam:
+        sess = CalibrationSession(
+            panel_dist=args.panel_dist,
+            orientation=args.orientation,
+            desired_tags=args.desired_tags,
+            max_tries=args.max_tries,
+            cam=cam,
+        )
+        sess.calibrate()
 
     sys.stderr.write(f"Used tags {sess.input_tag_ids} to calibrate.\n")
     sys.stderr.write(f"Error vector is:\n{sess.error}\n")
@@ -0,0 +1,333 @@
+"""
+Frame sources that hand back frames as RGB numpy arrays, so that the
+calibration, SLAM and segmentation code can all get frames the same way
+whether they come from the live camera or from a recording.
+
+Basic use:
+
+with open_camera(orientation=2) as camera:
+    img = camera.read()
+
+Passing a video file or a directory of images to open_camera replays it
+instead, which is handy for testing and benchmarking away from the
+vehicle:
+
+with open_camera("video/RobotsEyeView.mov", realtime=True, prefetch=8) as source:
+    for img in source:
+        ...
+"""
+
+import cv2
+import logging
+import os
+import queue
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+
+class CameraException(Exception):
+    pass
+
+
+class EndOfFrames(CameraException):
+    pass
+
+
+class FrameSource(object):
+    """
+    Common interface for frame sources. read() returns the next frame as an
+    RGB array and raises EndOfFrames once there are no more. Iterating over
+    a source yields frames until the end.
+    """
+
+    def read(self, newer_than=None, timeout=None):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __iter__(self):
+        while True:
+            try:
+                yield self.read()
+            except EndOfFrames:
+                return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Camera(FrameSource):
+    """
+    Live camera on the Jetson, read through a GStreamer appsink. A
+    background thread keeps reading so that read() can return the most
+    recent frame right away instead of waiting on the pipeline.
+
+    `orientation` is the same value we used to pass to nvgstcapture
+    (see cameraOrientation in the vehicle config). It is passed through
+    as the nvvidconv flip-method, where 2 is a 180 degree rotation.
+
+    Note the calibration homography depends on the resolution, so
+    calibrate with the same width and height that will be used later.
+    """
+
+    pipeline = """
+        nvarguscamerasrc
+        ! video/x-raw(memory:NVMM), width={width}, height={height}, format=NV12, framerate={fps}/1
+        ! nvvidconv flip-method={orientation}
+        ! video/x-raw, width={width}, height={height}, format=BGRx
+        ! videoconvert
+        ! video/x-raw, format=BGR
+        ! appsink drop=True max-buffers=1
+    """
+
+    def __init__(self, orientation=0, width=1280, height=720, fps=30):
+        self.fps = fps
+        self.capture = cv2.VideoCapture(
+            self.pipeline.format(
+                orientation=orientation, width=width, height=height, fps=fps
+            ),
+            cv2.CAP_GSTREAMER,
+        )
+        if not self.capture.isOpened():
+            raise CameraException("Unable to open camera pipeline.")
+
+        self.cond = threading.Condition()
+        self.frame = None
+        self.frame_time = None
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while self.running:
+            ret, frame = self.capture.read()
+            now = time.monotonic()
+            with self.cond:
+                if not ret:
+                    _logger.error("Camera stopped producing frames.")
+                    self.running = False
+                else:
+                    self.frame = frame
+                    self.frame_time = now
+                self.cond.notify_all()
+
+    def read(self, newer_than=None, timeout=5.0):
+        """
+        Return the most recent frame as an RGB array. If `newer_than` is
+        given (a time.monotonic() value), wait for a frame captured after
+        that time, e.g. to make sure the frame was taken after the vehicle
+        stopped moving.
+        """
+
+        def ready():
+            return not self.running or (
+                self.frame is not None
+                and (newer_than is None or self.frame_time > newer_than)
+            )
+
+        with self.cond:
+            if not self.cond.wait_for(ready, timeout=timeout):
+                raise CameraException("Timed out waiting for a frame.")
+            if self.frame is None or (
+                newer_than is not None and self.frame_time <= newer_than
+            ):
+                raise EndOfFrames("Camera is not running.")
+            frame = self.frame
+
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        self.capture.release()
+
+
+class RecordedSource(FrameSource):
+    """
+    Base class for sources that replay recorded frames in order. Subclasses
+    implement _decode, _skip and _rewind.
+
+    - fps: nominal frame rate of the recording.
+    - loop: start over at the end instead of raising EndOfFrames.
+    - realtime: behave like a live camera, handing out frames no faster
+      than `fps` and skipping any frames that would already have gone by
+      if the consumer is slower than that. Without this every frame is
+      returned, so runs are repeatable.
+    - prefetch: if nonzero, decode up to this many frames ahead on a
+      background thread.
+
+    The number of frames handed out and skipped are kept in `frames_read`
+    and `frames_skipped`.
+    """
+
+    def __init__(self, fps=30.0, loop=False, realtime=False, prefetch=0):
+        self.fps = fps
+        self.loop = loop
+        self.realtime = realtime
+        self.frames_read = 0
+        self.frames_skipped = 0
+        self.start_time = None
+        self.ended = False
+
+        self.queue = None
+        if prefetch:
+            self.queue = queue.Queue(maxsize=prefetch)
+            self.running = True
+            self.thread = threading.Thread(target=self._prefetch, daemon=True)
+            self.thread.start()
+
+    def _decode(self):
+        """
+        Return the next frame as an RGB array, or None at the end.
+        """
+        raise NotImplementedError
+
+    def _skip(self):
+        """
+        Advance past the next frame, returning False at the end. Subclasses
+        can override this when there's a cheaper way than decoding.
+        """
+        return self._decode() is not None
+
+    def _rewind(self):
+        raise NotImplementedError
+
+    def _next(self, decode=True):
+        advance = self._decode if decode else self._skip
+        result = advance()
+        if (result is None or result is False) and self.loop:
+            self._rewind()
+            result = advance()
+        return result
+
+    def _prefetch(self):
+        while self.running:
+            frame = self._next()
+            self.queue.put(frame)
+            if frame is None:
+                return
+
+    def _take(self, decode=True):
+        if self.ended:
+            raise EndOfFrames()
+        if self.queue is not None:
+            result = self.queue.get()
+        else:
+            result = self._next(decode=decode)
+        if result is None or result is False:
+            self.ended = True
+            raise EndOfFrames()
+        return result
+
+    def read(self, newer_than=None, timeout=None):
+        # Every recorded frame is "new", so newer_than and timeout don't apply.
+        if self.realtime:
+            now = time.monotonic()
+            if self.start_time is None:
+                self.start_time = now
+            due = int((now - self.start_time) * self.fps)
+            while self.frames_read + self.frames_skipped < due:
+                self._take(decode=False)
+                self.frames_skipped += 1
+            # Likewise if the consumer is faster, wait until the frame is due.
+            position = self.frames_read + self.frames_skipped
+            next_time = self.start_time + position / self.fps
+            if next_time > now:
+                time.sleep(next_time - now)
+
+        frame = self._take()
+        self.frames_read += 1
+        return frame
+
+    def close(self):
+        if self.queue is not None:
+            self.running = False
+            # Unblock the prefetch thread if it's waiting on a full queue.
+            while self.thread.is_alive():
+                try:
+                    self.queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self.thread.join()
+
+
+class VideoFileSource(RecordedSource):
+    """
+    Replays a video file, e.g. video/RobotsEyeView.mov.
+    """
+
+    def __init__(self, path, **kwargs):
+        self.path = path
+        self.capture = cv2.VideoCapture(path)
+        if not self.capture.isOpened():
+            raise CameraException(f"Unable to open {path}.")
+        kwargs.setdefault("fps", self.capture.get(cv2.CAP_PROP_FPS) or 30.0)
+        super().__init__(**kwargs)
+
+    def _decode(self):
+        ret, frame = self.capture.read()
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) if ret else None
+
+    def _skip(self):
+        # grab() advances without decoding the frame.
+        return self.capture.grab()
+
+    def _rewind(self):
+        self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+
+    def close(self):
+        super().close()
+        self.capture.release()
+
+
+class ImageDirSource(RecordedSource):
+    """
+    Replays the images in a directory, in order of file name.
+    """
+
+    suffixes = (".jpeg", ".jpg", ".png", ".tiff")
+
+    def __init__(self, path, **kwargs):
+        self.paths = sorted(
+            os.path.join(path, fn)
+            for fn in os.listdir(path)
+            if fn.lower().endswith(self.suffixes)
+        )
+        self.position = 0
+        super().__init__(**kwargs)
+
+    def _decode(self):
+        if self.position >= len(self.paths):
+            return None
+        img = cv2.imread(self.paths[self.position])
+        self.position += 1
+        return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+    def _skip(self):
+        if self.position >= len(self.paths):
+            return False
+        self.position += 1
+        return True
+
+    def _rewind(self):
+        self.position = 0
+
+
+def open_camera(path=None, orientation=0, **kwargs):
+    """
+    Open the live camera, or if `path` is given replay the video file or
+    image directory it names. Keyword arguments go to the source's
+    constructor.
+    """
+    if path is None:
+        return Camera(orientation=orientation, **kwargs)
+    elif os.path.isdir(path):
+        return ImageDirSource(path, **kwargs)
+    else:
+        return VideoFileSource(path, **kwargs)
@@ -0,0 +1,142 @@
+import collections
+import logging
+import statistics
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+
+class CommandMailbox(object):
+    """
+    Latest-value-wins mailbox between a producer that can post commands
+    faster than they can be carried out (e.g. the webapp's /state/ handler)
+    and a consumer that is slow (the serial link to the Arduino).
+
+    A background thread takes the most recent command and passes it to
+    `handler`, at most `max_rate` times per second. A command that is
+    replaced before the thread gets to it is dropped and counted as such.
+
+    Basic use:
+
+    mailbox = CommandMailbox(lambda cmd: vehicle.forward(cmd), max_rate=20)
+    mailbox.start()
+    mailbox.post(128)
+
+    post returns a ticket that can be passed to wait, to block until that
+    command, or one posted after it, has been carried out.
+    """
+
+    def __init__(self, handler, max_rate=None, latency_window=1000):
+        self.handler = handler
+        self.max_rate = max_rate
+        self.cond = threading.Condition()
+        self.pending = None  # (command, post time, ticket) or None
+        self.handled = 0  # ticket of the last command handled
+        self.running = False
+        self.thread = None
+
+        self.posted = 0
+        self.executed = 0
+        self.dropped = 0
+        self.failed = 0
+        # End-to-end latency from post to handler completion, in seconds.
+        self.latencies = collections.deque(maxlen=latency_window)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.thread.join()
+
+    def post(self, command):
+        """
+        Replace the pending command with `command` and return its ticket.
+        """
+        with self.cond:
+            self.posted += 1
+            if self.pending is not None:
+                self.dropped += 1
+            self.pending = (command, time.monotonic(), self.posted)
+            # notify_all since callers of wait share the condition.
+            self.cond.notify_all()
+            return self.posted
+
+    def wait(self, ticket, timeout=None):
+        """
+        Block until the command with `ticket`, or a later one that replaced
+        it, has been handled, successfully or not. Returns False if
+        `timeout` seconds pass first.
+        """
+        with self.cond:
+            return self.cond.wait_for(lambda: self.handled >= ticket, timeout)
+
+    def _run(self):
+        min_interval = 1.0 / self.max_rate if self.max_rate else 0.0
+        last_start = float("-inf")
+        while True:
+            with self.cond:
+                while self.running and self.pending is None:
+                    self.cond.wait()
+                if not self.running:
+                    return
+
+            # Sleep outside the lock so posts keep replacing the pending command.
+            delay = last_start + min_interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            with self.cond:
+                command, posted_at, ticket = self.pending
+                self.pending = None
+
+            last_start = time.monotonic()
+            try:
+                self.handler(command)
+            except Exception:
+                _logger.exception(f"Command {command} failed")
+                with self.cond:
+                    self.failed += 1
+                    self.handled = ticket
+                    self.cond.notify_all()
+                continue
+
+            latency = time.monotonic() - posted_at
+            with self.cond:
+                self.executed += 1
+                self.latencies.append(latency)
+                self.handled = ticket
+                self.cond.notify_all()
+
+    def stats(self):
+        """
+        Return a json-serializable summary of counters and latencies
+        (in milliseconds, over the most recent commands).
+        """
+        with self.cond:
+            last = self.latencies[-1] if self.latencies else None
+            latencies = sorted(self.latencies)
+            result = dict(
+                max_rate=self.max_rate,
+                posted=self.posted,
+                executed=self.executed,
+                dropped=self.dropped,
+                failed=self.failed,
+                pending=self.pending is not None,
+            )
+
+        if latencies:
+            ms = [l * 1000 for l in latencies]
+            result["latency_ms"] = dict(
+                last=last * 1000,
+                mean=statistics.mean(ms),
+                p50=ms[len(ms) // 2],
+                p95=ms[min(len(ms) - 1, int(len(ms) * 0.95))],
+                max=ms[-1],
+            )
+        return result
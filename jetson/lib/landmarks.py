@@ -0,0 +1,321 @@
+"""
+Map of tag landmarks for slam.py, with robust estimation of the
+vehicle-to-world transform from each frame's detections.
+
+Each landmark is a tag, represented like elsewhere in slam.py by the two
+points where it meets the floor. The map keeps a position estimate and a
+2x2 covariance for each point, and folds new observations in one
+landmark at a time, so the cost of a frame is proportional to the number
+of tags in it rather than the size of the map.
+
+Transforms are 3x3 homogeneous matrices as produced by
+fit_rigid_transform, mapping vehicle coordinates to world coordinates.
+"""
+
+import logging
+import math
+import numpy as np
+from spatialindex import GridIndex
+
+_logger = logging.getLogger(__name__)
+
+
+def rigid_transform(theta, tx, ty):
+    c, s = np.cos(theta), np.sin(theta)
+    return np.array([[c, -s, tx], [s, c, ty], [0.0, 0.0, 1.0]])
+
+
+def apply_transform(transform, points):
+    """
+    Apply a 3x3 rigid transform to an (N, 2) array of points.
+    """
+    points = np.asarray(points, dtype="float64")
+    return points @ transform[:2, :2].T + transform[:2, 2]
+
+
+def fit_rigid_transform(src, dst, weights=None):
+    """
+    Weighted least-squares rotation and translation taking the (N, 2)
+    points `src` onto `dst`. In 2D the optimal rotation has a closed form,
+    so no SVD is needed.
+    """
+    src = np.asarray(src, dtype="float64")
+    dst = np.asarray(dst, dtype="float64")
+    w = np.ones(len(src)) if weights is None else np.asarray(weights, "float64")
+    w = w / w.sum()
+
+    src_c = w @ src
+    dst_c = w @ dst
+    a = src - src_c
+    b = dst - dst_c
+    cross = w @ (a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0])
+    dot = w @ (a[:, 0] * b[:, 0] + a[:, 1] * b[:, 1])
+    theta = np.arctan2(cross, dot)
+
+    transform = rigid_transform(theta, 0.0, 0.0)
+    transform[:2, 2] = dst_c - transform[:2, :2] @ src_c
+    return transform
+
+
+class FrameUpdate(object):
+    """
+    Result of LandmarkMap.observe for one frame.
+
+    - transform: vehicle-to-world transform used for the frame, or None if
+      the frame couldn't be placed in the map.
+    - inliers, outliers: ids of known tags that did and didn't agree with
+      the transform. Outliers don't update the map.
+    - added: ids of tags that were new to the map.
+    - rms_error: RMS distance in world units between the inliers' observed
+      and mapped points.
+    """
+
+    def __init__(
+        self, transform=None, inliers=(), outliers=(), added=(), rms_error=None
+    ):
+        self.transform = transform
+        self.inliers = list(inliers)
+        self.outliers = list(outliers)
+        self.added = list(added)
+        self.rms_error = rms_error
+
+    def __repr__(self):
+        return (
+            f"FrameUpdate(inliers={self.inliers}, outliers={self.outliers}, "
+            f"added={self.added}, rms_error={self.rms_error})"
+        )
+
+
+class LandmarkMap(object):
+    """
+    - obs_sigma: standard deviation, in world units (inches), of an
+      observed tag point in vehicle coordinates.
+    - inlier_threshold: max distance between a tag's observed and mapped
+      points for it to count as agreeing with a transform hypothesis.
+    - max_hypotheses: max number of single-tag hypotheses tried by RANSAC.
+    - seed: seed for choosing hypotheses, for repeatable runs.
+    - cell_size: cell size of the spatial index over landmark points.
+    """
+
+    def __init__(
+        self,
+        obs_sigma=0.5,
+        inlier_threshold=2.0,
+        max_hypotheses=20,
+        seed=0,
+        cell_size=24.0,
+    ):
+        self.obs_sigma = obs_sigma
+        self.inlier_threshold = inlier_threshold
+        self.max_hypotheses = max_hypotheses
+        self.rng = np.random.default_rng(seed)
+        self.spatial = GridIndex(cell_size)
+
+        self.index = {}  # tag_id -> row in the arrays below
+        self.tag_ids = []
+        self.points = np.empty((16, 2, 2), dtype="float64")
+        self.covs = np.empty((16, 2, 2, 2), dtype="float64")
+        self.observations = np.zeros(16, dtype="int64")
+
+    def __len__(self):
+        return len(self.tag_ids)
+
+    def __contains__(self, tag_id):
+        return tag_id in self.index
+
+    def landmark(self, tag_id):
+        """
+        Return the (2, 2) points and (2, 2, 2) covariances of a landmark.
+        """
+        i = self.index[tag_id]
+        return self.points[i], self.covs[i]
+
+    def world_points(self):
+        """
+        Return a dict from tag id to a pair of (x, y) world points, the
+        representation used by render_tag_points in slam.py.
+        """
+        return {
+            tag_id: [tuple(p) for p in self.points[i]]
+            for tag_id, i in self.index.items()
+        }
+
+    def bounds(self):
+        """
+        Return ((min_x, min_y), (max_x, max_y)) covering all landmark
+        points, or None if the map is empty.
+        """
+        return self.spatial.bounds()
+
+    def near(self, center, radius):
+        """
+        Return the ids of tags with a point within `radius` of the world
+        point `center`, nearest first.
+        """
+        return self.spatial.query_radius(center, radius)
+
+    def visible_from(self, pose, max_range=60.0, fov=math.radians(90)):
+        """
+        Return the ids of tags that should be in view from `pose`, the
+        (x, y, theta) of a vehicle-to-world transform, nearest first. See
+        GridIndex.query_view.
+        """
+        return self.spatial.query_view(pose, max_range, fov)
+
+    def restore(self, tag_ids, points, covs, observations):
+        """
+        Replace the contents of the map with saved landmarks, e.g. from
+        mapstore.load_map. The arrays are copied.
+        """
+        n = len(tag_ids)
+        size = max(16, 1 << (n - 1).bit_length())
+        self.tag_ids = [int(t) for t in tag_ids]
+        self.index = {t: i for i, t in enumerate(self.tag_ids)}
+        self.points = np.empty((size, 2, 2), dtype="float64")
+        self.covs = np.empty((size, 2, 2, 2), dtype="float64")
+        self.observations = np.zeros(size, dtype="int64")
+        self.points[:n] = points
+        self.covs[:n] = covs
+        self.observations[:n] = observations
+        self.spatial = GridIndex(self.spatial.cell_size)
+        for i, t in enumerate(self.tag_ids):
+            self.spatial.update(t, self.points[i])
+
+    def move(self, tag_id, points):
+        """
+        Replace the position of a known landmark's two points, e.g. with
+        the result of optimizing the pose graph, keeping its covariances
+        and observation count.
+        """
+        i = self.index[tag_id]
+        self.points[i] = points
+        self.spatial.update(tag_id, self.points[i])
+
+    def _add(self, tag_id, points, cov):
+        n = len(self.tag_ids)
+        if n == len(self.points):
+            self.points = np.concatenate([self.points, np.empty_like(self.points)])
+            self.covs = np.concatenate([self.covs, np.empty_like(self.covs)])
+            self.observations = np.concatenate(
+                [self.observations, np.zeros_like(self.observations)]
+            )
+        self.index[tag_id] = n
+        self.tag_ids.append(tag_id)
+        self.points[n] = points
+        self.covs[n] = cov
+        self.observations[n] = 1
+        self.spatial.update(tag_id, self.points[n])
+
+    def _fuse(self, tag_id, points, cov):
+        # Kalman update of each point with a direct observation of it, i.e.
+        # the product of the two Gaussians.
+        i = self.index[tag_id]
+        for k in range(2):
+            prior_cov = self.covs[i, k]
+            gain = prior_cov @ np.linalg.inv(prior_cov + cov)
+            self.points[i, k] += gain @ (points[k] - self.points[i, k])
+            self.covs[i, k] = (np.eye(2) - gain) @ prior_cov
+        self.observations[i] += 1
+        self.spatial.update(tag_id, self.points[i])
+
+    def _ransac(self, known, veh_points):
+        """
+        Choose the transform most tags agree with. Each known tag's two
+        points are enough to fix a rigid transform, so hypotheses come
+        from single tags. Returns None for the transform and error if no
+        tag agrees with any hypothesis, e.g. a single known tag detected at
+        the wrong scale.
+        """
+        rows = [self.index[t] for t in known]
+        world = self.points[rows]
+        veh = np.stack([veh_points[t] for t in known])
+
+        candidates = np.arange(len(known))
+        if len(candidates) > self.max_hypotheses:
+            candidates = self.rng.choice(
+                candidates, self.max_hypotheses, replace=False
+            )
+
+        best = None
+        for c in candidates:
+            transform = fit_rigid_transform(veh[c], world[c])
+            errors = np.linalg.norm(
+                apply_transform(transform, veh.reshape(-1, 2)).reshape(-1, 2, 2)
+                - world,
+                axis=-1,
+            ).max(axis=1)
+            inliers = errors <= self.inlier_threshold
+            score = (inliers.sum(), -errors[inliers].sum())
+            if best is None or score > best[0]:
+                best = (score, inliers)
+
+        # Refit to all the inliers, trusting well-established points more.
+        inliers = best[1]
+        if not inliers.any():
+            return None, inliers, None
+        variances = np.trace(self.covs[rows], axis1=-2, axis2=-1)
+        weights = 1.0 / variances[inliers].reshape(-1)
+        transform = fit_rigid_transform(
+            veh[inliers].reshape(-1, 2), world[inliers].reshape(-1, 2), weights
+        )
+        residuals = (
+            apply_transform(transform, veh[inliers].reshape(-1, 2))
+            - world[inliers].reshape(-1, 2)
+        )
+        rms_error = float(np.sqrt(np.mean(np.sum(residuals ** 2, axis=1))))
+        return transform, inliers, rms_error
+
+    def observe(self, tag_veh_points, prior=None):
+        """
+        Incorporate one frame's detections, given as a dict from tag id to
+        a pair of points in vehicle coordinates.
+
+        The first frame defines the world frame. After that the transform
+        is estimated from the tags already in the map; if none are visible
+        the `prior` transform is used if given (e.g. from odometry),
+        otherwise the frame is skipped. Returns a FrameUpdate.
+        """
+        veh_points = {
+            t: np.asarray(p, dtype="float64").reshape(2, 2)
+            for t, p in tag_veh_points.items()
+        }
+        obs_cov = np.eye(2) * self.obs_sigma ** 2
+
+        if not self.tag_ids:
+            transform = np.eye(3) if prior is None else prior
+            for t, p in veh_points.items():
+                self._add(t, apply_transform(transform, p), [obs_cov, obs_cov])
+            return FrameUpdate(transform, added=veh_points.keys(), rms_error=0.0)
+
+        known = [t for t in veh_points if t in self.index]
+        new = [t for t in veh_points if t not in self.index]
+
+        transform, inliers, outliers, rms_error = None, [], [], None
+        if known:
+            transform, inlier_mask, rms_error = self._ransac(known, veh_points)
+            inliers = [t for (t, ok) in zip(known, inlier_mask) if ok]
+            outliers = [t for (t, ok) in zip(known, inlier_mask) if not ok]
+        if transform is None:
+            # No known tags, or none that can be trusted.
+            if prior is None:
+                _logger.debug(
+                    f"No usable known tags among {list(veh_points)}, skipping frame"
+                )
+                return FrameUpdate(outliers=outliers)
+            transform, rms_error = prior, None
+
+        # Observations inherit the uncertainty of the transform as well as
+        # their own. The residual is a rough stand-in for the former.
+        rot = transform[:2, :2]
+        transform_var = (rms_error or self.obs_sigma) ** 2
+        world_cov = rot @ obs_cov @ rot.T + np.eye(2) * transform_var
+
+        for t in inliers:
+            self._fuse(t, apply_transform(transform, veh_points[t]), world_cov)
+        for t in new:
+            world_points = apply_transform(transform, veh_points[t])
+            self._add(t, world_points, [world_cov, world_cov])
+        if outliers:
+            _logger.debug(f"Rejected outlier tags {outliers}")
+
+        return FrameUpdate(transform, inliers, outliers, new, rms_error)
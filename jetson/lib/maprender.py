@@ -0,0 +1,260 @@
+"""
+Incremental rendering of the SLAM tag map, as SVG or into an image.
+
+render_tag_points in slam.py lays out and draws the whole map each time.
+The renderers here keep their output between updates: landmarks added
+since the last update are drawn onto what is already there, and the map
+is only laid out again when it outgrows the current view. Views are
+grown with some slack so that happens rarely while mapping.
+
+Basic use:
+
+raster = RasterMapRenderer((640, 480))
+...
+if raster.update(lmap):
+    writer.write(raster.canvas)  # BGR, e.g. to an RtspServer writer
+
+svg = SvgMapRenderer()
+svg.update(lmap)
+open("map.svg", "wt").write(svg.svg())
+"""
+
+import cv2
+import logging
+import numpy as np
+import xml.etree.ElementTree as ET
+
+_logger = logging.getLogger(__name__)
+
+
+class MapRenderer(object):
+    """
+    Base class keeping track of the layout and of which landmarks have
+    been drawn. Subclasses implement _clear and _draw, and _move if they
+    can replace a single landmark's drawing.
+
+    - size: (width, height) of the drawing area.
+    - padding: space around the map inside the drawing area.
+    - slack: fraction by which to grow the view beyond the map's bounds
+      when it needs to be laid out again.
+    """
+
+    def __init__(self, size, padding=36, slack=0.25):
+        self.width, self.height = size
+        self.padding = padding
+        self.slack = slack
+        self.view = None  # ((min_x, min_y), (max_x, max_y)) in world units
+        self.scale = None
+        self.drawn = {}  # tag_id -> points as drawn, in world units
+        self.seen_observations = np.zeros(0, dtype="int64")
+        self.layouts = 0
+
+    def to_pixels(self, points):
+        """
+        Map world points to drawing coordinates, with y increasing upward
+        in the world and downward in the drawing.
+        """
+        (min_x, min_y), _ = self.view
+        points = np.asarray(points, dtype="float64")
+        return np.column_stack(
+            [
+                self.padding + (points[:, 0] - min_x) * self.scale,
+                self.height - self.padding - (points[:, 1] - min_y) * self.scale,
+            ]
+        )
+
+    def _layout(self, bounds, slack):
+        (min_x, min_y), (max_x, max_y) = bounds
+        grow_x = (max_x - min_x) * slack / 2
+        grow_y = (max_y - min_y) * slack / 2
+        self.view = ((min_x - grow_x, min_y - grow_y), (max_x + grow_x, max_y + grow_y))
+        (min_x, min_y), (max_x, max_y) = self.view
+        content_width = self.width - 2 * self.padding
+        content_height = self.height - 2 * self.padding
+        self.scale = min(
+            content_height / max(max_y - min_y, 1e-9),
+            content_width / max(max_x - min_x, 1e-9),
+        )
+        self.layouts += 1
+
+    def _in_view(self, bounds):
+        (min_x, min_y), (max_x, max_y) = bounds
+        (view_min_x, view_min_y), (view_max_x, view_max_y) = self.view
+        return (
+            view_min_x <= min_x
+            and view_min_y <= min_y
+            and max_x <= view_max_x
+            and max_y <= view_max_y
+        )
+
+    def _clear(self):
+        raise NotImplementedError
+
+    def _draw(self, tag_id, points):
+        raise NotImplementedError
+
+    def _move(self, tag_id, points):
+        """
+        Replace the drawing of a landmark that has moved. Returns False if
+        the renderer can't, in which case everything is redrawn.
+        """
+        return False
+
+    def update_tags(self, tag2points, bounds=None, slack=None):
+        """
+        Add or move the landmarks in `tag2points`, a dict from tag id to a
+        pair of world points. `bounds` must cover every landmark drawn so
+        far as well as these; by default it is computed. Returns True if
+        anything visible changed.
+        """
+        if not tag2points:
+            return False
+        slack = self.slack if slack is None else slack
+        if bounds is None:
+            points = np.concatenate(
+                [np.reshape(list(self.drawn.values()), (-1, 2))]
+                + [np.reshape(p, (-1, 2)) for p in tag2points.values()]
+            )
+            bounds = (tuple(points.min(axis=0)), tuple(points.max(axis=0)))
+
+        if self.view is None or not self._in_view(bounds):
+            self._layout(bounds, slack)
+            self.drawn.update(
+                (t, np.array(p, dtype="float64")) for t, p in tag2points.items()
+            )
+            self._redraw()
+            return True
+
+        redraw = False
+        for tag_id, points in tag2points.items():
+            points = np.array(points, dtype="float64")
+            old = self.drawn.get(tag_id)
+            self.drawn[tag_id] = points
+            if old is None:
+                self._draw(tag_id, points)
+            elif np.abs(old - points).max() * self.scale >= 0.5:
+                redraw = redraw or not self._move(tag_id, points)
+        if redraw:
+            self._redraw()
+        return True
+
+    def _redraw(self):
+        self._clear()
+        for tag_id, points in self.drawn.items():
+            self._draw(tag_id, points)
+
+    def update(self, lmap):
+        """
+        Bring the drawing up to date with a LandmarkMap, looking only at
+        landmarks added or refined since the last update. Returns True if
+        anything visible changed.
+        """
+        n = len(lmap)
+        seen = np.zeros(n, dtype="int64")
+        seen[: len(self.seen_observations)] = self.seen_observations
+        changed = np.flatnonzero(lmap.observations[:n] != seen)
+        self.seen_observations = lmap.observations[:n].copy()
+        return self.update_tags(
+            {lmap.tag_ids[i]: lmap.points[i] for i in changed}, lmap.bounds()
+        )
+
+
+class SvgMapRenderer(MapRenderer):
+    """
+    Renders the map as SVG in the same style as slam.render_tag_points,
+    keeping each landmark's markup so svg() only has to join them.
+    """
+
+    page_height = 792
+    page_width = 612
+    margin = 36
+
+    def __init__(self, padding=36, slack=0.25):
+        super().__init__(
+            (self.page_width - self.margin * 2, self.page_height - self.margin * 2),
+            padding=padding,
+            slack=slack,
+        )
+        self.fragments = {}
+
+    def _clear(self):
+        self.fragments.clear()
+
+    def _draw(self, tag_id, points):
+        p1, p2 = self.to_pixels(points)
+        elements = [
+            ET.Element("circle", cx=f"{p[0]}", cy=f"{p[1]}", r="5", fill="blue")
+            for p in (p1, p2)
+        ]
+        elements.append(
+            ET.Element(
+                "line",
+                x1=f"{p1[0]}",
+                y1=f"{p1[1]}",
+                x2=f"{p2[0]}",
+                y2=f"{p2[1]}",
+                stroke="blue",
+                attrib={"stroke-width": "2"},
+            )
+        )
+        text = ET.Element("text", x=f"{(p1[0]+p2[0])/2}", y=f"{(p1[1]+p2[1])/2}")
+        text.text = f"{tag_id:05}"
+        elements.append(text)
+        self.fragments[tag_id] = "".join(
+            ET.tostring(e, encoding="unicode") for e in elements
+        )
+
+    def _move(self, tag_id, points):
+        self._draw(tag_id, points)
+        return True
+
+    def svg(self):
+        return (
+            f'<svg xmlns="http://www.w3.org/2000/svg" width="{self.width}px" '
+            f'height="{self.height}px">' + "".join(self.fragments.values()) + "</svg>"
+        )
+
+
+class RasterMapRenderer(MapRenderer):
+    """
+    Draws the map into `canvas`, a BGR uint8 array ready for cv2 video
+    writers or cv2.imwrite. A landmark that moves by a pixel or more
+    causes a redraw, since erasing it could erase its neighbors too.
+    """
+
+    def __init__(
+        self,
+        size=(640, 480),
+        padding=24,
+        slack=0.25,
+        background=(255, 255, 255),
+        color=(255, 0, 0),
+    ):
+        super().__init__(size, padding=padding, slack=slack)
+        self.background = background
+        self.color = color
+        self.canvas = np.empty((self.height, self.width, 3), dtype="uint8")
+        self._clear()
+
+    def _clear(self):
+        self.canvas[:] = self.background
+
+    def _draw(self, tag_id, points):
+        # cv2 draws at integer pixels; shift gives sub-pixel precision.
+        shift = 4
+        p1, p2 = np.round(self.to_pixels(points) * (1 << shift)).astype(int)
+        p1, p2 = tuple(int(v) for v in p1), tuple(int(v) for v in p2)
+        cv2.line(self.canvas, p1, p2, self.color, 2, cv2.LINE_AA, shift)
+        for p in (p1, p2):
+            cv2.circle(self.canvas, p, 3 << shift, self.color, -1, cv2.LINE_AA, shift)
+        mid = ((p1[0] + p2[0]) >> (shift + 1), (p1[1] + p2[1]) >> (shift + 1))
+        cv2.putText(
+            self.canvas,
+            str(tag_id),
+            mid,
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.4,
+            (0, 0, 0),
+            1,
+            cv2.LINE_AA,
+        )
@@ -0,0 +1,226 @@
+"""
+On-disk format for SLAM maps, so a session can pick up a map built by an
+earlier one.
+
+A map is a directory of flat binary files of fixed-size records, which
+can be appended to a step at a time and loaded with np.memmap without
+parsing anything:
+
+- landmarks.bin: one LANDMARK_DTYPE record each time a landmark is added
+  or refined. The latest record for a tag is its current state.
+- poses.bin: one POSE_DTYPE record per pose written, the vehicle-to-world
+  (x, y, theta) in the map's convention with a time.time() timestamp.
+- meta.json: format version and record layouts, checked on load.
+
+Since landmark records are only ever appended, a crash can at worst leave
+a partial record at the end of a file, which loading ignores. compact()
+rewrites the landmarks file with only the latest records when it has
+grown large.
+
+Basic use:
+
+writer = MapWriter("map", lmap)
+... lmap.observe(...)
+writer.write_step(step, poses=[(time.time(), x, y, theta)])
+
+lmap, poses = load_map("map")
+"""
+
+import json
+import logging
+import numpy as np
+import os
+from landmarks import LandmarkMap
+
+_logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+LANDMARK_DTYPE = np.dtype(
+    [
+        ("step", "<i8"),
+        ("tag_id", "<i8"),
+        ("observations", "<i8"),
+        ("points", "<f8", (2, 2)),
+        ("covs", "<f8", (2, 2, 2)),
+    ]
+)
+
+POSE_DTYPE = np.dtype(
+    [("step", "<i8"), ("t", "<f8"), ("x", "<f8"), ("y", "<f8"), ("theta", "<f8")]
+)
+
+_FILES = {"landmarks": LANDMARK_DTYPE, "poses": POSE_DTYPE}
+
+
+class MapFormatException(Exception):
+    pass
+
+
+def _meta():
+    return dict(
+        version=FORMAT_VERSION,
+        dtypes={name: dtype.descr for (name, dtype) in _FILES.items()},
+    )
+
+
+def _read_records(path, name):
+    """
+    Memory-map the whole records of one of the files in a map directory.
+    """
+    dtype = _FILES[name]
+    filename = os.path.join(path, f"{name}.bin")
+    count = os.path.getsize(filename) // dtype.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode="r", shape=(count,))
+
+
+def _latest_landmarks(records):
+    """
+    Return the index of the latest record for each tag in an array of
+    landmark records, in order of when each tag was first recorded.
+    """
+    # np.unique finds the first occurrence, so look from the end.
+    tag_ids = records["tag_id"][::-1]
+    _, rev_index = np.unique(tag_ids, return_index=True)
+    latest = len(records) - 1 - rev_index
+    _, first = np.unique(records["tag_id"], return_index=True)
+    return latest[np.argsort(first)]
+
+
+def load_map(path, **lmap_kwargs):
+    """
+    Load the map saved in the directory `path`. Returns a LandmarkMap
+    (constructed with `lmap_kwargs`) holding the latest state of each
+    landmark, and a read-only POSE_DTYPE array of the saved poses.
+    """
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    if meta.get("version") != FORMAT_VERSION:
+        raise MapFormatException(
+            f"Unsupported map format version {meta.get('version')} in {path}"
+        )
+    if meta["dtypes"] != json.loads(json.dumps(_meta()["dtypes"])):
+        raise MapFormatException(f"Unexpected record layout in {path}")
+
+    records = _read_records(path, "landmarks")
+    latest = records[_latest_landmarks(records)]
+    lmap = LandmarkMap(**lmap_kwargs)
+    lmap.restore(
+        latest["tag_id"], latest["points"], latest["covs"], latest["observations"]
+    )
+    poses = _read_records(path, "poses")
+    _logger.info(
+        f"Loaded {len(lmap)} landmarks from {len(records)} records "
+        f"and {len(poses)} poses from {path}"
+    )
+    return lmap, poses
+
+
+class MapWriter(object):
+    """
+    Appends the changes to a LandmarkMap to a map directory.
+
+    With resume=False any existing map in `path` is replaced. With
+    resume=True new records are appended to it, and `lmap` is assumed to
+    have been loaded from it, so only later changes are written.
+    """
+
+    def __init__(self, path, lmap, resume=False):
+        self.path = path
+        self.lmap = lmap
+        os.makedirs(path, exist_ok=True)
+
+        mode = "ab" if resume else "wb"
+        self.files = {
+            name: open(os.path.join(path, f"{name}.bin"), mode) for name in _FILES
+        }
+        self._write_meta()
+        if not resume:
+            self.written = np.zeros(0, dtype="int64")
+            self.written_points = np.zeros((0, 2, 2))
+        else:
+            for f in self.files.values():
+                self._trim_partial(f)
+            self.written = lmap.observations[: len(lmap)].copy()
+            self.written_points = lmap.points[: len(lmap)].copy()
+
+    def _write_meta(self):
+        tmp = os.path.join(self.path, "meta.json.tmp")
+        with open(tmp, "wt") as f:
+            json.dump(_meta(), f)
+        os.replace(tmp, os.path.join(self.path, "meta.json"))
+
+    def _trim_partial(self, f):
+        # Drop a partial record left by an interrupted write, so that new
+        # records stay aligned.
+        dtype = _FILES[os.path.basename(f.name)[: -len(".bin")]]
+        size = f.seek(0, os.SEEK_END)
+        if size % dtype.itemsize:
+            f.truncate(size - size % dtype.itemsize)
+
+    def write_step(self, step, poses=()):
+        """
+        Append records for the landmarks added, refined or moved (see
+        LandmarkMap.move) since the last write, and for `poses`, a sequence of (t, x, y, theta). Returns the
+        number of landmark records written.
+        """
+        lmap = self.lmap
+        n = len(lmap)
+        written = np.zeros(n, dtype="int64")
+        written[: len(self.written)] = self.written
+        moved = np.zeros(n, dtype=bool)
+        m = len(self.written_points)
+        moved[:m] = (lmap.points[:m] != self.written_points).any(axis=(1, 2))
+        changed = np.flatnonzero((lmap.observations[:n] != written) | moved)
+
+        records = np.zeros(len(changed), dtype=LANDMARK_DTYPE)
+        records["step"] = step
+        records["tag_id"] = [lmap.tag_ids[i] for i in changed]
+        records["observations"] = lmap.observations[changed]
+        records["points"] = lmap.points[changed]
+        records["covs"] = lmap.covs[changed]
+        self.files["landmarks"].write(records.tobytes())
+
+        pose_records = np.zeros(len(poses), dtype=POSE_DTYPE)
+        pose_records["step"] = step
+        if len(poses):
+            poses = np.asarray(poses, dtype="float64").reshape(-1, 4)
+            for k, field in enumerate(("t", "x", "y", "theta")):
+                pose_records[field] = poses[:, k]
+        self.files["poses"].write(pose_records.tobytes())
+
+        for f in self.files.values():
+            f.flush()
+        self.written = lmap.observations[:n].copy()
+        self.written_points = lmap.points[:n].copy()
+        return len(changed)
+
+    def compact(self):
+        """
+        Rewrite the landmarks file with only the latest record per tag.
+        """
+        self.files["landmarks"].close()
+        records = _read_records(self.path, "landmarks")
+        latest = np.array(records[_latest_landmarks(records)])
+        del records
+
+        filename = os.path.join(self.path, "landmarks.bin")
+        tmp = filename + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(latest.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, filename)
+        self.files["landmarks"] = open(filename, "ab")
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
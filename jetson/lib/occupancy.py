@@ -0,0 +1,266 @@
+"""
+Occupancy grid of the floor around the vehicle, built from segmentation
+masks.
+
+Each frame's labels (floor, not floor or unknown per pixel, as produced
+by the segmentation models) are projected onto the floor with the
+calibration homography, placed in the world with the vehicle's pose and
+folded into a log-odds grid.
+
+The homography never changes, so FloorSampler works out once which image
+pixels to look at: points on a regular grid on the floor in front of the
+vehicle, projected into the image. Per frame that leaves a gather of the
+labels at those pixels, a rigid transform of the points and a histogram
+per grid chunk, all vectorized. The grid is stored in fixed-size chunks
+allocated as the vehicle explores, so memory scales with the area seen
+rather than with the extent of the map.
+
+Basic use:
+
+sampler = FloorSampler(CalibratedCamera.load(), (1280, 720))
+grid = OccupancyGrid()
+...
+grid.update_from_labels(sampler, labels, veh.curr_pose)
+img = grid.to_image()
+
+Run this module to benchmark updates with the saved calibration:
+
+python3 occupancy.py --frames 300
+"""
+
+import argparse
+import calibration
+import logging
+import math
+import numpy as np
+import time
+from pose import Pose2D
+
+_logger = logging.getLogger(__name__)
+
+# Same values as COLOR_UNKNOWN, COLOR_NONFLOOR, COLOR_FLOOR in
+# segmentation/render.py, which can't be imported without TensorFlow.
+LABEL_UNKNOWN, LABEL_NONFLOOR, LABEL_FLOOR = 0, 1, 2
+
+
+def labels_from_probabilities(probs, threshold=0.75):
+    """
+    Convert a (H, W, 2) array of (not floor, floor) probabilities from the
+    segmentation models into a (H, W) array of labels.
+    """
+    labels = np.full(probs.shape[:2], LABEL_UNKNOWN, dtype="uint8")
+    labels[probs[:, :, 0] >= threshold] = LABEL_NONFLOOR
+    labels[probs[:, :, 1] >= threshold] = LABEL_FLOOR
+    return labels
+
+
+class FloorSampler(object):
+    """
+    Fixed set of floor points in front of the vehicle and the image pixels
+    they appear at.
+
+    - calibrated: a calibration.CalibratedCamera.
+    - image_size: (width, height) of the frames to be labeled.
+    - spacing: distance between sample points on the floor, in inches.
+    - max_range: ignore the floor further than this from the vehicle, where
+      the projection is least accurate.
+
+    The points are kept in the Pose2D convention (x forward, y to the left)
+    so they can be placed with Vehicle.curr_pose.
+    """
+
+    def __init__(self, calibrated, image_size, spacing=0.5, max_range=60.0):
+        self.spacing = spacing
+        xs = np.arange(-max_range, max_range + spacing / 2, spacing)
+        ys = np.arange(spacing, max_range + spacing / 2, spacing)
+        veh = np.stack(np.meshgrid(xs, ys), axis=-1).reshape(-1, 2)
+        veh = veh[np.hypot(veh[:, 0], veh[:, 1]) <= max_range]
+
+        pixels = calibrated.to_image(veh)
+        width, height = image_size
+        inside = (
+            np.isfinite(pixels).all(axis=1)
+            & (pixels[:, 0] >= 0)
+            & (pixels[:, 0] < width)
+            & (pixels[:, 1] >= 0)
+            & (pixels[:, 1] < height)
+        )
+        # Floor points beyond the horizon also project into the image, upside
+        # down. They're on the other side of the homography's singular line
+        # from the bottom of the image, which is certainly floor.
+        inv = np.linalg.inv(calibrated.hmat)
+        bottom = calibrated.to_vehicle(np.array([[width / 2, height - 1.0]]))[0]
+        side = np.sign(inv[2, :2] @ bottom + inv[2, 2])
+        inside &= np.sign(veh @ inv[2, :2] + inv[2, 2]) == side
+        veh, pixels = veh[inside], pixels[inside]
+
+        self.rows = pixels[:, 1].astype("intp")
+        self.cols = pixels[:, 0].astype("intp")
+        # Calibration vehicle frame (x right, y forward) to Pose2D's.
+        self.points = np.column_stack([veh[:, 1], -veh[:, 0]])
+        _logger.debug(f"FloorSampler: {len(self.points)} sample points")
+
+    def __len__(self):
+        return len(self.points)
+
+    def sample(self, labels):
+        return labels[self.rows, self.cols]
+
+
+class OccupancyGrid(object):
+    """
+    Log-odds occupancy grid stored as a dict of square chunks.
+
+    - cell_size: side of a cell, in inches.
+    - chunk_size: cells per side of a chunk.
+    - l_occupied, l_free: log-odds added for a cell fully observed as not
+      floor, or as floor, in one frame.
+    - l_min, l_max: limits on the log-odds, so the map can change its mind
+      about cells that change.
+    """
+
+    def __init__(
+        self,
+        cell_size=1.0,
+        chunk_size=64,
+        l_occupied=0.85,
+        l_free=-0.4,
+        l_min=-4.0,
+        l_max=4.0,
+    ):
+        self.cell_size = cell_size
+        self.chunk_size = chunk_size
+        self.l_occupied = l_occupied
+        self.l_free = l_free
+        self.l_min = l_min
+        self.l_max = l_max
+        self.chunks = {}  # (i, j) -> (chunk_size, chunk_size) float32 log-odds
+
+    def update(self, points, occupied, weight=1.0):
+        """
+        Fold in observations of the world `points` (N, 2), each of which is
+        `occupied` (True) or free (False). Each observation adds `weight`
+        times l_occupied or l_free, so pass the fraction of a cell each
+        point stands for to keep the update independent of the sampling.
+        """
+        cells = np.floor(np.asarray(points) / self.cell_size).astype("int64")
+        deltas = np.where(occupied, self.l_occupied, self.l_free) * weight
+
+        c = self.chunk_size
+        chunk_ids = cells // c
+        local = (cells[:, 0] - chunk_ids[:, 0] * c) * c + (
+            cells[:, 1] - chunk_ids[:, 1] * c
+        )
+        keys, inverse = np.unique(chunk_ids, axis=0, return_inverse=True)
+        # One histogram over all the chunks touched, chunk by chunk.
+        changes = np.bincount(
+            inverse.reshape(-1) * (c * c) + local,
+            weights=deltas,
+            minlength=len(keys) * c * c,
+        ).reshape(-1, c, c)
+        for (i, j), change in zip(keys.tolist(), changes):
+            chunk = self.chunks.get((i, j))
+            if chunk is None:
+                chunk = self.chunks[(i, j)] = np.zeros((c, c), dtype="float32")
+            chunk += change
+            np.clip(chunk, self.l_min, self.l_max, out=chunk)
+
+    def update_from_labels(self, sampler, labels, pose):
+        """
+        Fold in a frame's (H, W) labels, taken with the vehicle at `pose`, a
+        Pose2D in the same world frame as earlier updates.
+        """
+        sampled = sampler.sample(labels)
+        known = sampled != LABEL_UNKNOWN
+        c, s = math.cos(pose.theta), math.sin(pose.theta)
+        local = sampler.points[known]
+        world = np.empty_like(local)
+        world[:, 0] = pose.x + c * local[:, 0] - s * local[:, 1]
+        world[:, 1] = pose.y + s * local[:, 0] + c * local[:, 1]
+        weight = min(1.0, (sampler.spacing / self.cell_size) ** 2)
+        self.update(world, sampled[known] == LABEL_NONFLOOR, weight)
+
+    def log_odds(self, points):
+        """
+        Return the log-odds of the cells containing the world `points`,
+        0 for cells never observed.
+        """
+        cells = np.floor(np.asarray(points) / self.cell_size).astype("int64")
+        c = self.chunk_size
+        result = np.zeros(len(cells), dtype="float32")
+        for n, (x, y) in enumerate(cells):
+            chunk = self.chunks.get((x // c, y // c))
+            if chunk is not None:
+                result[n] = chunk[x % c, y % c]
+        return result
+
+    def bounds(self):
+        """
+        Return ((min_x, min_y), (max_x, max_y)) in world units covering all
+        allocated chunks, or None if nothing has been observed.
+        """
+        if not self.chunks:
+            return None
+        keys = np.array(list(self.chunks))
+        extent = self.chunk_size * self.cell_size
+        lo, hi = keys.min(axis=0) * extent, (keys.max(axis=0) + 1) * extent
+        return (float(lo[0]), float(lo[1])), (float(hi[0]), float(hi[1]))
+
+    def to_image(self):
+        """
+        Render the grid as a uint8 image: black for occupied, white for free
+        and gray for unknown. World x increases to the right and y upward.
+        Returns the image and its bounds as from bounds().
+        """
+        bounds = self.bounds()
+        if bounds is None:
+            return np.zeros((0, 0), dtype="uint8"), None
+        c = self.chunk_size
+        keys = np.array(list(self.chunks))
+        (i0, j0), (i1, j1) = keys.min(axis=0), keys.max(axis=0)
+        log_odds = np.zeros(((i1 - i0 + 1) * c, (j1 - j0 + 1) * c), dtype="float32")
+        for (i, j), chunk in self.chunks.items():
+            log_odds[
+                (i - i0) * c : (i - i0 + 1) * c, (j - j0) * c : (j - j0 + 1) * c
+            ] = chunk
+        free = 1.0 / (1.0 + np.exp(log_odds))
+        # Rows of log_odds are x and columns y; images are the other way up.
+        img = (free.T[::-1] * 255).astype("uint8")
+        return img, bounds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--spacing", type=float, default=0.5)
+    args = parser.parse_args()
+
+    calibrated = calibration.CalibratedCamera.load()
+    start = time.perf_counter()
+    sampler = FloorSampler(calibrated, (args.width, args.height), spacing=args.spacing)
+    print(
+        f"{len(sampler)} sample points, set up in "
+        f"{time.perf_counter() - start:.3f} sec"
+    )
+
+    rng = np.random.default_rng(0)
+    labels = rng.integers(0, 3, (args.height, args.width), dtype="uint8")
+    grid = OccupancyGrid()
+
+    start = time.perf_counter()
+    for n in range(args.frames):
+        # Drive in a slow circle.
+        angle = n * 0.01
+        pose = Pose2D(100 * math.sin(angle), 100 - 100 * math.cos(angle), angle)
+        grid.update_from_labels(sampler, labels, pose)
+    secs = time.perf_counter() - start
+    print(
+        f"{args.frames} updates in {secs:.3f} sec, {args.frames / secs:.1f} fps, "
+        f"{len(grid.chunks)} chunks"
+    )
+
+
+if __name__ == "__main__":
+    main()
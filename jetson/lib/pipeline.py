@@ -0,0 +1,229 @@
+"""
+Small helper for running a frame-processing pipeline with each stage on
+its own thread, connected by bounded queues so a slow stage applies
+backpressure rather than letting frames pile up in memory.
+
+Basic use:
+
+pipe = Pipeline(frames_iterable, name="decode")
+pipe.then("warp", warp_fn).then("encode", writer.write)
+pipe.run(report_interval=5.0)
+
+Each stage function takes one item and returns the item to pass on. The
+return value of the last stage is discarded. Per-stage counters are
+available from stats() while running and after.
+
+A stage can also work on batches, e.g. to run a model on several frames
+at once:
+
+pipe.then("infer", lambda frames: model.predict(np.stack(frames)), batch_size=8)
+
+The function then gets a list of up to batch_size items and returns a
+sequence of results, which are passed on one at a time.
+"""
+
+import logging
+import queue
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+_END = object()
+_TIMEOUT = object()
+
+
+class StageStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy_secs = 0.0
+        self.start_time = None
+        self.end_time = None
+
+    def to_json_obj(self):
+        """
+        Return a json-serializable summary: items processed, throughput and
+        the fraction of time spent working (as opposed to waiting on the
+        neighboring stages).
+        """
+        if self.start_time is None:
+            elapsed = 0.0
+        else:
+            elapsed = (self.end_time or time.monotonic()) - self.start_time
+        return dict(
+            items=self.items,
+            items_per_sec=self.items / elapsed if elapsed > 0 else 0.0,
+            busy_fraction=self.busy_secs / elapsed if elapsed > 0 else 0.0,
+        )
+
+
+class Pipeline(object):
+    def __init__(self, source, name="source", queue_size=4):
+        self.source = source
+        self.source_name = name
+        self.queue_size = queue_size
+        self.stages = []
+        self.stop_event = threading.Event()
+        self.error = None
+        self.stage_stats = []
+
+    def then(self, name, fn, batch_size=None, max_batch_wait=None):
+        """
+        Add a stage. With batch_size, `fn` is called with lists of items;
+        a batch is handed over once it is full, the input ends, or
+        max_batch_wait seconds after its first item arrived if given.
+        """
+        self.stages.append((name, fn, batch_size, max_batch_wait))
+        return self
+
+    def stop(self):
+        """
+        Ask all stages to finish early, e.g. from a signal handler.
+        """
+        self.stop_event.set()
+
+    def stats(self):
+        return {s.name: s.to_json_obj() for s in self.stage_stats}
+
+    def _put(self, q, item):
+        while not self.stop_event.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q, deadline=None):
+        while not self.stop_event.is_set():
+            timeout = 0.1
+            if deadline is not None:
+                timeout = min(timeout, deadline - time.monotonic())
+                if timeout <= 0:
+                    return _TIMEOUT
+            try:
+                return q.get(timeout=timeout)
+            except queue.Empty:
+                pass
+        return _END
+
+    def _get_batch(self, q, batch_size, max_batch_wait):
+        """
+        Return a list of up to batch_size items, and whether the input
+        ended.
+        """
+        item = self._get(q)
+        if item is _END:
+            return [], True
+        batch = [item]
+        deadline = None
+        if max_batch_wait is not None:
+            deadline = time.monotonic() + max_batch_wait
+        while len(batch) < batch_size:
+            item = self._get(q, deadline)
+            if item is _TIMEOUT:
+                break
+            if item is _END:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _fail(self, stats, e):
+        _logger.exception(f"Pipeline stage {stats.name} failed")
+        self.error = e
+        self.stop_event.set()
+
+    def _run_source(self, stats, out_q):
+        stats.start_time = time.monotonic()
+        try:
+            it = iter(self.source)
+            while not self.stop_event.is_set():
+                t0 = time.monotonic()
+                try:
+                    item = next(it)
+                except StopIteration:
+                    break
+                stats.busy_secs += time.monotonic() - t0
+                stats.items += 1
+                if not self._put(out_q, item):
+                    break
+        except Exception as e:
+            self._fail(stats, e)
+        finally:
+            stats.end_time = time.monotonic()
+            self._put(out_q, _END)
+
+    def _run_stage(self, stats, fn, in_q, out_q, batch_size, max_batch_wait):
+        stats.start_time = time.monotonic()
+        try:
+            while True:
+                if batch_size:
+                    batch, ended = self._get_batch(in_q, batch_size, max_batch_wait)
+                else:
+                    item = self._get(in_q)
+                    batch, ended = ([], True) if item is _END else ([item], False)
+                if batch:
+                    t0 = time.monotonic()
+                    results = fn(batch) if batch_size else [fn(batch[0])]
+                    stats.busy_secs += time.monotonic() - t0
+                    stats.items += len(batch)
+                    if out_q is not None and not all(
+                        self._put(out_q, result) for result in results
+                    ):
+                        break
+                if ended:
+                    break
+        except Exception as e:
+            self._fail(stats, e)
+        finally:
+            stats.end_time = time.monotonic()
+            if out_q is not None:
+                self._put(out_q, _END)
+
+    def run(self, report_interval=None):
+        """
+        Run until the source is exhausted or stop() is called, and return
+        the final stats. Re-raises the first exception from any stage.
+        """
+        assert self.stages, "A pipeline needs at least one stage after the source."
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        self.stage_stats = [StageStats(self.source_name)] + [
+            StageStats(name) for (name, *_) in self.stages
+        ]
+
+        threads = [
+            threading.Thread(
+                target=self._run_source,
+                args=(self.stage_stats[0], queues[0]),
+                daemon=True,
+            )
+        ]
+        for i, (name, fn, batch_size, max_batch_wait) in enumerate(self.stages):
+            out_q = queues[i + 1] if i + 1 < len(queues) else None
+            threads.append(
+                threading.Thread(
+                    target=self._run_stage,
+                    args=(
+                        self.stage_stats[i + 1],
+                        fn,
+                        queues[i],
+                        out_q,
+                        batch_size,
+                        max_batch_wait,
+                    ),
+                    daemon=True,
+                )
+            )
+
+        for t in threads:
+            t.start()
+        for t in threads:
+            while t.is_alive():
+                t.join(timeout=report_interval)
+                if report_interval and t.is_alive():
+                    _logger.info(f"Pipeline stats: {self.stats()}")
+
+        if self.error is not None:
+            raise self.error
+        return self.stats()
@@ -1,6 +1,9 @@
 from dataclasses import dataclass
 import logging
 import math
+import numpy as np
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -92,3 +95,136 @@ def pose_from_wheel_distances(left, right, wheel_base, tol=0.001):
         x = c * math.sin(theta)
         y = c - c * math.cos(theta)
         return Pose2D(x, y, reduce_angle(theta))
+
+
+def reduce_angles(theta):
+    """
+    Array version of reduce_angle. Angles come back in the range [-pi, pi).
+    """
+    return np.mod(np.asarray(theta, dtype="float64") + np.pi, 2 * np.pi) - np.pi
+
+
+def poses_from_wheel_distances(left, right, wheel_base, start=Pose2D(), tol=0.001):
+    """
+    Batch version of pose_from_wheel_distances, for replaying encoder logs.
+    `left` and `right` are arrays of per-sample wheel distances. Each sample
+    is converted to a relative pose as in pose_from_wheel_distances and the
+    relative poses are composed in order starting from `start`, as if by
+    repeatedly applying Pose2D.__add__.
+
+    Returns a tuple of (x, y, theta) arrays, one entry per sample, giving
+    the pose after each sample.
+    """
+    left = np.asarray(left, dtype="float64")
+    right = np.asarray(right, dtype="float64")
+
+    # Relative pose for each sample. The scalar version works in terms of
+    # the radius c of the center point's circle of travel. Simplifying that,
+    # the rotation is (right - left) / wheel_base and c is the mean distance
+    # divided by the rotation, which has no trouble with right == 0. The
+    # straight-line case is masked out rather than branched on; the safe
+    # denominator keeps it from dividing by zero.
+    straight = np.abs(left - right) <= tol
+    dtheta = np.where(straight, 0.0, (right - left) / wheel_base)
+    c = (left + right) / 2 / np.where(straight, 1.0, dtheta)
+    dx = np.where(straight, left, c * np.sin(dtheta))
+    dy = np.where(straight, 0.0, c - c * np.cos(dtheta))
+
+    # Composition is a scan: each relative pose is rotated by the heading
+    # accumulated over all previous samples, then translations add up.
+    heading = start.theta + np.cumsum(dtheta)
+    prev_heading = heading - dtheta
+    cos_h = np.cos(prev_heading)
+    sin_h = np.sin(prev_heading)
+    x = start.x + np.cumsum(dx * cos_h - dy * sin_h)
+    y = start.y + np.cumsum(dx * sin_h + dy * cos_h)
+    return x, y, reduce_angles(heading)
+
+
+class PoseHistory:
+    """
+    Compact record of poses over time, stored as parallel float64 arrays
+    of x, y, theta and timestamp rather than a list of Pose2D objects.
+
+    By default the history grows without bound, doubling its storage as
+    needed. If `capacity` is given it acts as a ring buffer holding the
+    most recent `capacity` poses. Either way append is O(1) and the
+    arrays returned by `as_arrays` are views, not copies.
+
+    Appends and reads are guarded by a lock, so one thread (e.g. the one
+    running Vehicle.perform_action_async) can record poses while another
+    reads curr_pose.
+    """
+
+    _FIELDS = ("x", "y", "theta", "t")
+
+    def __init__(self, capacity=None, initial_size=1024):
+        self.capacity = capacity
+        self.initial_size = initial_size
+        self._lock = threading.RLock()
+        self.reset()
+
+    def reset(self, pose=Pose2D(), t=None):
+        """
+        Discard all history and start over from a single pose.
+        """
+        # The ring buffer writes every entry twice, at i and i + capacity,
+        # so the most recent `capacity` entries are always contiguous.
+        size = 2 * self.capacity if self.capacity else self.initial_size
+        with self._lock:
+            self._data = np.empty((len(self._FIELDS), size), dtype="float64")
+            self._start = 0
+            self._len = 0
+            self.append(pose, t)
+
+    def append(self, pose, t=None):
+        if t is None:
+            t = time.time()
+        row = (pose.x, pose.y, pose.theta, t)
+
+        with self._lock:
+            if self.capacity:
+                if self._len == self.capacity:
+                    self._start = (self._start + 1) % self.capacity
+                else:
+                    self._len += 1
+                i = (self._start + self._len - 1) % self.capacity
+                self._data[:, i] = row
+                self._data[:, i + self.capacity] = row
+            else:
+                if self._len == self._data.shape[1]:
+                    grown = np.empty(
+                        (self._data.shape[0], self._len * 2), dtype="float64"
+                    )
+                    grown[:, : self._len] = self._data
+                    self._data = grown
+                self._data[:, self._len] = row
+                self._len += 1
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, i):
+        with self._lock:
+            if i < 0:
+                i += self._len
+            if not 0 <= i < self._len:
+                raise IndexError("PoseHistory index out of range")
+            x, y, theta, _ = self._data[:, self._start + i]
+        return Pose2D(float(x), float(y), float(theta))
+
+    @property
+    def curr_pose(self):
+        return self[-1]
+
+    def as_arrays(self):
+        """
+        Return a dict of x, y, theta and t arrays covering the
+        retained history, oldest first. These are read-only views into the
+        underlying storage, so copy them if they need to outlive the next
+        append, or if another thread may be appending.
+        """
+        with self._lock:
+            view = self._data[:, self._start : self._start + self._len]
+        view.flags.writeable = False
+        return dict(zip(self._FIELDS, view))
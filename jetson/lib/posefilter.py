@@ -0,0 +1,137 @@
+"""
+Extended Kalman filter fusing wheel odometry with tag-based pose fixes,
+for slam.py.
+
+The state is the vehicle-to-world pose (x, y, theta) in the same
+convention as posegraph: the calibration vehicle frame, x to the right
+and y forward. Odometry from Vehicle.pose_hist predicts the pose forward
+between frames, and the transform LandmarkMap estimates from visible
+tags corrects it. When no known tags are in view the prediction alone
+carries the estimate, with its uncertainty growing until tags are seen
+again.
+
+Basic use:
+
+pf = PoseFilter()
+pf.predict(posegraph.vehicle_delta(relative_pose(prev, veh.curr_pose)))
+update = lmap.observe(tag2points, prior=pf.transform())
+if update.inliers:
+    pf.correct(slam.transform_pose(update.transform), update.rms_error)
+"""
+
+import logging
+import math
+import numpy as np
+from landmarks import rigid_transform
+from pose import Pose2D, reduce_angle
+
+_logger = logging.getLogger(__name__)
+
+
+def relative_pose(start, end):
+    """
+    Return the Pose2D of `end` in the frame of `start`, i.e. the pose d
+    such that start + d == end.
+    """
+    dx, dy = end.x - start.x, end.y - start.y
+    c, s = math.cos(start.theta), math.sin(start.theta)
+    return Pose2D(
+        c * dx + s * dy, -s * dx + c * dy, reduce_angle(end.theta - start.theta)
+    )
+
+
+class PoseFilter(object):
+    """
+    - initial_sigma: (x, y, theta) standard deviations of the initial pose.
+      The first tag frame defines the world frame, so this is small.
+    - dist_noise: odometry translation error per unit of distance
+      traveled.
+    - turn_noise: odometry heading error per radian turned.
+    - drift_noise: odometry heading error per unit of distance traveled.
+    - heading_lever: typical distance from the vehicle to the tags it
+      fixes its pose from, used to turn a positional error into a heading
+      error for corrections.
+    """
+
+    def __init__(
+        self,
+        initial_sigma=(0.1, 0.1, 0.01),
+        dist_noise=0.05,
+        turn_noise=0.1,
+        drift_noise=0.01,
+        heading_lever=20.0,
+    ):
+        self.dist_noise = dist_noise
+        self.turn_noise = turn_noise
+        self.drift_noise = drift_noise
+        self.heading_lever = heading_lever
+        self.reset(np.zeros(3), initial_sigma)
+
+    def reset(self, pose, sigma):
+        self.mean = np.array(pose, dtype="float64")
+        self.cov = np.diag(np.square(np.asarray(sigma, dtype="float64")))
+
+    @property
+    def sigma(self):
+        """
+        Standard deviations of x, y and theta.
+        """
+        return np.sqrt(np.diag(self.cov))
+
+    def transform(self):
+        """
+        The current estimate as a 3x3 vehicle-to-world transform, e.g. for
+        the `prior` argument of LandmarkMap.observe.
+        """
+        x, y, theta = self.mean
+        return rigid_transform(theta, x, y)
+
+    def predict(self, delta):
+        """
+        Move the estimate by an odometry `delta` = (x, y, theta) in the
+        vehicle frame, e.g. from posegraph.vehicle_delta.
+        """
+        dx, dy, dtheta = delta
+        x, y, theta = self.mean
+        c, s = math.cos(theta), math.sin(theta)
+
+        self.mean = np.array(
+            [
+                x + c * dx - s * dy,
+                y + s * dx + c * dy,
+                reduce_angle(theta + dtheta),
+            ]
+        )
+
+        dist = math.hypot(dx, dy)
+        q = np.diag(
+            [
+                (self.dist_noise * dist) ** 2,
+                (self.dist_noise * dist) ** 2,
+                (self.turn_noise * abs(dtheta) + self.drift_noise * dist) ** 2,
+            ]
+        )
+        F = np.array(
+            [[1.0, 0.0, -s * dx - c * dy], [0.0, 1.0, c * dx - s * dy], [0.0, 0.0, 1.0]]
+        )
+        G = np.array([[c, -s, 0.0], [s, c, 0.0], [0.0, 0.0, 1.0]])
+        self.cov = F @ self.cov @ F.T + G @ q @ G.T
+
+    def correct(self, measured, rms_error=None, min_sigma=0.5):
+        """
+        Fold in a direct measurement of the pose, (x, y, theta), such as the
+        transform estimated from tags. `rms_error` is the residual of that
+        estimate; its uncertainty is taken to be at least `min_sigma`.
+        Returns the innovation.
+        """
+        sigma = max(rms_error or 0.0, min_sigma)
+        R = np.diag([sigma ** 2, sigma ** 2, (sigma / self.heading_lever) ** 2])
+
+        innovation = np.asarray(measured, dtype="float64") - self.mean
+        innovation[2] = reduce_angle(innovation[2])
+        gain = self.cov @ np.linalg.inv(self.cov + R)
+        self.mean = self.mean + gain @ innovation
+        self.mean[2] = reduce_angle(self.mean[2])
+        self.cov = (np.eye(3) - gain) @ self.cov
+        _logger.debug(f"PoseFilter innovation {innovation}, sigma {self.sigma}")
+        return innovation
@@ -0,0 +1,399 @@
+"""
+Sparse pose-graph optimization for tag-based SLAM.
+
+Nodes are vehicle poses and landmark points (the floor points of tags,
+see slam.py). Edges are odometry constraints between poses and
+observations of landmark points from poses. The whole graph is solved
+with Levenberg-Marquardt on a scipy.sparse system, so errors that build
+up along a chain of poses get corrected when a landmark is seen again.
+
+Poses are (x, y, theta) vehicle-to-world transforms in the vehicle frame
+used by calibration.py: x to the right, y forward. Use vehicle_delta to
+convert Pose2D odometry, which has x forward and y to the left.
+
+Run this module to benchmark the solver on synthetic graphs:
+
+python3 posegraph.py --poses 5000
+"""
+
+import argparse
+import logging
+import math
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+import time
+
+_logger = logging.getLogger(__name__)
+
+
+def wrap_angles(theta):
+    return np.mod(theta + np.pi, 2 * np.pi) - np.pi
+
+
+def vehicle_delta(pose2d):
+    """
+    Convert a relative Pose2D (x forward, y to the left) into the
+    (x, y, theta) convention of the calibration vehicle frame.
+    """
+    return np.array([-pose2d.y, pose2d.x, pose2d.theta])
+
+
+def _rot_t(theta):
+    """
+    Stack of transposed rotation matrices for an array of angles.
+    """
+    c, s = np.cos(theta), np.sin(theta)
+    return np.stack([np.stack([c, s], -1), np.stack([-s, c], -1)], -2)
+
+
+def _drot_t(theta):
+    """
+    Derivatives of _rot_t with respect to theta.
+    """
+    c, s = np.cos(theta), np.sin(theta)
+    return np.stack([np.stack([-s, c], -1), np.stack([-c, -s], -1)], -2)
+
+
+def _block(row0, col0, blocks):
+    """
+    COO triplets for placing an (n, a, b) stack of blocks with top-left
+    corners at (row0[k], col0[k]).
+    """
+    n, a, b = blocks.shape
+    rows = row0[:, None, None] + np.arange(a)[None, :, None]
+    cols = col0[:, None, None] + np.arange(b)[None, None, :]
+    rows, cols = np.broadcast_arrays(rows, cols)
+    return rows.ravel(), cols.ravel(), blocks.ravel()
+
+
+class PoseGraph(object):
+    """
+    - odometry_sigma: default (x, y, theta) standard deviations of an
+      odometry edge.
+    - observation_sigma: default standard deviation of an observed
+      landmark point, in the same units as the poses.
+    - loop_closure_gap: an observation of a landmark last seen at least
+      this many poses earlier marks the graph as needing optimization.
+    """
+
+    def __init__(
+        self,
+        odometry_sigma=(0.5, 0.5, 0.05),
+        observation_sigma=0.5,
+        loop_closure_gap=10,
+    ):
+        self.odometry_sigma = np.asarray(odometry_sigma, dtype="float64")
+        self.observation_sigma = observation_sigma
+        self.loop_closure_gap = loop_closure_gap
+
+        # Storage grows by doubling; poses and landmark_points are views.
+        self._poses = np.zeros((64, 3))
+        self._points = np.zeros((64, 2))
+        self.num_poses = 0
+        self.num_points = 0
+        self.landmark_index = {}  # key -> row in landmark_points
+        self.last_seen = {}  # key -> last pose to observe it
+
+        self.odometry = []  # (i, j, delta, sigma)
+        self.observations = []  # (pose, landmark row, point, sigma)
+        self.needs_optimization = False
+
+    @property
+    def poses(self):
+        return self._poses[: self.num_poses]
+
+    @poses.setter
+    def poses(self, value):
+        self._poses[: self.num_poses] = value
+
+    @property
+    def landmark_points(self):
+        return self._points[: self.num_points]
+
+    @landmark_points.setter
+    def landmark_points(self, value):
+        self._points[: self.num_points] = value
+
+    @staticmethod
+    def _append(storage, count, row):
+        if count == len(storage):
+            storage = np.concatenate([storage, np.zeros_like(storage)])
+        storage[count] = row
+        return storage
+
+    def add_pose(self, initial):
+        """
+        Add a pose node with an initial estimate, returning its index.
+        The first pose is held fixed to anchor the graph.
+        """
+        self._poses = self._append(self._poses, self.num_poses, initial)
+        self.num_poses += 1
+        return self.num_poses - 1
+
+    def add_odometry(self, i, j, delta, sigma=None):
+        """
+        Constrain pose j to be at `delta` = (x, y, theta) relative to pose i.
+        """
+        sigma = self.odometry_sigma if sigma is None else np.asarray(sigma)
+        self.odometry.append((i, j, np.asarray(delta, dtype="float64"), sigma))
+
+    def add_observation(self, pose, key, point, sigma=None):
+        """
+        Record that `pose` observed landmark `key` at `point`, in vehicle
+        coordinates. New landmarks are initialized from the pose's current
+        estimate. Returns True if this closes a loop.
+        """
+        point = np.asarray(point, dtype="float64")
+        if key not in self.landmark_index:
+            x, y, theta = self.poses[pose]
+            c, s = math.cos(theta), math.sin(theta)
+            world = (x + c * point[0] - s * point[1], y + s * point[0] + c * point[1])
+            self.landmark_index[key] = self.num_points
+            self._points = self._append(self._points, self.num_points, world)
+            self.num_points += 1
+
+        loop_closed = (
+            key in self.last_seen
+            and pose - self.last_seen[key] >= self.loop_closure_gap
+        )
+        if loop_closed:
+            self.needs_optimization = True
+        self.last_seen[key] = max(pose, self.last_seen.get(key, pose))
+
+        sigma = self.observation_sigma if sigma is None else sigma
+        self.observations.append((pose, self.landmark_index[key], point, sigma))
+        return loop_closed
+
+    def landmark(self, key):
+        return self.landmark_points[self.landmark_index[key]]
+
+    def _edge_arrays(self):
+        odo = self.odometry
+        obs = self.observations
+        return dict(
+            odo_i=np.array([e[0] for e in odo], dtype="int64"),
+            odo_j=np.array([e[1] for e in odo], dtype="int64"),
+            odo_z=np.array([e[2] for e in odo], dtype="float64").reshape(-1, 3),
+            odo_w=1.0 / np.array([e[3] for e in odo], dtype="float64").reshape(-1, 3),
+            obs_p=np.array([e[0] for e in obs], dtype="int64"),
+            obs_l=np.array([e[1] for e in obs], dtype="int64"),
+            obs_z=np.array([e[2] for e in obs], dtype="float64").reshape(-1, 2),
+            obs_w=1.0 / np.array([e[3] for e in obs], dtype="float64"),
+        )
+
+    def _residuals(self, poses, points, edges):
+        """
+        Whitened residuals: odometry, then observations.
+        """
+        e = edges
+        pi, pj = poses[e["odo_i"]], poses[e["odo_j"]]
+        rt = _rot_t(pi[:, 2])
+        odo_t = np.einsum("nab,nb->na", rt, pj[:, :2] - pi[:, :2]) - e["odo_z"][:, :2]
+        odo_theta = wrap_angles(pj[:, 2] - pi[:, 2] - e["odo_z"][:, 2])
+        odo = np.column_stack([odo_t, odo_theta]) * e["odo_w"]
+
+        pp = poses[e["obs_p"]]
+        obs = (
+            np.einsum("nab,nb->na", _rot_t(pp[:, 2]), points[e["obs_l"]] - pp[:, :2])
+            - e["obs_z"]
+        ) * e["obs_w"][:, None]
+        return np.concatenate([odo.ravel(), obs.ravel()])
+
+    def _jacobian(self, poses, points, edges):
+        e = edges
+        n_poses = len(poses)
+        n_odo = len(e["odo_i"])
+        n_obs = len(e["obs_p"])
+        triplets = []
+
+        # Odometry rows: 3 per edge
+        if n_odo:
+            row = 3 * np.arange(n_odo)
+            pi, pj = poses[e["odo_i"]], poses[e["odo_j"]]
+            rt = _rot_t(pi[:, 2])
+            drt = np.einsum("nab,nb->na", _drot_t(pi[:, 2]), pj[:, :2] - pi[:, :2])
+            w = e["odo_w"]
+            ci, cj = 3 * e["odo_i"], 3 * e["odo_j"]
+            triplets += [
+                _block(row, ci, -rt * w[:, :2, None]),
+                _block(row, ci + 2, (drt * w[:, :2])[:, :, None]),
+                _block(row, cj, rt * w[:, :2, None]),
+                (row + 2, ci + 2, -w[:, 2]),
+                (row + 2, cj + 2, w[:, 2]),
+            ]
+
+        # Observation rows: 2 per edge
+        if n_obs:
+            row = 3 * n_odo + 2 * np.arange(n_obs)
+            pp = poses[e["obs_p"]]
+            rt = _rot_t(pp[:, 2]) * e["obs_w"][:, None, None]
+            drt = (
+                np.einsum(
+                    "nab,nb->na", _drot_t(pp[:, 2]), points[e["obs_l"]] - pp[:, :2]
+                )
+                * e["obs_w"][:, None]
+            )
+            cp = 3 * e["obs_p"]
+            cl = 3 * n_poses + 2 * e["obs_l"]
+            triplets += [
+                _block(row, cp, -rt),
+                _block(row, cp + 2, drt[:, :, None]),
+                _block(row, cl, rt),
+            ]
+
+        rows, cols, vals = (np.concatenate(parts) for parts in zip(*triplets))
+        shape = (3 * n_odo + 2 * n_obs, 3 * n_poses + 2 * len(points))
+        J = scipy.sparse.csc_matrix((vals, (rows, cols)), shape=shape)
+        # The first pose anchors the graph, so it isn't a variable.
+        return J[:, 3:]
+
+    def optimize(self, max_iterations=20, tolerance=1e-6, damping=1e-3):
+        """
+        Levenberg-Marquardt, starting from the current estimates. Returns a
+        dict summarizing the run. Costs are half the sum of squared
+        whitened residuals.
+        """
+        start = time.perf_counter()
+        edges = self._edge_arrays()
+
+        n_pose_vars = 3 * len(self.poses)
+        poses, points = self.poses.copy(), self.landmark_points.copy()
+        r = self._residuals(poses, points, edges)
+        cost = initial_cost = 0.5 * r @ r
+
+        iterations = 0
+        for iterations in range(1, max_iterations + 1):
+            J = self._jacobian(poses, points, edges)
+            JtJ = (J.T @ J).tocsc()
+            g = J.T @ r
+            diag = JtJ.diagonal()
+
+            while True:
+                A = JtJ + scipy.sparse.diags(damping * np.maximum(diag, 1e-9))
+                # A is symmetric, so order it as such; the default COLAMD
+                # ordering produces several times more fill-in here.
+                lu = scipy.sparse.linalg.splu(A.tocsc(), permc_spec="MMD_AT_PLUS_A")
+                step = lu.solve(-g)
+                step = np.concatenate([np.zeros(3), step])
+                new_poses = poses + step[:n_pose_vars].reshape(-1, 3)
+                new_poses[:, 2] = wrap_angles(new_poses[:, 2])
+                new_points = points + step[n_pose_vars:].reshape(-1, 2)
+                new_r = self._residuals(new_poses, new_points, edges)
+                new_cost = 0.5 * new_r @ new_r
+                if new_cost <= cost:
+                    damping = max(damping / 10, 1e-9)
+                    break
+                damping *= 10
+                if damping > 1e9:
+                    break
+
+            if new_cost > cost:
+                break
+            improvement = cost - new_cost
+            poses, points, r, cost = new_poses, new_points, new_r, new_cost
+            if improvement <= tolerance * max(initial_cost, 1e-12):
+                break
+
+        self.poses, self.landmark_points = poses, points
+        self.needs_optimization = False
+        return dict(
+            iterations=iterations,
+            initial_cost=initial_cost,
+            final_cost=cost,
+            secs=time.perf_counter() - start,
+        )
+
+    def optimize_if_needed(self, **kwargs):
+        """
+        Optimize only if a loop has been closed since the last optimization.
+        Returns the summary from optimize, or None.
+        """
+        if self.needs_optimization:
+            return self.optimize(**kwargs)
+        return None
+
+
+def synthetic_graph(num_poses, num_landmarks, seed=0, view_range=30.0):
+    """
+    Build a graph for a vehicle driving laps of a circle through a ring of
+    landmarks, with noisy odometry and observations. Returns the graph and
+    the true poses and landmark points.
+    """
+    rng = np.random.default_rng(seed)
+    laps = 3
+    radius = 100.0
+    angles = np.linspace(0, laps * 2 * np.pi, num_poses)
+    true_poses = np.column_stack(
+        [radius * np.cos(angles), radius * np.sin(angles), wrap_angles(angles + np.pi)]
+    )
+    lm_angles = rng.uniform(0, 2 * np.pi, num_landmarks)
+    lm_radius = radius + rng.uniform(-15, 15, num_landmarks)
+    true_points = np.column_stack(
+        [lm_radius * np.cos(lm_angles), lm_radius * np.sin(lm_angles)]
+    )
+
+    graph = PoseGraph(odometry_sigma=(0.05, 0.05, 0.005), observation_sigma=0.5)
+    graph.add_pose(true_poses[0])
+    for j in range(1, num_poses):
+        prev, curr = true_poses[j - 1], true_poses[j]
+        delta = np.concatenate(
+            [_rot_t(prev[2]) @ (curr[:2] - prev[:2]), [wrap_angles(curr[2] - prev[2])]]
+        )
+        delta += rng.normal(0, graph.odometry_sigma)
+        # Initialize by chaining the noisy odometry.
+        p = graph.poses[j - 1]
+        c, s = math.cos(p[2]), math.sin(p[2])
+        graph.add_pose(
+            [
+                p[0] + c * delta[0] - s * delta[1],
+                p[1] + s * delta[0] + c * delta[1],
+                p[2] + delta[2],
+            ]
+        )
+        graph.add_odometry(j - 1, j, delta)
+
+        dists = np.linalg.norm(true_points - curr[:2], axis=1)
+        for k in np.flatnonzero(dists < view_range):
+            point = _rot_t(curr[2]) @ (true_points[k] - curr[:2])
+            graph.add_observation(
+                j, k, point + rng.normal(0, graph.observation_sigma, 2)
+            )
+
+    return graph, true_poses, true_points
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--poses", type=int, default=2000)
+    parser.add_argument("--landmarks", type=int, default=200)
+    args = parser.parse_args()
+
+    graph, true_poses, _ = synthetic_graph(args.poses, args.landmarks)
+
+    def position_error():
+        return np.sqrt(
+            np.mean(np.sum((graph.poses[:, :2] - true_poses[:, :2]) ** 2, axis=1))
+        )
+
+    print(
+        f"{len(graph.poses)} poses, {len(graph.landmark_points)} landmarks, "
+        f"{len(graph.odometry)} odometry edges, {len(graph.observations)} observations"
+    )
+    print(f"RMS position error before: {position_error():.3f}")
+    result = graph.optimize()
+    print(f"RMS position error after: {position_error():.3f}")
+    print(
+        f"{result['iterations']} iterations in {result['secs']:.3f} sec, "
+        f"cost {result['initial_cost']:.1f} -> {result['final_cost']:.1f}"
+    )
+
+    # Re-optimizing from a converged state, as after a loop closure, is cheaper.
+    result = graph.optimize()
+    print(
+        f"Warm re-optimization: {result['iterations']} iterations in {result['secs']:.3f} sec"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,3 @@
-import random
 import os
 import functools
 import sys
@@ -7,15 +6,25 @@ import tensorflow as tf
 import PIL
 import numpy as np
 
-def partition(sliceable, fraction):
+import sharedpool
+
+def _rng(rng):
+    """ The given numpy Generator, or a freshly seeded one. """
+    return rng if rng is not None else np.random.default_rng()
+
+def partition(sliceable, fraction, rng=None):
+    """ Split into two at fraction, shuffling first if given a numpy Generator. """
+    if rng is not None:
+        sliceable = [sliceable[i] for i in rng.permutation(len(sliceable))]
     split_point = int(len(sliceable) * fraction)
     left, right = sliceable[:split_point], sliceable[split_point:]
     assert left and right, "Fraction too extreme for a dataset this small."
     return left, right
 
-def random_flip(arr, horizontal=True, vertical=True, arr2=None):
-    h = horizontal & random.randint(0,1)
-    v = vertical & random.randint(0,1)
+def random_flip(arr, horizontal=True, vertical=True, arr2=None, rng=None):
+    rng = _rng(rng)
+    h = horizontal and rng.integers(2)
+    v = vertical and rng.integers(2)
     def flip(a):
         if h:
             a = np.flip(a, axis=1)
@@ -28,19 +37,86 @@ def random_flip(arr, horizontal=True, vertical=True, arr2=None):
         return (a1,a2)
     return a1
 
-def random_rotation(arr, max_degree):
-    degree = random.uniform(-max_degree, max_degree)
+def random_rotation(arr, max_degree, rng=None):
+    degree = _rng(rng).uniform(-max_degree, max_degree)
     im = PIL.Image.fromarray(arr)
     im = im.rotate(degree)
     return np.array(im)
 
-def random_brightness(arr, brightness_offset):
-    factor = 1 + random.uniform(-brightness_offset, brightness_offset)
+def random_brightness(arr, brightness_offset, rng=None):
+    factor = 1 + _rng(rng).uniform(-brightness_offset, brightness_offset)
     im = PIL.Image.fromarray(arr)
     enhancer = PIL.ImageEnhance.Brightness(im)
     im = enhancer.enhance(factor)
     return np.array(im)
 
+def _per_sample(mask, batch):
+    """ Reshape a (N,) mask to broadcast against a (N, ...) batch. """
+    return mask.reshape((-1,) + (1,) * (batch.ndim - 1))
+
+def flip_batch(batch, rng, horizontal=True, vertical=True, labels=None):
+    """
+    Flip each of a (N, H, W, ...) batch independently at random, and the
+    (N, H, W, ...) labels the same way if given, returning both.
+    """
+    batch = np.asarray(batch)
+    arrays = [batch] if labels is None else [batch, np.asarray(labels)]
+    for axis, enabled in ((2, horizontal), (1, vertical)):
+        if enabled:
+            flips = rng.integers(0, 2, len(batch)).astype(bool)
+            arrays = [np.where(_per_sample(flips, a), np.flip(a, axis=axis), a) for a in arrays]
+    return arrays[0] if labels is None else tuple(arrays)
+
+def rotation_margin(patch_side, max_degree):
+    """ Pixels needed around a patch so it can be rotated by up to max_degree without running off its edges. """
+    r = np.radians(min(abs(max_degree), 45))
+    return int(np.ceil(patch_side / 2 * (np.cos(r) + np.sin(r) - 1))) + 1 if max_degree else 0
+
+def rotate_batch(batch, max_degree, rng, out_side=None):
+    """
+    Rotate each of a (N, S, S, C) batch by its own random angle about its
+    center, with bilinear interpolation, and return the float32 center
+    out_side x out_side crops. Give the batch a rotation_margin around
+    out_side to avoid smearing the edges, which are otherwise clamped.
+    """
+    n, side = batch.shape[:2]
+    out_side = out_side or side
+    angles = np.radians(rng.uniform(-max_degree, max_degree, n)).astype("float32")
+    cos, sin = np.cos(angles)[:,None,None], np.sin(angles)[:,None,None]
+    center = (side - 1) / 2
+    yy, xx = np.mgrid[0:out_side, 0:out_side].astype("float32") - (out_side - 1) / 2
+    src_x = np.clip(cos * xx - sin * yy + center, 0, side - 1)
+    src_y = np.clip(sin * xx + cos * yy + center, 0, side - 1)
+    x0 = np.minimum(src_x.astype("intp"), side - 2)
+    y0 = np.minimum(src_y.astype("intp"), side - 2)
+    fx = (src_x - x0).astype("float32")[...,None]
+    fy = (src_y - y0).astype("float32")[...,None]
+    # Gather the four neighbors from the flattened batch, which is much
+    # faster than indexing with three index arrays.
+    flat = batch.reshape(n * side * side, -1)
+    i00 = (np.arange(n)[:,None,None] * side + y0) * side + x0
+    def at(offset):
+        return np.take(flat, i00 + offset, axis=0).astype("float32")
+    top = at(0) * (1 - fx) + at(1) * fx
+    bottom = at(side) * (1 - fx) + at(side + 1) * fx
+    return top * (1 - fy) + bottom * fy
+
+def brightness_batch(batch, brightness_offset, rng, max_value=255):
+    """ Scale each of a batch by its own factor in 1 +/- brightness_offset, like random_brightness. """
+    factors = 1 + rng.uniform(-brightness_offset, brightness_offset, len(batch))
+    out = np.multiply(batch, _per_sample(factors, np.asarray(batch)), dtype="float32")
+    return np.minimum(out, max_value, out=out)
+
+def augment_segmentation_batch(x, y, rng, brightness=0.5, h_flip=True):
+    """
+    Vectorized generate_segmentation_data augmentation of a uint8
+    (N, H, W, C) image batch x and its (N, H, W) labels y. Returns x as
+    float32 in [0, 1], and y.
+    """
+    x, y = flip_batch(x, rng, horizontal=h_flip, vertical=False, labels=y)
+    x = np.floor(brightness_batch(x, brightness, rng))
+    return np.true_divide(x, 255, dtype="float32"), y
+
 def thumbnail(arr, dest_width, dest_height):
     im = PIL.Image.fromarray(arr)
     im.thumbnail((dest_width, dest_height))
@@ -71,7 +147,14 @@ def load_img(fn):
         assert len(arr.shape) == 3, "No color for %s, shape is %s" % (fn, arr.shape)
         return arr
         
-def list_images(dir):
+def list_images(dir, use_index=False):
+    """ With use_index, list them from a dataindex.DatasetIndex, refreshed first. """
+    if use_index:
+        from .dataindex import DatasetIndex
+        index = DatasetIndex(dir, kind="image")
+        index.refresh()
+        return index.paths()
+
     suff = set(["jpeg", "jpg", "png", "tiff"])
     def is_image(fn):
         return True in [fn.lower().endswith(s) for s in suff]
@@ -105,6 +188,16 @@ def iterate_over(sequence, iterations=float("inf")):
     else:
         return chain.from_iterable(repeat(sequence, iterations))
 
+def _augmented_patches(fn, rng, patch_side, res_width, res_height, rotate, brightness, stride):
+    arr = load_img(fn)
+    arr = random_rotation(arr, rotate, rng)
+    arr = random_brightness(arr, brightness, rng)
+    arr = thumbnail(arr, res_width, res_height)
+    # arr = ycbcr(arr)
+    arr = np.true_divide(arr, 255, dtype="float32")
+    patches = [patch for patch, ix in extract_patches(arr, patch_side, stride=stride)]
+    return (np.stack(patches) if patches else np.zeros((0, patch_side, patch_side, 3), dtype="float32"),)
+
 def generate_patches(
         image_files,
         patch_side=16,
@@ -113,30 +206,65 @@ def generate_patches(
         rotate=5,
         brightness=0.5,
         stride=8,
-        iterations=float("inf")
+        iterations=float("inf"),
+        cache_dir=None,
+        shuffle=True,
+        workers=0,
+        ordered=True,
+        seed=None
     ):
+    """
+    Patches from image_files, as float32 arrays in [0, 1].
+
+    With cache_dir, each image is decoded, resized and cut into patches
+    only once, into a memory-mapped shard under cache_dir (see
+    patchcache.PatchCache), and rotation and brightness are applied to
+    whole batches of patches as they're read. Patches then come out
+    shuffled across a few images at a time, rather than image by image.
+
+    Otherwise, with workers, images are loaded and augmented by that many
+    processes (see sharedpool.SharedPool); ordered and seed are passed on.
+    Each image is augmented with sharedpool.task_rng(seed, its position in
+    the stream) either way, so a seed gives the same patches, in order,
+    however many workers there are.
+    """
 
     if stride is None:
         stride = patch_side
 
+    if cache_dir is not None:
+        from .patchcache import PatchCache
+        cache = PatchCache(image_files, cache_dir, patch_side, res_width, res_height, stride, rotate=rotate)
+        print("Generating a data set of %d cached patches per iteration." % len(cache))
+        batches = cache.batches(rotate=rotate, brightness=brightness, iterations=iterations, shuffle=shuffle)
+        return (patch for b in batches for patch in b), len(cache)
+
     N_estimated = len(image_files) * (res_height//stride) * (res_width//stride)
     print("Generating a data set of approximately %d patches per iteration." % N_estimated)
 
     # TODO noise    
-    
+
+    task = functools.partial(
+        _augmented_patches,
+        patch_side=patch_side, res_width=res_width, res_height=res_height,
+        rotate=rotate, brightness=brightness, stride=stride
+    )
+    files = iterate_over(image_files, iterations=iterations)
+
     def gen():
-        for fn in iterate_over(files, iterations=iterations):
-            arr = load_img(fn)
-            arr = random_rotation(arr, rotate)
-            arr = random_brightness(arr, brightness)
-            arr = thumbnail(arr, res_width, res_height)
-            # arr = ycbcr(arr)
-            # PIL.Image.fromarray(arr).save("transformed_%04d.png" % next(c))
-            arr = np.true_divide(arr, 255, dtype="float32")
-            for patch, ix in extract_patches(arr, patch_side, stride=stride):
-                yield patch
-
-    return gen(), N_estimated
+        for index, fn in enumerate(files):
+            patches, = task(fn, sharedpool.task_rng(seed, index))
+            yield from patches
+
+    def gen_parallel():
+        # Thumbnails fit in res_width x res_height, so this is the most patches an image gives.
+        max_patches = (res_height//stride + 1) * (res_width//stride + 1)
+        slot_bytes = max_patches * patch_side * patch_side * 3 * 4
+        with sharedpool.SharedPool(task, slot_bytes, num_workers=int(workers), seed=seed) as pool:
+            for patches, in pool.imap(files, ordered=ordered):
+                yield from patches
+
+    return (gen_parallel() if workers else gen()), N_estimated
  
 def pair_for_autoencoder(g):
     for x in g:
@@ -167,14 +295,45 @@ def open_labelme_segmentation(item):
         y = np.array(im)
     return (x,y)
 
-def generate_segmentation_data(items, brightness=0.5, h_flip=True, iterations=float("inf"), opener=open_labelme_segmentation):
-    for item in iterate_over(items, iterations=iterations):
-        x, y = opener(item)
-        x, y = random_flip(x, arr2=y, horizontal=h_flip, vertical=False)
-        x = random_brightness(x, brightness_offset=brightness)
-        x = np.true_divide(x, 255, dtype="float32")
-        yield x, y
+def _augmented_segmentation(item, rng, brightness, h_flip, opener):
+    x, y = opener(item)
+    x, y = random_flip(x, arr2=y, horizontal=h_flip, vertical=False, rng=rng)
+    x = random_brightness(x, brightness_offset=brightness, rng=rng)
+    x = np.true_divide(x, 255, dtype="float32")
+    return x, y
+
+def generate_segmentation_data(items, brightness=0.5, h_flip=True, iterations=float("inf"), opener=open_labelme_segmentation,
+                               workers=0, ordered=True, seed=None):
+    """
+    With workers, items are loaded and augmented by that many processes
+    (see sharedpool.SharedPool), which needs a picklable opener unless
+    processes are forked. The items are all expected to be the size of
+    the first. As with generate_patches, a seed gives the same data
+    however many workers there are.
+    """
+    task = functools.partial(_augmented_segmentation, brightness=brightness, h_flip=h_flip, opener=opener)
+    items_iter = iterate_over(items, iterations=iterations)
+    if not workers:
+        for index, item in enumerate(items_iter):
+            yield task(item, sharedpool.task_rng(seed, index))
+        return
+
+    x, y = task(items[0], sharedpool.task_rng(seed, 0))
+    with sharedpool.SharedPool(task, x.nbytes + y.nbytes, num_workers=int(workers), seed=seed) as pool:
+        for x, y in pool.imap(items_iter, ordered=ordered):
+            yield x, y
         
+def generate_segmentation_batches(items, batch_size=4, brightness=0.5, h_flip=True, iterations=float("inf"),
+                                  opener=open_labelme_segmentation, seed=None):
+    """
+    Batches of generate_segmentation_data's samples, augmented a batch at
+    a time with augment_segmentation_batch from a Generator seeded with seed.
+    """
+    rng = np.random.default_rng(seed)
+    opened = (opener(item) for item in iterate_over(items, iterations=iterations))
+    for x, y in batch(opened, batch_size=batch_size):
+        yield augment_segmentation_batch(x, y, rng, brightness=brightness, h_flip=h_flip)
+
 if __name__ == "__main__":
     parent_dir, = sys.argv[1:]
     files = os.listdir(parent_dir)
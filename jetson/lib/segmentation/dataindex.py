@@ -0,0 +1,234 @@
+"""
+Persistent index of a training data directory.
+
+Listing a directory of tens of thousands of labelme items, and opening
+one to learn the input shape, is slow enough to notice on every run.
+DatasetIndex keeps what the trainers need in a SQLite file next to the
+directory: each item's path, modification time, image shape and, for
+labelme items, a histogram of its label classes.
+
+refresh() brings the index up to date, reading only items that are new
+or whose files changed. By default it first compares the directory's
+own modification time with the last refresh and skips the scan when
+nothing was added or removed; pass check_files=True to also notice items
+edited in place.
+
+index = DatasetIndex(parent_dir)
+index.refresh()
+input_shape = index.input_shape()
+train_items, val_items = index.split(0.8, seed=0)
+
+Also runnable to build or refresh an index and print a summary:
+
+python3 -m segmentation.dataindex refresh <dir> [labelme|image]
+"""
+
+import os
+import sqlite3
+import sys
+
+import numpy as np
+import PIL.Image
+
+IMAGE_SUFFIXES = ("jpeg", "jpg", "png", "tiff")
+KINDS = ("labelme", "image")
+# Bump when the meaning of a column changes, to rebuild existing indexes.
+SCHEMA_VERSION = "2"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    name TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    height INTEGER NOT NULL,
+    width INTEGER NOT NULL,
+    channels INTEGER NOT NULL,
+    histogram BLOB
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def default_index_path(root):
+    # Beside the directory rather than in it, so it isn't taken for an item.
+    return os.path.normpath(os.path.abspath(root)) + ".index.sqlite"
+
+
+def _image_header(path, kind):
+    """
+    (height, width, channels) of the array the item's opener returns,
+    without decoding the pixels. load_img converts images to RGB, while
+    open_labelme_segmentation takes them as they are, so single-band
+    images have no channel axis; channels is 0 for those.
+    """
+    with PIL.Image.open(path) as im:
+        width, height = im.size
+        if kind == "image":
+            return height, width, 3
+        bands = len(im.getbands())
+        return height, width, bands if bands > 1 else 0
+
+
+def _label_histogram(path):
+    with PIL.Image.open(path) as im:
+        return np.bincount(np.asarray(im).ravel()).astype("int64")
+
+
+class DatasetIndex(object):
+    """
+    - root: the directory, of labelme items (directories holding img.png
+      and label.png, see datagen.open_labelme_segmentation) or of images.
+    - kind: "labelme" or "image".
+    - index_path: the SQLite file, by default beside root.
+    """
+
+    def __init__(self, root, kind="labelme", index_path=None):
+        assert kind in KINDS, "kind must be one of %s" % (KINDS,)
+        self.root = root
+        self.kind = kind
+        self.db = sqlite3.connect(index_path or default_index_path(root))
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def _meta(self, key, default=None):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def _files(self, name):
+        path = os.path.join(self.root, name)
+        if self.kind == "labelme":
+            return os.path.join(path, "img.png"), os.path.join(path, "label.png")
+        return path, None
+
+    def _scan(self):
+        """ name -> mtime for everything in root that looks like an item. """
+        found = {}
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if self.kind == "labelme":
+                    if not entry.is_dir():
+                        continue
+                    try:
+                        found[entry.name] = max(os.stat(f).st_mtime for f in self._files(entry.name))
+                    except FileNotFoundError:
+                        continue
+                elif entry.is_file() and entry.name.lower().endswith(IMAGE_SUFFIXES):
+                    found[entry.name] = entry.stat().st_mtime
+        return found
+
+    def refresh(self, check_files=False):
+        """
+        Update the index with the directory's contents. Returns the number
+        of items added, updated or removed.
+        """
+        root_mtime = repr(os.stat(self.root).st_mtime)
+        current = (self._meta("root_mtime"), self._meta("kind"), self._meta("schema"))
+        if not check_files and current == (root_mtime, self.kind, SCHEMA_VERSION):
+            return 0
+
+        found = self._scan()
+        known = {}
+        if current[1:] == (self.kind, SCHEMA_VERSION):
+            known = dict(self.db.execute("SELECT name, mtime FROM items"))
+        removed = [(name,) for name in known if name not in found]
+        changed = [name for name, mtime in found.items() if known.get(name) != mtime]
+
+        rows = []
+        for name in changed:
+            img, label = self._files(name)
+            histogram = _label_histogram(label).tobytes() if label else None
+            rows.append((name, found[name]) + _image_header(img, self.kind) + (histogram,))
+
+        with self.db:
+            if not known:
+                self.db.execute("DELETE FROM items")
+            self.db.executemany("DELETE FROM items WHERE name = ?", removed)
+            self.db.executemany("INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.db.executemany(
+                "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                [("root_mtime", root_mtime), ("kind", self.kind), ("schema", SCHEMA_VERSION)],
+            )
+        return len(removed) + len(rows)
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+
+    def paths(self):
+        """ Full paths of the items, sorted by name. """
+        names = self.db.execute("SELECT name FROM items ORDER BY name")
+        return [os.path.join(self.root, name) for name, in names]
+
+    def input_shape(self):
+        """
+        Shape of the image arrays as the item's opener returns them, and so
+        as the models take them: (height, width, channels), or (height,
+        width) for single-band labelme images. Raises if the images aren't
+        all the same shape.
+        """
+        shapes = self.db.execute("SELECT DISTINCT height, width, channels FROM items LIMIT 2").fetchall()
+        assert len(shapes) == 1, "Expected one image shape, found %s" % (shapes or "no items",)
+        height, width, channels = shapes[0]
+        return (height, width, channels) if channels else (height, width)
+
+    def histograms(self, num_classes=None):
+        """ Paths and an (N, num_classes) array of label pixel counts per item. """
+        rows = self.db.execute("SELECT name, histogram FROM items ORDER BY name").fetchall()
+        counts = [np.frombuffer(h or b"", dtype="int64") for _, h in rows]
+        num_classes = num_classes or max([len(c) for c in counts] + [1])
+        result = np.zeros((len(rows), num_classes), dtype="int64")
+        for i, c in enumerate(counts):
+            result[i, :len(c)] = c[:num_classes]
+        return [os.path.join(self.root, name) for name, _ in rows], result
+
+    def split(self, fraction=0.8, seed=None, stratify_class=1, bins=5):
+        """
+        Shuffle and split the items into two lists, like datagen.partition.
+
+        For labelme items the split is stratified: items are grouped into
+        `bins` bins by the fraction of their pixels labeled stratify_class
+        (floor, by default) and each bin is split separately, so both sides
+        see as much floor as each other.
+        """
+        rng = np.random.default_rng(seed)
+        if self.kind != "labelme":
+            paths = self.paths()
+            strata = np.zeros(len(paths), dtype="int64")
+        else:
+            paths, counts = self.histograms()
+            counts = np.pad(counts, ((0, 0), (0, max(0, stratify_class + 1 - counts.shape[1]))))
+            share = counts[:, stratify_class] / np.maximum(counts.sum(axis=1), 1)
+            strata = np.minimum((share * bins).astype("int64"), bins - 1)
+
+        left, right = [], []
+        for stratum in np.unique(strata):
+            members = rng.permutation(np.flatnonzero(strata == stratum))
+            split_point = int(round(len(members) * fraction))
+            left.extend(paths[i] for i in members[:split_point])
+            right.extend(paths[i] for i in members[split_point:])
+        assert left and right, "Fraction too extreme for a dataset this small."
+        return [left[i] for i in rng.permutation(len(left))], [right[i] for i in rng.permutation(len(right))]
+
+
+def do_refresh(root, kind="labelme"):
+    index = DatasetIndex(root, kind)
+    changed = index.refresh(check_files=True)
+    print("%d items, %d changed" % (len(index), changed))
+    if len(index):
+        print("input shape:", index.input_shape())
+    if kind == "labelme" and len(index):
+        _, counts = index.histograms()
+        print("label pixels by class:", counts.sum(axis=0))
+
+
+if __name__ == "__main__":
+
+    opcode = sys.argv[1]
+    args = sys.argv[2:]
+
+    func_name = "do_" + opcode
+    func = locals()[func_name]
+    func(*args)
@@ -0,0 +1,207 @@
+"""
+tf.data input pipelines for the trainers in train.py.
+
+These produce the same samples as the datagen generators, but decode and
+augment several images at once on tf.data's threads and prefetch batches,
+so the model step doesn't wait on a single Python loop. Decoded images
+are cached (in memory, or in a file if `cache` names one) so only the
+first epoch decodes them. Random augmentation happens after the cache,
+so it still differs from epoch to epoch.
+
+- segmentation_dataset: like generate_segmentation_data, batched.
+- patch_dataset: like generate_patches, unbatched patches.
+- classifier_dataset: like train.do_train_classifier's round_robin mix
+  of one-hot labeled normal and anomaly patches, batched.
+
+Compare samples/sec of the generators and the tf.data pipelines with:
+
+python3 -m segmentation.dataset benchmark_segmentation <labelme_dir> [batches]
+python3 -m segmentation.dataset benchmark_classifier <normals_dir> <anomalies_dir> [batches]
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from . import datagen
+
+AUTOTUNE = tf.data.AUTOTUNE
+
+
+def _cached(ds, cache):
+    """ cache=None caches in memory, a path caches to that file, False doesn't cache. """
+    if cache is False:
+        return ds
+    return ds.cache(cache or "")
+
+
+def segmentation_dataset(
+        items,
+        batch_size=4,
+        brightness=0.5,
+        h_flip=True,
+        iterations=None,
+        shuffle=True,
+        cache=None,
+        opener=datagen.open_labelme_segmentation
+    ):
+    """
+    Batches of (float32 image in [0, 1], label) from labelme items, with
+    the augmentation of generate_segmentation_data.
+    """
+    x0, y0 = opener(items[0])
+
+    def load(item):
+        x, y = opener(item.decode())
+        return x, y
+
+    def decode(item):
+        x, y = tf.numpy_function(load, [item], (tf.as_dtype(x0.dtype), tf.as_dtype(y0.dtype)))
+        return tf.ensure_shape(x, x0.shape), tf.ensure_shape(y, y0.shape)
+
+    def augment(x, y):
+        if h_flip:
+            flip = tf.random.uniform(()) < 0.5
+            x = tf.cond(flip, lambda: tf.reverse(x, axis=[1]), lambda: x)
+            y = tf.cond(flip, lambda: tf.reverse(y, axis=[1]), lambda: y)
+        # Same as PIL's ImageEnhance.Brightness: scale and clip.
+        factor = 1 + tf.random.uniform((), -brightness, brightness)
+        x = tf.minimum(tf.cast(x, tf.float32) * factor, 255.0)
+        x = tf.floor(x) / 255
+        return x, y
+
+    ds = tf.data.Dataset.from_tensor_slices(list(items))
+    ds = ds.map(decode, num_parallel_calls=AUTOTUNE)
+    ds = _cached(ds, cache)
+    if shuffle:
+        ds = ds.shuffle(len(items), reshuffle_each_iteration=True)
+    ds = ds.repeat(iterations)
+    ds = ds.map(augment, num_parallel_calls=AUTOTUNE)
+    return ds.batch(batch_size).prefetch(AUTOTUNE)
+
+
+def patch_dataset(
+        image_files,
+        patch_side=16,
+        res_width=640,
+        res_height=480,
+        rotate=5,
+        brightness=0.5,
+        stride=8,
+        iterations=None,
+        shuffle_buffer=8192,
+        cache=None
+    ):
+    """
+    Unbatched float32 patches in [0, 1], with the augmentation of
+    generate_patches, and the approximate number of patches per iteration.
+    Images are resized once and cached; each epoch rotates the resized
+    image rather than the original, which is much cheaper and about the same.
+    """
+    stride = stride or patch_side
+    N_estimated = len(image_files) * (res_height//stride) * (res_width//stride)
+
+    def load(fn):
+        return datagen.thumbnail(datagen.load_img(fn.decode()), res_width, res_height)
+
+    def rotate_image(arr):
+        return datagen.random_rotation(arr, rotate)
+
+    def decode(fn):
+        arr = tf.numpy_function(load, [fn], tf.uint8)
+        return tf.ensure_shape(arr, (None, None, 3))
+
+    def augment(arr):
+        if rotate:
+            arr = tf.ensure_shape(tf.numpy_function(rotate_image, [arr], tf.uint8), (None, None, 3))
+        factor = 1 + tf.random.uniform((), -brightness, brightness)
+        x = tf.floor(tf.minimum(tf.cast(arr, tf.float32) * factor, 255.0)) / 255
+        patches = tf.image.extract_patches(
+            x[tf.newaxis],
+            sizes=[1, patch_side, patch_side, 1],
+            strides=[1, stride, stride, 1],
+            rates=[1, 1, 1, 1],
+            padding="VALID"
+        )
+        return tf.reshape(patches, (-1, patch_side, patch_side, 3))
+
+    ds = tf.data.Dataset.from_tensor_slices(list(image_files))
+    ds = ds.map(decode, num_parallel_calls=AUTOTUNE)
+    ds = _cached(ds, cache)
+    ds = ds.shuffle(len(image_files), reshuffle_each_iteration=True)
+    ds = ds.repeat(iterations)
+    ds = ds.map(augment, num_parallel_calls=AUTOTUNE)
+    ds = ds.unbatch()
+    if shuffle_buffer:
+        ds = ds.shuffle(shuffle_buffer)
+    return ds, N_estimated
+
+
+def classifier_dataset(normal_files, anomaly_files, batch_size=2048, **kwargs):
+    """
+    Batches of (patch, one-hot label) alternating normal (category 1) and
+    anomaly (category 0) patches like round_robin, and the approximate
+    number of batches per iteration. kwargs go to patch_dataset.
+    """
+    def labeled(files, category):
+        ds, N = patch_dataset(files, **kwargs)
+        y = tf.one_hot(category, 2, dtype=tf.uint8)
+        return ds.map(lambda x: (x, y), num_parallel_calls=AUTOTUNE), N
+
+    normal, normal_N = labeled(normal_files, 1)
+    anomaly, anomaly_N = labeled(anomaly_files, 0)
+    choice = tf.data.Dataset.range(2).repeat()
+    ds = tf.data.Dataset.choose_from_datasets([normal, anomaly], choice, stop_on_empty_dataset=True)
+    return ds.batch(batch_size).prefetch(AUTOTUNE), (normal_N + anomaly_N) // batch_size
+
+
+def measure(batches, num_batches):
+    """ Samples per second over num_batches batches, after one to warm up. """
+    it = iter(batches)
+    next(it)
+    samples = 0
+    start = time.perf_counter()
+    for _ in range(num_batches):
+        x = next(it)[0]
+        samples += len(x)
+    return samples / (time.perf_counter() - start)
+
+
+def do_benchmark_segmentation(parent_dir, num_batches=50, batch_size=4):
+    num_batches, batch_size = int(num_batches), int(batch_size)
+    items = [os.path.join(parent_dir, item) for item in sorted(os.listdir(parent_dir))]
+    old = datagen.batch(datagen.generate_segmentation_data(items), batch_size=batch_size)
+    new = segmentation_dataset(items, batch_size=batch_size).as_numpy_iterator()
+    print("generator: %.1f samples/sec" % measure(old, num_batches))
+    print("tf.data:   %.1f samples/sec" % measure(new, num_batches))
+
+
+def do_benchmark_classifier(normals, anomalies, num_batches=20, batch_size=2048):
+    num_batches, batch_size = int(num_batches), int(batch_size)
+    normal_files, anomaly_files = datagen.list_images(normals), datagen.list_images(anomalies)
+
+    def generator_mix():
+        normal, _ = datagen.generate_patches(normal_files)
+        anomaly, _ = datagen.generate_patches(anomaly_files)
+        return datagen.round_robin(
+            datagen.assign_one_hot_class(normal, 1, 2),
+            datagen.assign_one_hot_class(anomaly, 0, 2)
+        )
+
+    old = datagen.batch(generator_mix(), batch_size=batch_size)
+    new, _ = classifier_dataset(normal_files, anomaly_files, batch_size=batch_size)
+    print("generator: %.1f samples/sec" % measure(old, num_batches))
+    print("tf.data:   %.1f samples/sec" % measure(new.as_numpy_iterator(), num_batches))
+
+
+if __name__ == "__main__":
+
+    opcode = sys.argv[1]
+    args = sys.argv[2:]
+
+    func_name = "do_" + opcode
+    func = locals()[func_name]
+    func(*args)
@@ -0,0 +1,248 @@
+"""
+Floor segmentation inference for use on the vehicle.
+
+Trained models (saved by train.py) are exported once to TensorFlow Lite,
+optionally quantized to float16 or int8, and then run with TFLiteSegmenter,
+which loads the interpreter once, warms it up and reuses its input buffer
+for every frame. TFLiteSegmenter.predict takes the same batches as
+render.TFRenderer.predict, so it can stand in for it.
+
+Usage, from the lib directory:
+
+python3 -m segmentation.inference export_tflite <model_dir> <out.tflite> [float16|int8|none] [representative_dir]
+python3 -m segmentation.inference benchmark <model_dir> <labeled_dir> <a.tflite> [<b.tflite> ...]
+
+representative_dir and labeled_dir hold one directory per labeled image,
+as used for training (see datagen.open_labelme_segmentation).
+"""
+
+import collections
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from . import datagen
+
+QUANTIZATIONS = ("none", "float16", "int8")
+
+
+def _representative_images(image_dir, limit=100):
+    """ Yield training images as float32 arrays for int8 calibration. """
+    items = sorted(os.listdir(image_dir))[:limit]
+    for item in items:
+        x, _ = datagen.open_labelme_segmentation(os.path.join(image_dir, item))
+        yield np.true_divide(x[:, :, :3], 255, dtype="float32")
+
+
+def export_tflite(model_path, out_path, quantization="float16", representative_dir=None):
+    """
+    Convert a saved model to TensorFlow Lite.
+
+    - float16 halves the size of the weights; on CPU they're expanded back to
+      float32 at load time, so it mostly helps with size and GPU delegates.
+    - int8 quantizes weights and activations, including the input and
+      output, which become uint8. It needs representative_dir to calibrate
+      the activation ranges.
+    """
+    import tensorflow as tf
+
+    assert quantization in QUANTIZATIONS, "quantization must be one of %s" % (QUANTIZATIONS,)
+    converter = tf.lite.TFLiteConverter.from_saved_model(model_path)
+
+    if quantization == "float16":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == "int8":
+        assert representative_dir, "int8 quantization needs representative images"
+
+        def representative_dataset():
+            for x in _representative_images(representative_dir):
+                yield [x[np.newaxis]]
+
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        converter.inference_input_type = tf.uint8
+        converter.inference_output_type = tf.uint8
+
+    with open(out_path, "wb") as f:
+        f.write(converter.convert())
+    print("Wrote %s (%d bytes)" % (out_path, os.path.getsize(out_path)))
+
+
+def _create_interpreter(model_path, num_threads=None):
+    # Use the standalone runtime if it's installed, otherwise the one
+    # bundled with TensorFlow.
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        import tensorflow as tf
+        Interpreter = tf.lite.Interpreter
+    return Interpreter(model_path=model_path, num_threads=num_threads or os.cpu_count())
+
+
+class TFLiteSegmenter(object):
+    """
+    Runs a TensorFlow Lite segmentation model one frame at a time.
+
+    segment() takes a uint8 RGB frame and returns (H, W, 2) float32 class
+    probabilities at the model's resolution. Frames of a different size are
+    resized first. The latency of each call is kept for latency_stats().
+    """
+
+    def __init__(self, model_path, num_threads=None, latency_window=1000, warmup=3):
+        self.interpreter = _create_interpreter(model_path, num_threads)
+        self.interpreter.allocate_tensors()
+        inp, = self.interpreter.get_input_details()
+        out, = self.interpreter.get_output_details()
+        self.input_index = inp["index"]
+        self.output_index = out["index"]
+        self.input_dtype = np.dtype(inp["dtype"])
+        self.input_scale, self.input_zero_point = inp["quantization"]
+        self.output_scale, self.output_zero_point = out["quantization"]
+        _, self.height, self.width, _ = inp["shape"]
+
+        self.input_buffer = np.zeros(inp["shape"], dtype=self.input_dtype)
+        self._resized = np.empty((self.height, self.width, 3), dtype="uint8")
+        self._scaled = np.empty((self.height, self.width, 3), dtype="float32")
+        self.latencies = collections.deque(maxlen=latency_window)
+
+        for _ in range(warmup):
+            self.interpreter.set_tensor(self.input_index, self.input_buffer)
+            self.interpreter.invoke()
+
+    def _fill_input(self, rgb):
+        """ Copy a uint8 RGB frame into the input buffer, converting as the model expects. """
+        if rgb.shape[:2] != (self.height, self.width):
+            rgb = cv2.resize(rgb, (self.width, self.height), dst=self._resized, interpolation=cv2.INTER_AREA)
+        buf = self.input_buffer[0]
+        if self.input_dtype == np.float32:
+            np.multiply(rgb, 1.0 / 255, out=buf, casting="unsafe")
+        elif np.isclose(self.input_scale * 255, 1.0) and self.input_zero_point == 0:
+            # The usual uint8 quantization of [0, 1] inputs: just the pixels.
+            np.copyto(buf, rgb, casting="unsafe")
+        else:
+            info = np.iinfo(self.input_dtype)
+            np.multiply(rgb, 1.0 / (255 * self.input_scale), out=self._scaled, casting="unsafe")
+            self._scaled += self.input_zero_point
+            np.rint(self._scaled, out=self._scaled)
+            np.clip(self._scaled, info.min, info.max, out=self._scaled)
+            np.copyto(buf, self._scaled, casting="unsafe")
+
+    def _invoke(self):
+        self.interpreter.set_tensor(self.input_index, self.input_buffer)
+        self.interpreter.invoke()
+        result = self.interpreter.get_tensor(self.output_index)[0]
+        if result.dtype != np.float32:
+            result = (result.astype("float32") - self.output_zero_point) * self.output_scale
+        return result
+
+    def segment(self, rgb):
+        start = time.perf_counter()
+        self._fill_input(rgb)
+        result = self._invoke()
+        self.latencies.append(time.perf_counter() - start)
+        return result
+
+    def predict(self, batch):
+        """ Same interface as render.TFRenderer: float32 [0, 1] batch in, probabilities out. """
+        return np.stack([
+            self.segment(np.clip(np.rint(x * 255), 0, 255).astype("uint8"))
+            for x in batch
+        ])
+
+    def latency_stats(self):
+        """ Latency of recent frames in milliseconds. """
+        if not self.latencies:
+            return {}
+        ms = np.array(self.latencies) * 1000
+        return dict(
+            frames=len(ms),
+            last=float(ms[-1]),
+            mean=float(ms.mean()),
+            p50=float(np.percentile(ms, 50)),
+            p95=float(np.percentile(ms, 95)),
+            max=float(ms.max()),
+        )
+
+
+def load_segmenter(model_path):
+    """ TFLiteSegmenter for .tflite files, otherwise render.TFRenderer for saved models. """
+    if model_path.endswith(".tflite"):
+        return TFLiteSegmenter(model_path)
+    from .render import TFRenderer
+    return TFRenderer(model_path)
+
+
+def benchmark(reference, candidates, labeled_items):
+    """
+    Compare models on labeled images: accuracy against the labels,
+    agreement with the reference model's predictions, and latency.
+    `candidates` maps names to TFLiteSegmenters.
+    """
+    images = [datagen.open_labelme_segmentation(item) for item in labeled_items]
+
+    ref_latency = []
+    ref_classes = []
+    for x, _ in images:
+        batch = np.true_divide(x[np.newaxis, :, :, :3], 255, dtype="float32")
+        start = time.perf_counter()
+        probs = reference.predict(batch)[0]
+        ref_latency.append(time.perf_counter() - start)
+        ref_classes.append(np.argmax(probs, axis=-1))
+
+    def accuracy(classes, labels):
+        return float(np.mean([np.mean(c == y) for c, y in zip(classes, labels)]))
+
+    labels = [y for _, y in images]
+    results = {
+        "reference": dict(
+            accuracy=accuracy(ref_classes, labels),
+            agreement=1.0,
+            p50_ms=float(np.percentile(ref_latency, 50) * 1000),
+        )
+    }
+    for name, segmenter in candidates.items():
+        segmenter.latencies.clear()
+        classes = []
+        for (x, y) in images:
+            probs = segmenter.segment(np.ascontiguousarray(x[:, :, :3]))
+            classes.append(np.argmax(probs, axis=-1))
+        stats = segmenter.latency_stats()
+        results[name] = dict(
+            accuracy=accuracy(classes, labels),
+            agreement=accuracy(classes, ref_classes),
+            p50_ms=stats["p50"],
+            p95_ms=stats["p95"],
+        )
+    return results
+
+
+def do_export_tflite(model_path, out_path, quantization="float16", representative_dir=None):
+    export_tflite(model_path, out_path, quantization, representative_dir)
+
+
+def do_benchmark(model_path, labeled_dir, *tflite_paths):
+    from .render import TFRenderer
+    reference = TFRenderer(model_path)
+    candidates = {os.path.basename(p): TFLiteSegmenter(p) for p in tflite_paths}
+    items = [os.path.join(labeled_dir, item) for item in sorted(os.listdir(labeled_dir))]
+    results = benchmark(reference, candidates, items)
+    print("%-30s %9s %9s %9s %9s" % ("model", "accuracy", "agreement", "p50 ms", "p95 ms"))
+    for name, r in results.items():
+        print("%-30s %9.4f %9.4f %9.1f %9s" % (
+            name, r["accuracy"], r["agreement"], r["p50_ms"],
+            "%.1f" % r["p95_ms"] if "p95_ms" in r else "-"))
+
+
+if __name__ == "__main__":
+
+    opcode = sys.argv[1]
+    args = sys.argv[2:]
+
+    func_name = "do_" + opcode
+    func = locals()[func_name]
+    func(*args)
@@ -0,0 +1,142 @@
+"""
+Patches for training the patch classifiers, decoded once and cached.
+
+datagen.generate_patches re-opens, resizes and cuts up every image on
+every pass over the data. PatchCache does that once per image, saving the
+patches as a uint8 .npy shard named after a hash of the image file and
+the parameters, and memory-maps the shards to read them back. An epoch is
+then a scan over the shards, with the random rotation, brightness and
+flips applied to a whole batch at a time with numpy.
+
+Patches are saved with a margin around them (see datagen.rotation_margin)
+so rotation can take pixels from the neighboring image area, as rotating
+the whole image used to.
+
+Shards are reused across runs and datasets with the same parameters. To
+clear the cache, delete the directory.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from . import datagen
+
+# Bump when the shard contents change for the same parameters.
+FORMAT_VERSION = 1
+
+
+def file_digest(fn, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(fn, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def cut_patches(arr, patch_side, stride, margin=0):
+    """
+    All the full patch_side patches of an (H, W, C) image at the given
+    stride, in datagen.extract_patches order, each with `margin` more
+    pixels around it (the image's edge pixels repeated where needed).
+    """
+    if margin:
+        arr = np.pad(arr, ((margin, margin), (margin, margin), (0, 0)), mode="edge")
+    side = patch_side + 2 * margin
+    windows = sliding_window_view(arr, (side, side), axis=(0, 1))[::stride, ::stride]
+    return np.ascontiguousarray(np.moveaxis(windows, 2, -1).reshape(-1, side, side, arr.shape[-1]))
+
+
+class PatchCache(object):
+    """
+    Memory-mapped patch shards for a list of images, built as needed.
+
+    - patch_side, res_width, res_height, stride: as for datagen.generate_patches.
+    - rotate: the largest rotation that will be asked of batches(), which
+      sets the margin saved around each patch.
+    """
+
+    def __init__(self, image_files, cache_dir, patch_side=16, res_width=640, res_height=480, stride=8, rotate=5):
+        self.image_files = list(image_files)
+        self.cache_dir = cache_dir
+        self.patch_side = patch_side
+        self.res_width = res_width
+        self.res_height = res_height
+        self.stride = stride or patch_side
+        self.margin = datagen.rotation_margin(patch_side, rotate)
+        os.makedirs(cache_dir, exist_ok=True)
+        self.shards = [self._open_shard(fn) for fn in self.image_files]
+        self.sizes = np.array([len(s) for s in self.shards], dtype="int64")
+
+    def __len__(self):
+        return int(self.sizes.sum())
+
+    def params(self):
+        return dict(
+            version=FORMAT_VERSION,
+            patch_side=self.patch_side,
+            res_width=self.res_width,
+            res_height=self.res_height,
+            stride=self.stride,
+            margin=self.margin,
+        )
+
+    def shard_path(self, fn):
+        key = hashlib.sha1((file_digest(fn) + json.dumps(self.params(), sort_keys=True)).encode()).hexdigest()
+        return os.path.join(self.cache_dir, key + ".npy")
+
+    def _open_shard(self, fn):
+        path = self.shard_path(fn)
+        if not os.path.exists(path):
+            arr = datagen.thumbnail(datagen.load_img(fn), self.res_width, self.res_height)
+            patches = cut_patches(arr, self.patch_side, self.stride, self.margin)
+            # Write under another name first so a crash can't leave a partial shard.
+            tmp_path = path + ".%d.tmp" % os.getpid()
+            with open(tmp_path, "wb") as f:
+                np.save(f, patches)
+            os.replace(tmp_path, path)
+        return np.load(path, mmap_mode="r")
+
+    def batches(self, batch_size=2048, rotate=5, brightness=0.5, h_flip=False, v_flip=False,
+                iterations=float("inf"), shuffle=True, shuffle_shards=16, rng=None):
+        """
+        Yield float32 (batch_size, patch_side, patch_side, 3) batches in
+        [0, 1], the last of the final iteration possibly smaller.
+
+        With shuffle, shards are visited in a random order, shuffle_shards
+        at a time, with the patches of those shards mixed together, so
+        reads stay sequential within each shard.
+        """
+        assert abs(rotate) <= 45 and datagen.rotation_margin(self.patch_side, rotate) <= self.margin, \
+            "The cache was built for smaller rotations."
+        rng = rng or np.random.default_rng()
+        pending = []
+        for _ in datagen.iterate_over([None], iterations=iterations):
+            order = rng.permutation(len(self.shards)) if shuffle else np.arange(len(self.shards))
+            group = shuffle_shards if shuffle else 1
+            for start in range(0, len(order), group):
+                pending.extend(self.shards[i] for i in order[start:start+group])
+                patches = np.concatenate(pending)
+                if shuffle:
+                    patches = patches[rng.permutation(len(patches))]
+                full = len(patches) - len(patches) % batch_size
+                for b in range(0, full, batch_size):
+                    yield self._augment(patches[b:b+batch_size], rotate, brightness, h_flip, v_flip, rng)
+                pending = [patches[full:]]
+        if pending and len(pending[0]):
+            yield self._augment(pending[0], rotate, brightness, h_flip, v_flip, rng)
+
+    def _augment(self, batch, rotate, brightness, h_flip, v_flip, rng):
+        m, p = self.margin, self.patch_side
+        if rotate:
+            batch = datagen.rotate_batch(batch, rotate, rng, out_side=p)
+        else:
+            batch = batch[:, m:m+p, m:m+p]
+        if brightness:
+            batch = datagen.brightness_batch(batch, brightness, rng)
+        if h_flip or v_flip:
+            batch = datagen.flip_batch(batch, rng, horizontal=h_flip, vertical=v_flip)
+        return np.true_divide(batch, 255, dtype="float32")
@@ -1,11 +1,14 @@
 import sys
 import os
-import itertools
 
 from . import datagen
+from . import inference
+import camera
+import pipeline
 
 import PIL
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import cv2
 
 import tensorflow as tf
@@ -26,21 +29,138 @@ def color_slice(arr, lower, upper, bgr_f32, blend=0.2):
     s *= (1-blend)
     s += blend * bgr_f32    
 
-def label_frame(classifier_callback, frame, patch_side, colors, stride=None, batch_size=512):
-    assert stride is None, "We don't yet support labeling sub-patches, but we want to."
-    patch_gen = datagen.extract_patches(frame, patch_side, stride=stride)
-    batcher = datagen.batch(patch_gen, batch_size=batch_size)
-    for patches, coords in batcher:
-        categories = classifier_callback(patches)
-        for ix, cat in enumerate(categories):
-            h, w = coords[ix]
-            color_slice(frame, (h,w), (h+patch_side,w+patch_side), colors[cat])
-
-def label_image(classifier_callback, patch_side, path_in, path_out):
-    pass
-    
-def label_video(classifier_callback, patch_side, video_in, video_out):
-    pass
+def _blend_categories(region, categories, colors, blend):
+    """ Blend colors[categories] into a float32 region in-place, categories being per pixel. """
+    region *= (1-blend)
+    region += blend * _palette(colors)[categories]
+
+def label_frame(classifier_callback, frame, patch_side, colors, stride=None, batch_size=512, blend=0.2):
+    """
+    Color a float32 frame in-place by the category classifier_callback gives
+    each patch_side x patch_side patch.
+
+    Patches are strided views of the frame, copied only batch_size at a time
+    for the classifier. With a stride smaller than patch_side the patches
+    overlap and each stride x stride block takes the category most of the
+    patches covering it voted for (ties going to the lower category).
+    patch_side must be a multiple of stride. Pixels past the last full patch
+    are left alone.
+    """
+    stride = stride or patch_side
+    assert patch_side % stride == 0, "patch_side must be a multiple of stride"
+    windows = sliding_window_view(frame, (patch_side, patch_side), axis=(0, 1))[::stride, ::stride]
+    # (rows, cols, channels, patch_side, patch_side) -> (rows, cols, patch_side, patch_side, channels)
+    windows = np.moveaxis(windows, 2, -1)
+    rows, cols = windows.shape[:2]
+    if rows == 0 or cols == 0:
+        return
+
+    categories = np.empty((rows, cols), dtype="intp")
+    rows_per_batch = max(1, batch_size // cols)
+    for r in range(0, rows, rows_per_batch):
+        patches = windows[r:r+rows_per_batch].reshape(-1, patch_side, patch_side, frame.shape[-1])
+        categories[r:r+rows_per_batch] = np.reshape(classifier_callback(patches), (-1, cols))
+
+    # Each patch covers span x span blocks of the stride grid; count its vote in each.
+    span = patch_side // stride
+    one_hot = np.eye(max(colors) + 1, dtype="int32")[categories]
+    votes = np.zeros((rows + span - 1, cols + span - 1, one_hot.shape[-1]), dtype="int32")
+    for dh in range(span):
+        for dw in range(span):
+            votes[dh:dh+rows, dw:dw+cols] += one_hot
+    blocks = np.argmax(votes, axis=-1)
+
+    pixels = blocks.repeat(stride, axis=0).repeat(stride, axis=1)
+    h, w = pixels.shape
+    _blend_categories(frame[:h, :w], pixels, colors, blend)
+
+def label_image(classifier_callback, patch_side, path_in, path_out, colors=DEFAULT_COLORS, blend=0.2):
+    with PIL.Image.open(path_in) as im:
+        frame = np.array(im.convert(mode="RGB"))
+    labeled, = label_batch(classifier_callback, [frame], patch_side, colors, blend)
+    PIL.Image.fromarray(labeled).save(path_out)
+
+def _palette(colors):
+    """ Colors dict keyed by category to a (n, 3) lookup table. """
+    palette = np.zeros((max(colors) + 1, 3), dtype="float32")
+    for cat, color in colors.items():
+        palette[cat] = color
+    return palette
+
+def _tile_patches(frames, patch_side):
+    """ Non-overlapping patches from a (N, H, W, 3) batch, in the order datagen.extract_patches gives them. """
+    n, h, w, c = frames.shape
+    nh, nw = h // patch_side, w // patch_side
+    tiles = frames[:, :nh*patch_side, :nw*patch_side].reshape(n, nh, patch_side, nw, patch_side, c)
+    return tiles.swapaxes(2, 3).reshape(-1, patch_side, patch_side, c), (nh, nw)
+
+def label_batch(classifier_callback, frames, patch_side, colors=DEFAULT_COLORS, blend=0.2):
+    """
+    Label a list of same-sized uint8 RGB frames with a single call to the
+    classifier and return them as uint8 RGB with the category colors blended in.
+
+    With patch_side, classifier_callback gets float32 patches like label_frame's
+    and returns a category per patch; pixels outside the last full row and
+    column of patches are left alone, as in label_frame. Without it, it gets
+    the whole float32 frames and returns a (N, H, W) category per pixel.
+    """
+    batch = np.true_divide(np.stack(frames), 255, dtype="float32")
+    if patch_side is None:
+        categories = np.asarray(classifier_callback(batch))
+    else:
+        patches, (nh, nw) = _tile_patches(batch, patch_side)
+        categories = np.asarray(classifier_callback(patches)).reshape(-1, nh, nw)
+        categories = categories.repeat(patch_side, axis=1).repeat(patch_side, axis=2)
+    h, w = categories.shape[1:3]
+    _blend_categories(batch[:, :h, :w], categories, colors, blend)
+    return list((batch * 255).astype("uint8"))
+
+def label_video(classifier_callback, patch_side, video_in, video_out, colors=DEFAULT_COLORS, blend=0.2,
+                batch_size=8, max_batch_wait=None, prefetch=8, report_interval=10.0):
+    """
+    Label every frame of a video, streaming it through a pipeline.Pipeline so
+    decoding, inference and encoding overlap on their own threads with bounded
+    queues between them. Frames are classified batch_size at a time (see
+    label_batch) to make better use of the accelerator.
+
+    video_in is anything camera.open_camera accepts. video_out is a path for
+    an mp4 file, or a function taking (fps, (width, height)) and returning a
+    cv2.VideoWriter-like object, e.g. to stream with rtsp.RtspServer.mount_writer.
+    Returns the pipeline's stats.
+    """
+    source = video_in
+    if source is None or isinstance(source, str):
+        source = camera.open_camera(video_in, prefetch=prefetch)
+    fps = getattr(source, "fps", 30.0)
+
+    if isinstance(video_out, str):
+        path_out = video_out
+        def video_out(fps, size_wh):
+            return cv2.VideoWriter(path_out, cv2.VideoWriter_fourcc(*"mp4v"), fps, size_wh)
+
+    writers = []
+    def encode(rgb):
+        if not writers:
+            height, width = rgb.shape[:2]
+            writers.append(video_out(fps, (width, height)))
+        writers[0].write(np.ascontiguousarray(rgb[:, :, ::-1]))
+
+    def infer(frames):
+        return label_batch(classifier_callback, frames, patch_side, colors, blend)
+
+    pipe = pipeline.Pipeline(source, name="decode", queue_size=2 * batch_size)
+    pipe.then("infer", infer, batch_size=batch_size, max_batch_wait=max_batch_wait)
+    pipe.then("encode", encode)
+    try:
+        stats = pipe.run(report_interval=report_interval)
+    finally:
+        if hasattr(source, "close"):
+            source.close()
+        for writer in writers:
+            if hasattr(writer, "release"):
+                writer.release()
+    print("labeled %d frames at %.1f fps" % (stats["encode"]["items"], stats["encode"]["items_per_sec"]))
+    return stats
 
 def do_label_image_from_classifier(model_path, image_in, image_out, threshold=0.75):
     model = TFRenderer(model_path)
@@ -80,14 +200,14 @@ def label_image_from_unet(model, int_arr_in, threshold=0.75):
     return (blended * 255).astype("uint8")
 
 def do_label_image_from_unet(model_path, threshold, image_in, image_out):
-    model = TFRenderer(model_path)
+    model = inference.load_segmenter(model_path)
     with PIL.Image.open(image_in) as im:
         int_arr_in = np.array(im)
     int_arr_out = label_image_from_unet(model, int_arr_in, threshold=float(threshold))
     PIL.Image.fromarray(int_arr_out).save(image_out)
 
 def do_label_images_from_unet(model_path, threshold, input_image_dir, output_image_dir):
-    model = TFRenderer(model_path)
+    model = inference.load_segmenter(model_path)
     for fn in os.listdir(input_image_dir):
         print(fn)
         in_path = os.path.join(input_image_dir, fn)
@@ -97,29 +217,41 @@ def do_label_images_from_unet(model_path, threshold, input_image_dir, output_ima
         int_arr_out = label_image_from_unet(model, int_arr_in, threshold=float(threshold))
         PIL.Image.fromarray(int_arr_out).save(out_path)    
 
-def do_label_video_from_unet(model_path, threshold, video_in, video_out):
-    model = TFRenderer(model_path)
-    # model = keras.models.load_model(model_path)
-    camera = cv2.VideoCapture(video_in)
-    
-    width = int(camera.get(cv2.CAP_PROP_FRAME_WIDTH))
-    height = int(camera.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    fps = camera.get(cv2.CAP_PROP_FPS)
-    
-    codec = cv2.VideoWriter_fourcc(*"mp4v") #*"avc1")
-    output = cv2.VideoWriter(video_out, codec, fps, (width,height))
-    
-    c = itertools.count()
-    while camera.isOpened():
-        ret, in_frame = camera.read()
-        if not ret:
-            break
-        in_rgb = np.flip(in_frame, axis=-1)
-        out_rgb = label_image_from_unet(model, in_rgb, threshold=float(threshold))
-        out_frame = np.flip(out_rgb, axis=-1)
-        print("frame", next(c), in_frame.shape, out_frame.shape)
-        output.write(out_frame)
-    output.release()
+# label_image_from_unet's look: unknown pixels are just darkened.
+UNET_COLORS = dict(DEFAULT_COLORS)
+UNET_COLORS[COLOR_UNKNOWN] = np.array((0.,0.,0.))
+
+def unet_classifier(model, threshold=0.75):
+    """ Classifier callback for label_batch giving a category per pixel from a unet's probabilities. """
+    def classify(batch):
+        c = model.predict(batch)
+        return np.where(c[...,0] >= threshold, COLOR_NONFLOOR, 0) + np.where(c[...,1] >= threshold, COLOR_FLOOR, 0)
+    return classify
+
+def do_label_video_from_unet(model_path, threshold, video_in, video_out, batch_size=8):
+    model = inference.load_segmenter(model_path)
+    classify = unet_classifier(model, float(threshold))
+    label_video(classify, None, video_in, video_out, colors=UNET_COLORS, blend=0.3, batch_size=int(batch_size))
+
+def do_stream_video_from_unet(model_path, threshold, video_in=None, port=8554, batch_size=8):
+    """ Like label_video_from_unet, but stream to rtsp://<host>:<port>/labeled. """
+    import rtsp
+    model = inference.load_segmenter(model_path)
+    classify = unet_classifier(model, float(threshold))
+    server = rtsp.RtspServer(int(port))
+    server.start()
+    def open_writer(fps, size_wh):
+        return server.mount_writer("/labeled", int(fps), size_wh)
+    label_video(classify, None, video_in, open_writer, colors=UNET_COLORS, blend=0.3, batch_size=int(batch_size))
+
+def do_label_video_from_classifier(model_path, video_in, video_out, threshold=0.75, batch_size=8):
+    model = keras.models.load_model(model_path)
+    patch_side = model.input.shape[1]
+    threshold = float(threshold)
+    def classify(patches):
+        c = model.predict(patches)
+        return np.where(c[:,0] >= threshold, 1, 0) + np.where(c[:,1] >= threshold, 2, 0)
+    label_video(classify, patch_side, video_in, video_out, batch_size=int(batch_size))
 
 class KerasRenderer(object):
     def __init__(self, model_path):
@@ -1,6 +1,5 @@
 import sys
 import os
-import random
 import PIL
 
 import tensorflow as tf
@@ -9,6 +8,7 @@ import numpy as np
 
 from . import model
 from . import datagen
+from . import dataindex
 
 def train_autoencoder(
         input_shape, latent_dims,
@@ -65,8 +65,7 @@ def train_autoencoder(
 def do_train_autoencoder(normals, anomalies, latent_dims, epochs, checkpoints, reconstructions):
     
     normal_imgs = datagen.list_images(normals)
-    random.shuffle(normal_imgs)
-    normal_train_imgs, normal_val_imgs = datagen.partition(normal_imgs, 0.8)
+    normal_train_imgs, normal_val_imgs = datagen.partition(normal_imgs, 0.8, rng=np.random.default_rng())
     
     anomaly_imgs = datagen.list_images(anomalies)
     
@@ -89,7 +88,7 @@ def do_train_autoencoder(normals, anomalies, latent_dims, epochs, checkpoints, r
         checkpoints, reconstructions
     )
     
-def do_train_classifier(normals, anomalies, epochs, checkpoints):
+def do_train_classifier(normals, anomalies, epochs, checkpoints, cache_dir=None, input_pipeline="generator"):
 
     batch_size = 2048
     os.makedirs(checkpoints, exist_ok=True)
@@ -97,8 +96,8 @@ def do_train_classifier(normals, anomalies, epochs, checkpoints):
     def prep_data(dir, category):
         imgs = datagen.list_images(dir)
         train, val = datagen.partition(imgs, 0.8)
-        train_patches, train_N = datagen.generate_patches(train)
-        val_patches, val_N = datagen.generate_patches(val)
+        train_patches, train_N = datagen.generate_patches(train, cache_dir=cache_dir)
+        val_patches, val_N = datagen.generate_patches(val, cache_dir=cache_dir)
         train_xy = datagen.assign_one_hot_class(train_patches, category, 2)
         val_xy = datagen.assign_one_hot_class(val_patches, category, 2)
         return train_xy, train_N, val_xy, val_N
@@ -113,11 +112,22 @@ def do_train_classifier(normals, anomalies, epochs, checkpoints):
             (normal[3] + anomaly[3]) // batch_size
         )
     
-    normal_tuple = prep_data(normals, 1)
-    anomaly_tuple = prep_data(anomalies, 0)
-    train, train_N, val, val_N = fuse_data(normal_tuple, anomaly_tuple)
-    
-    burn = next(val)[0][0]
+    def prep_tf_data():
+        from . import dataset
+        normal_train, normal_val = datagen.partition(datagen.list_images(normals), 0.8)
+        anomaly_train, anomaly_val = datagen.partition(datagen.list_images(anomalies), 0.8)
+        train, train_N = dataset.classifier_dataset(normal_train, anomaly_train, batch_size=batch_size)
+        val, val_N = dataset.classifier_dataset(normal_val, anomaly_val, batch_size=batch_size)
+        return train, train_N, val, val_N
+
+    if input_pipeline == "tf.data":
+        train, train_N, val, val_N = prep_tf_data()
+        burn = next(iter(val))[0][0]
+    else:
+        normal_tuple = prep_data(normals, 1)
+        anomaly_tuple = prep_data(anomalies, 0)
+        train, train_N, val, val_N = fuse_data(normal_tuple, anomaly_tuple)
+        burn = next(val)[0][0]
     
     classifier = model.create_classifier(burn.shape)
     classifier.compile(
@@ -141,14 +151,14 @@ def do_train_classifier(normals, anomalies, epochs, checkpoints):
         callbacks = callbacks
     )
 
-def do_train_unet(parent_dir, epochs, model_dir):
-    return _do_train_whole(model.create_unet, parent_dir, epochs, model_dir)
+def do_train_unet(parent_dir, epochs, model_dir, input_pipeline="generator"):
+    return _do_train_whole(model.create_unet, parent_dir, epochs, model_dir, input_pipeline=input_pipeline)
     
-def do_train_erfnet(parent_dir, epochs, model_dir):
+def do_train_erfnet(parent_dir, epochs, model_dir, input_pipeline="generator"):
     def create_model(*args):
         erf, (encoder, decoder) = model.create_erfnet(*args)
         return erf
-    return _do_train_whole(create_model, parent_dir, epochs, model_dir)
+    return _do_train_whole(create_model, parent_dir, epochs, model_dir, input_pipeline=input_pipeline)
     
 def do_train_erfnet_encoder(parent_dir, epochs, model_dir):
     def create_model(*args):
@@ -182,29 +192,39 @@ def do_train_erfnet_decoder(encoder_path, parent_dir, epochs, erfnet_path):
         return keras.Sequential([encoder, decoder])
     _do_train_whole(create_model, parent_dir, epochs, erfnet_path, partition_randseed=0)
 
-def _do_train_whole(model_create_fn, parent_dir, epochs, model_dir, expectation_transformer=None, partition_randseed=None):
-    items = os.listdir(parent_dir)
-    items = [os.path.join(parent_dir, item) for item in items]
-    random.Random(partition_randseed).shuffle(items)
-    train_items, val_items = datagen.partition(items, 0.8)
-        
-    train = datagen.generate_segmentation_data(train_items)
-    val = datagen.generate_segmentation_data(val_items)
-
-    input_shape = next(val)[0].shape
+def _do_train_whole(model_create_fn, parent_dir, epochs, model_dir, expectation_transformer=None, partition_randseed=None, input_pipeline="generator"):
+    index = dataindex.DatasetIndex(parent_dir)
+    # The split is stratified by the indexed label histograms, so also
+    # pick up labels edited in place, which don't touch the directory.
+    index.refresh(check_files=True)
+    train_items, val_items = index.split(0.8, seed=partition_randseed)
 
     batch_size = 4
-    def batcher(g):
-        return datagen.batch(g, batch_size=batch_size)    
 
-    if not expectation_transformer:
-        expectation_transformer = lambda y: y
+    if input_pipeline == "tf.data":
+        from . import dataset
+        train = dataset.segmentation_dataset(train_items, batch_size=batch_size)
+        val = dataset.segmentation_dataset(val_items, batch_size=batch_size, shuffle=False)
+        input_shape = tuple(train.element_spec[0].shape[1:])
+        if expectation_transformer:
+            def transform_y(x, y):
+                return x, tf.numpy_function(lambda y: np.asarray(expectation_transformer(y), dtype="float32"), [y], tf.float32)
+            train = train.map(transform_y)
+            val = val.map(transform_y)
+    else:
+        train = datagen.generate_segmentation_batches(train_items, batch_size=batch_size)
+        val = datagen.generate_segmentation_batches(val_items, batch_size=batch_size)
+
+        input_shape = index.input_shape()
+
+        if not expectation_transformer:
+            expectation_transformer = lambda y: y
 
-    def transform_y(g):
-        return ((x,expectation_transformer(y)) for (x,y) in g)
+        def transform_y(g):
+            return ((x,expectation_transformer(y)) for (x,y) in g)
 
-    train = transform_y(batcher(train))
-    val   = transform_y(batcher(val))
+        train = transform_y(train)
+        val   = transform_y(val)
 
     callbacks = [
         keras.callbacks.ModelCheckpoint(
@@ -0,0 +1,202 @@
+"""
+Process pool for CPU-bound work producing numpy arrays, e.g. loading and
+augmenting training images, that hands results back through shared
+memory rather than pickling them.
+
+Each worker process takes (index, argument) tasks from a queue, calls
+`fn(argument, rng)` and copies the arrays it returns into a free slot of
+a multiprocessing.shared_memory block. Only the slot number, dtypes and
+shapes go back over the result queue. The parent copies the arrays out
+and frees the slot straight away, so slots are never held while results
+wait to be delivered in order.
+
+Every task gets its own numpy.random.Generator. With a seed it's derived
+from the seed and the task's index, so results don't depend on which
+worker ran the task or when; with ordered delivery that makes the whole
+stream reproducible. Python's `random` module is seeded the same way for
+code that still uses it.
+
+Basic use:
+
+with SharedPool(load_and_augment, slot_bytes=64 << 20, seed=0) as pool:
+    for x, y in pool.imap(filenames):
+        ...
+"""
+
+import logging
+import multiprocessing
+import numpy as np
+import queue
+import random
+import traceback
+from multiprocessing import shared_memory
+
+_logger = logging.getLogger(__name__)
+
+
+class WorkerException(Exception):
+    pass
+
+
+def _task_seed(seed, index):
+    if seed is None:
+        return np.random.SeedSequence()
+    return np.random.SeedSequence(seed, spawn_key=(index,))
+
+
+def task_rng(seed, index):
+    """
+    The numpy Generator task number `index` gets, from fresh entropy if
+    seed is None.
+    """
+    return np.random.default_rng(_task_seed(seed, index))
+
+
+def _worker(fn, tasks, results, free_slots, shm_name, slot_bytes, seed):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            index, arg = task
+            try:
+                seq = _task_seed(seed, index)
+                random.seed(int(seq.generate_state(1)[0]))
+                arrays = [
+                    np.ascontiguousarray(a) for a in fn(arg, np.random.default_rng(seq))
+                ]
+                size = sum(a.nbytes for a in arrays)
+                if size > slot_bytes:
+                    raise WorkerException(
+                        f"Task {index} produced {size} bytes, more than slot_bytes={slot_bytes}"
+                    )
+                slot = free_slots.get()
+                offset = slot * slot_bytes
+                layout = []
+                for a in arrays:
+                    out = np.ndarray(a.shape, a.dtype, buffer=shm.buf, offset=offset)
+                    out[...] = a
+                    layout.append((a.dtype.str, a.shape, offset))
+                    offset += a.nbytes
+                    del out
+                results.put((index, slot, layout, None))
+            except Exception:
+                results.put((index, None, None, traceback.format_exc()))
+    finally:
+        shm.close()
+
+
+class SharedPool(object):
+    """
+    - fn: function(argument, rng) returning a sequence of arrays. With the
+      default fork start method it may be any callable; otherwise it must
+      be picklable, e.g. a module-level function or functools.partial.
+    - slot_bytes: room for the arrays from one task.
+    - num_workers: processes to start, by default one per CPU.
+    - slots: shared buffers, at least num_workers; more lets workers run
+      further ahead of the consumer.
+    - seed: see the module docstring.
+    """
+
+    def __init__(self, fn, slot_bytes, num_workers=None, slots=None, seed=None):
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+        self.slots = max(slots or 2 * self.num_workers, self.num_workers)
+        self.slot_bytes = slot_bytes
+        self.shm = shared_memory.SharedMemory(create=True, size=self.slots * slot_bytes)
+        self.tasks = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.free_slots = multiprocessing.Queue()
+        for slot in range(self.slots):
+            self.free_slots.put(slot)
+        self.processes = [
+            multiprocessing.Process(
+                target=_worker,
+                args=(
+                    fn,
+                    self.tasks,
+                    self.results,
+                    self.free_slots,
+                    self.shm.name,
+                    slot_bytes,
+                    seed,
+                ),
+                daemon=True,
+            )
+            for _ in range(self.num_workers)
+        ]
+        for p in self.processes:
+            p.start()
+        _logger.debug(
+            f"SharedPool: {self.num_workers} workers, {self.slots} slots of {slot_bytes} bytes"
+        )
+
+    def _receive(self):
+        while True:
+            try:
+                index, slot, layout, error = self.results.get(timeout=1.0)
+                break
+            except queue.Empty:
+                if not all(p.is_alive() for p in self.processes):
+                    raise WorkerException("A worker process died")
+        if error is not None:
+            raise WorkerException(f"Task {index} failed:\n{error}")
+        arrays = [
+            np.ndarray(
+                shape, np.dtype(dtype), buffer=self.shm.buf, offset=offset
+            ).copy()
+            for dtype, shape, offset in layout
+        ]
+        self.free_slots.put(slot)
+        return index, arrays
+
+    def imap(self, args, ordered=True):
+        """
+        Yield fn's arrays for each of `args`, which may be endless, in
+        order, or as they're ready if not `ordered`.
+        """
+        args = iter(args)
+        in_flight = 0
+        next_index = 0
+        next_yield = 0
+        done = {}
+        exhausted = False
+        while True:
+            # Keep no more tasks going than there are slots, which also
+            # bounds how many results wait in `done` to be delivered.
+            while not exhausted and in_flight + len(done) < self.slots:
+                try:
+                    arg = next(args)
+                except StopIteration:
+                    exhausted = True
+                    break
+                self.tasks.put((next_index, arg))
+                next_index += 1
+                in_flight += 1
+            if in_flight == 0:
+                return
+            index, arrays = self._receive()
+            in_flight -= 1
+            if not ordered:
+                yield arrays
+                continue
+            done[index] = arrays
+            while next_yield in done:
+                yield done.pop(next_yield)
+                next_yield += 1
+
+    def close(self):
+        for _ in self.processes:
+            self.tasks.put(None)
+        for p in self.processes:
+            p.join(timeout=1.0)
+            if p.is_alive():
+                p.terminate()
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,17 +1,25 @@
 import argparse
 import calibration
+import camera
 import cv2
-import dt_apriltags
-import itertools
+import landmarks
+import maprender
+import mapstore
 import numpy as np
+import posefilter
+import posegraph
+import tagdetect
+import time
 import vehctl
-import tempfile
+
+
+# Distance between points - 1.75"
+# Distance from lower to floor - 5.5"
+FLOOR_SCALE = 5.5 / 1.75
 
 
 def project_floor(lower, upper):
-    # Distance between points - 1.75"
-    # Distance from lower to floor - 5.5"
-    scale = 5.5 / 1.75
+    scale = FLOOR_SCALE
 
     # Note lower has the larger y value.
     # Cheating here a bit by not projecting through the vertical distance exactly,
@@ -22,51 +30,120 @@ def project_floor(lower, upper):
     ]
 
 
-def estimate_transform(vehicle_points, world_points):
-
-    # a 2D port of https://github.com/nghiaho12/rigid_transform_3D/blob/master/rigid_transform_3D.py
-
-    # the caller will slice, because we don't need the trailing 1's
-    # and we'd rather not have them distract us in this tricky operation
-    assert (
-        world_points.shape[1] == 2
-    ), "Expected data like [ [X,Y], [X,Y], ... ]. Please trim off a unit third dimension."
-    assert vehicle_points.shape[1] == 2
-
-    # organize the data like the method expects
-    A = vehicle_points.T
-    B = world_points.T
-
-    centroid_A = np.mean(A, axis=1).reshape(-1, 1)
-    centroid_B = np.mean(B, axis=1).reshape(-1, 1)
-
-    Am = A - centroid_A
-    Bm = B - centroid_B
-
-    H = Am @ np.transpose(Bm)
-
-    U, S, Vt = np.linalg.svd(H)
-    R = Vt.T @ U.T
-
-    if np.linalg.det(R) < 0:
-        # print("correcting for reflection")
-        Vt[1, :] *= -1
-        R = Vt.T @ U.T
-
-    t = -R @ centroid_A + centroid_B
-
-    transform = np.concatenate(
-        (np.concatenate((R, np.zeros((1, 2)))), np.concatenate((t, np.ones((1, 1))))),
-        axis=1,
+def tag_vehicle_points(tags, calibrated):
+    """
+    Return a mapping from tag id to the two points where the tag meets the
+    floor, in vehicle coordinates.
+    """
+    return {
+        t.tag_id: calibrated.to_vehicle(
+            np.array(
+                [
+                    project_floor(t.corners[0], t.corners[3]),
+                    project_floor(t.corners[1], t.corners[2]),
+                ]
+            )
+        )
+        for t in tags
+    }
+
+
+def predicted_tag_rois(transform, lmap, calibrated, detector, shape):
+    """
+    Return search regions for the known tags that should be in view if
+    the vehicle-to-world transform is right, as (x0, y0, x1, y1) boxes for
+    TagDetector.detect. Tags are taken to be square, standing upright
+    above their floor points as in project_floor.
+    """
+    visible = lmap.visible_from(transform_pose(transform))
+    n = len(visible)
+    if n == 0:
+        return []
+    rows = [lmap.index[tag_id] for tag_id in visible]
+    rot, t = transform[:2, :2], transform[:2, 2]
+    veh = (lmap.points[rows].reshape(-1, 2) - t) @ rot
+    # The homography is meaningless behind the camera.
+    in_front = (veh[:, 1] > 0).reshape(n, 2).all(axis=1)
+    floor = calibrated.to_image(veh).reshape(n, 2, 2)[in_front]
+
+    h, w = shape[:2]
+    rois = []
+    for p0, p1 in floor:
+        up = np.array([0.0, -np.linalg.norm(p1 - p0)])
+        corners = np.array(
+            [
+                p0 + FLOOR_SCALE * up,
+                p1 + FLOOR_SCALE * up,
+                p1 + (FLOOR_SCALE + 1) * up,
+                p0 + (FLOOR_SCALE + 1) * up,
+            ]
+        )
+        if (corners.max(axis=0) < 0).any() or (corners.min(axis=0) >= (w, h)).any():
+            continue
+        rois.append(detector.roi_for_corners(corners, shape))
+    return rois
+
+
+def transform_pose(transform):
+    """
+    Return the (x, y, theta) pose of a vehicle-to-world transform, as used
+    by posegraph.
+    """
+    return np.array(
+        [transform[0, 2], transform[1, 2], np.arctan2(transform[1, 0], transform[0, 0])]
     )
-    return transform
 
 
-def vehicle2world(v2w_matrix, points):
-    points = np.array(points)
-    points = np.concatenate([points, np.ones((points.shape[0], 1))], axis=1)
-    pred = (v2w_matrix @ points.T).T
-    return np.split(pred, [2], axis=1)[0]
+def add_keyframe(graph, tag2points, transform=None, odometry=None):
+    """
+    Add a pose for the current frame to the pose graph along with its tag
+    observations, and an odometry edge from the previous pose if one is
+    given as a vehicle-frame (x, y, theta) delta. The initial estimate is
+    `transform` if the frame was placed in the map, otherwise the previous
+    pose moved by the odometry. Returns the new pose's index.
+    """
+    if transform is not None:
+        initial = transform_pose(transform)
+    elif graph.num_poses:
+        x, y, theta = graph.poses[-1]
+        dx, dy, dtheta = odometry if odometry is not None else (0.0, 0.0, 0.0)
+        c, s = np.cos(theta), np.sin(theta)
+        initial = [x + c * dx - s * dy, y + s * dx + c * dy, theta + dtheta]
+    else:
+        initial = np.zeros(3)
+
+    pose = graph.add_pose(initial)
+    if pose > 0 and odometry is not None:
+        graph.add_odometry(pose - 1, pose, odometry)
+    for tag_id, points in tag2points.items():
+        for k, point in enumerate(points):
+            graph.add_observation(pose, (tag_id, k), point)
+    return pose
+
+
+def graph_tag_points(graph):
+    """
+    Return the tag landmarks of a pose graph built by add_keyframe in the
+    form used by render_tag_points.
+    """
+    tag_ids = sorted({tag_id for (tag_id, _) in graph.landmark_index})
+    return {
+        tag_id: [tuple(graph.landmark((tag_id, k))) for k in range(2)]
+        for tag_id in tag_ids
+    }
+
+
+def apply_optimized_graph(graph, lmap, pf):
+    """
+    Feed the result of optimizing the pose graph back into the live map:
+    move the landmarks the graph knows to their optimized positions and
+    re-center the pose filter on the latest keyframe, keeping its
+    uncertainty.
+    """
+    for tag_id, points in graph_tag_points(graph).items():
+        if tag_id in lmap:
+            lmap.move(tag_id, points)
+    pf.reset(graph.poses[-1], pf.sigma)
 
 
 def print_tag_points(msg, tag2points):
@@ -75,63 +152,16 @@ def print_tag_points(msg, tag2points):
         print(tag_id, points)
 
 
-def render_tag_points(tag2points):
-
-    page_height = 792
-    page_width = 612
-    margin = 36
-    padding = 36
-    content_height = page_height - (margin + padding) * 2
-    content_width = page_width - (margin + padding) * 2
-
-    import xml.etree.ElementTree as ET
-
-    doc = ET.Element(
-        "svg",
-        width=f"{page_width - margin * 2}px",
-        height=f"{page_height - margin * 2}px",
-        xmlns="http://www.w3.org/2000/svg",
-    )
-
-    all_points = list(itertools.chain(*tag2points.values()))
-    minX = min(p[0] for p in all_points)
-    maxX = max(p[0] for p in all_points)
-    minY = min(p[1] for p in all_points)
-    maxY = max(p[1] for p in all_points)
-
-    scale = min(content_height / (maxY - minY), content_width / (maxX - minX))
-
-    for tag_id, point_pair in tag2points.items():
-
-        p1 = (
-            padding + (point_pair[0][0] - minX) * scale,
-            padding + content_height - (point_pair[0][1] - minY) * scale,
-        )
-        p2 = (
-            padding + (point_pair[1][0] - minX) * scale,
-            padding + content_height - (point_pair[1][1] - minY) * scale,
-        )
-
-        for (p, color) in ((p1, "red"), (p2, "blue")):
-            doc.append(
-                ET.Element("circle", cx=f"{p[0]}", cy=f"{p[1]}", r="5", fill="blue")
-            )
-        doc.append(
-            ET.Element(
-                "line",
-                x1=f"{p1[0]}",
-                y1=f"{p1[1]}",
-                x2=f"{p2[0]}",
-                y2=f"{p2[1]}",
-                stroke="blue",
-                attrib={"stroke-width": "2"},
-            )
-        )
-        text_elt = ET.Element("text", x=f"{(p1[0]+p2[0])/2}", y=f"{(p1[1]+p2[1])/2}")
-        text_elt.text = f"{tag_id:05}"
-        doc.append(text_elt)
-
-    return ET.tostring(doc, encoding="unicode")
+def render_tag_points(tag2points, bounds=None):
+    """
+    Render a map of tags as SVG. `bounds` is ((min_x, min_y), (max_x,
+    max_y)) in world coordinates, e.g. from LandmarkMap.bounds; by default
+    it is computed from the points. To redraw a growing map repeatedly,
+    keep a maprender.SvgMapRenderer instead.
+    """
+    renderer = maprender.SvgMapRenderer(slack=0.0)
+    renderer.update_tags(tag2points, bounds)
+    return renderer.svg()
 
 
 def main():
@@ -223,15 +253,28 @@ def main():
     # print(render_tag_points(tag_world_points))
     # return
 
-    # parser = argparse.ArgumentParser()
-    # args = parser.parse_args()
-
-    # Map from tag_id to ((x1, y1), (x2, y2)) in world coordinates
-    # Two points correspond to a tag based on projecting down to floor.
-    tag_world_points = {}
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--video",
+        help="Replay a recorded video or image directory instead of the camera",
+    )
+    parser.add_argument(
+        "--map", default="map", help="Directory to save the map in, default map"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue building the map saved in --map rather than starting over",
+    )
+    parser.add_argument(
+        "--rtsp-port",
+        type=int,
+        help="Stream the map as it is built to rtsp://<hostname>:<port>/map",
+    )
+    args = parser.parse_args()
 
     veh = vehctl.Vehicle()
-    veh_hmat, _, _ = calibration.read_calibration()
+    calibrated = calibration.CalibratedCamera.load()
 
     # pseudocode:
     # until stop:
@@ -241,96 +284,127 @@ def main():
     #   if first time (i.e. no tags yet):
     #       store coordinates as world coordinates
     #   else if known tags are visible:
-    #       estimate new transform from known tags
+    #       estimate new transform from known tags, ignoring outliers
     #       use new transform to map new tags to world coordinates
-    #       store world coordinates
+    #       refine known tags' world coordinates
     #   else:
-    #       panic?
-
-    tmpdir = tempfile.mkdtemp()
-    at_detector = dt_apriltags.Detector(
-        searchpath=["apriltags"],
-        families="tagStandard41h12",
-        nthreads=1,
-        quad_decimate=1.0,
-        quad_sigma=0.0,
-        refine_edges=1,
-        decode_sharpening=0.25,
-        debug=0,
-    )
+    #       skip the frame
 
-    num_steps = 10
-    for step in range(num_steps):
-        img = cv2.cvtColor(
-            calibration.capture_image(tmpdir, veh.config.vehicle.cameraOrientation),
-            cv2.COLOR_RGB2GRAY,
+    cam = camera.open_camera(
+        args.video, orientation=veh.config.vehicle.cameraOrientation
+    )
+    at_detector = tagdetect.TagDetector()
+
+    # Landmarks are tags, each represented by the two points where it
+    # meets the floor, in world coordinates.
+    if args.resume:
+        lmap, _ = mapstore.load_map(args.map)
+    else:
+        lmap = landmarks.LandmarkMap()
+    map_writer = mapstore.MapWriter(args.map, lmap, resume=args.resume)
+    last_frame = None
+
+    # Odometry predicts the vehicle pose between frames and tags correct
+    # it, so frames with no known tags in view can still be placed, and
+    # the detector can look where the map says tags should be.
+    # When resuming a map the vehicle could be anywhere in it, so that
+    # waits until known tags have placed it.
+    pf = posefilter.PoseFilter()
+    localized = not args.resume
+    if not localized:
+        pf.reset(np.zeros(3), (1000.0, 1000.0, np.pi))
+    odo_pose = veh.curr_pose
+
+    # Frames taken while the vehicle is stopped also become keyframes in a
+    # pose graph, linked by odometry, which is re-optimized whenever a tag
+    # comes back into view after a while. The optimized landmarks and pose
+    # then replace the map's and the filter's estimates.
+    graph = posegraph.PoseGraph()
+
+    svg = maprender.SvgMapRenderer()
+    raster = maprender.RasterMapRenderer()
+    map_stream = None
+    if args.rtsp_port:
+        # Only needed here, and it needs GStreamer.
+        import rtsp
+
+        server = rtsp.RtspServer(args.rtsp_port)
+        map_stream = server.mount_writer("/map", cam.fps, (raster.width, raster.height))
+        server.start()
+        print(f"Streaming the map at rtsp://localhost:{args.rtsp_port}/map")
+
+    def map_frame():
+        nonlocal last_frame, odo_pose, localized
+        frame = cam.read(newer_than=last_frame)
+        last_frame = time.monotonic()
+        curr_pose = veh.curr_pose
+        pf.predict(
+            posegraph.vehicle_delta(posefilter.relative_pose(odo_pose, curr_pose))
         )
-        tags = at_detector.detect(img)
-
-        # Mapping from tag id to points in vehicle coordinates
-        tag_veh_points = {
-            t.tag_id: calibration.apply_homography(
-                veh_hmat,
-                [
-                    project_floor(t.corners[0], t.corners[3]),
-                    project_floor(t.corners[1], t.corners[2]),
-                ],
-            )
-            for t in tags
-        }
-
-        print_tag_points("Current points in vehicle coordinates", tag_veh_points)
-
-        if len(tag_world_points) > 0:
-            # For detected tags, partition into known and unknown
-            # for consistent ordering.
-            known_tags = list(
-                set(tag_veh_points.keys()).intersection(tag_world_points.keys())
-            )
-            new_tags = list(
-                set(tag_veh_points.keys()).difference(tag_world_points.keys())
-            )
-
-            # Construct parallel arrays of vehicle points and
-            # world points from known tags
-            known_veh_points = list(
-                itertools.chain(*[tag_veh_points[tag_id] for tag_id in known_tags])
-            )
-            known_world_points = list(
-                itertools.chain(*[tag_world_points[tag_id] for tag_id in known_tags])
-            )
+        odo_pose = curr_pose
 
-            assert len(known_world_points) > 0, "No common points"
-
-            v2w_matrix = estimate_transform(
-                np.array(known_veh_points), np.array(known_world_points)
+        img = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+        rois = []
+        if localized:
+            rois = predicted_tag_rois(
+                pf.transform(), lmap, calibrated, at_detector, img.shape
             )
+        tags = at_detector.detect(img, extra_rois=rois)
+        tag2points = tag_vehicle_points(tags, calibrated)
+        update = lmap.observe(tag2points, prior=pf.transform() if localized else None)
+        if update.inliers:
+            pf.correct(transform_pose(update.transform), update.rms_error)
+            localized = True
+        print(update, "pose:", pf.mean, "sigma:", pf.sigma)
+        if map_stream is not None:
+            raster.update(lmap)
+            map_stream.write(raster.canvas)
+        return tag2points
 
-            new_veh_points = list(
-                itertools.chain(*[tag_veh_points[tag_id] for tag_id in new_tags])
-            )
-            new_world_points = [
-                (p[0], p[1]) for p in vehicle2world(v2w_matrix, new_veh_points)
-            ]
+    num_steps = 10
+    direction = vehctl.Direction.RIGHT
+    tag2points = map_frame()
+    add_keyframe(graph, tag2points, pf.transform())
+    for step in range(num_steps):
+        # Keep mapping at camera frame rate while the vehicle turns, then
+        # once more after it has stopped.
+        action = veh.perform_action_async(direction, 180 // num_steps)
+        done = False
+        while not done:
+            done = action.done()
+            tag2points = map_frame()
+
+        odometry = posegraph.vehicle_delta(
+            veh.action_displacement(direction, action.result())
+        )
+        add_keyframe(graph, tag2points, pf.transform(), odometry)
+        result = graph.optimize_if_needed()
+        if result is not None:
+            print(f"Optimized pose graph: {result}")
+            apply_optimized_graph(graph, lmap, pf)
+
+        print_tag_points(
+            "All known points in world coordinates: ", lmap.world_points()
+        )
 
-            # Gather new world points into pairs and associate with tag ids:
-            for (i, tag_id) in enumerate(new_tags):
-                tag_world_points[tag_id] = [
-                    new_world_points[i * 2],
-                    new_world_points[i * 2 + 1],
-                ]
+        records = map_writer.write_step(step, poses=[(time.time(), *graph.poses[-1])])
+        print(f"Saved {records} landmark updates to {args.map}")
 
-        else:
-            # First time through, use current coordinate frame as world frame
-            tag_world_points.update(tag_veh_points)
+        if svg.update(lmap):
+            mapfile = "map.svg"
+            with open(mapfile, "wt") as f:
+                print(f"Writing current map to {mapfile}")
+                f.write(svg.svg())
 
-        print_tag_points("All known points in world coordinates: ", tag_world_points)
-        veh.perform_action(vehctl.Direction.RIGHT, 180 // num_steps)
+    if graph.num_poses > 1:
+        graph.optimize()
+    mapfile = "map_optimized.svg"
+    with open(mapfile, "wt") as f:
+        print(f"Writing optimized map to {mapfile}")
+        f.write(render_tag_points(graph_tag_points(graph)))
 
-        mapfile = f"map{step}.svg"
-        with open(mapfile, "wt") as f:
-            print(f"Writing current map to {mapfile}")
-            f.write(render_tag_points(tag_world_points))
+    map_writer.close()
+    cam.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,156 @@
+"""
+Uniform grid index over 2D points, for finding map landmarks near a pose
+without scanning the whole map.
+
+Each entry is a key (e.g. a tag id) with a small set of points (e.g. the
+tag's two floor points). Entries can be added and moved one at a time,
+which suits LandmarkMap refining its points a frame at a time better than
+a KD-tree that would need rebuilding. The bounds of all points are kept
+up to date as entries change, and recomputed after removals.
+
+Basic use:
+
+index = GridIndex(cell_size=24.0)
+index.update(7, [(0.0, 10.0), (2.0, 10.0)])
+index.query_radius((0.0, 0.0), 30.0)  # -> [7]
+index.query_view((0.0, 0.0, 0.0), max_range=30.0)  # -> [7]
+"""
+
+import math
+import numpy as np
+from pose import Pose2D
+
+
+class GridIndex(object):
+    """
+    - cell_size: side of a grid cell, in world units. Queries are
+      cheapest when this is close to the typical query radius.
+    """
+
+    def __init__(self, cell_size=24.0):
+        self.cell_size = float(cell_size)
+        self.cells = {}  # (i, j) -> set of keys with a point in that cell
+        self.entries = {}  # key -> (points, cells)
+        self.min = None
+        self.max = None
+        self.bounds_stale = False  # set by remove(), cleared by bounds()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def _cell(self, point):
+        return (
+            int(math.floor(point[0] / self.cell_size)),
+            int(math.floor(point[1] / self.cell_size)),
+        )
+
+    def update(self, key, points):
+        """
+        Add an entry, or move an existing one to new points.
+        """
+        points = np.array(points, dtype="float64").reshape(-1, 2)
+        cells = {self._cell(p) for p in points}
+
+        old = self.entries.get(key)
+        old_cells = old[1] if old is not None else set()
+        for cell in old_cells - cells:
+            keys = self.cells[cell]
+            keys.discard(key)
+            if not keys:
+                del self.cells[cell]
+        for cell in cells - old_cells:
+            self.cells.setdefault(cell, set()).add(key)
+        self.entries[key] = (points, cells)
+
+        # Moving an entry only grows the bounds. Points move by small
+        # refinements, so recomputing to shrink them isn't worth a scan of
+        # the map.
+        lo, hi = points.min(axis=0), points.max(axis=0)
+        if self.bounds_stale:
+            pass
+        elif self.min is None:
+            self.min, self.max = lo, hi
+        else:
+            self.min = np.minimum(self.min, lo)
+            self.max = np.maximum(self.max, hi)
+
+    def remove(self, key):
+        _, cells = self.entries.pop(key)
+        for cell in cells:
+            keys = self.cells[cell]
+            keys.discard(key)
+            if not keys:
+                del self.cells[cell]
+        # Recomputed by the next bounds() call.
+        self.bounds_stale = True
+
+    def bounds(self):
+        """
+        Return ((min_x, min_y), (max_x, max_y)) covering every point in the
+        index, or None if the index is empty.
+        """
+        if self.bounds_stale:
+            self.bounds_stale = False
+            self.min = self.max = None
+            if self.entries:
+                points = np.concatenate([p for (p, _) in self.entries.values()])
+                self.min, self.max = points.min(axis=0), points.max(axis=0)
+        if self.min is None:
+            return None
+        return tuple(self.min), tuple(self.max)
+
+    def _candidates(self, center, radius):
+        i0, j0 = self._cell((center[0] - radius, center[1] - radius))
+        i1, j1 = self._cell((center[0] + radius, center[1] + radius))
+        if (i1 - i0 + 1) * (j1 - j0 + 1) > len(self.cells):
+            # Large query relative to the map; checking occupied cells is cheaper.
+            return set().union(
+                *(
+                    keys
+                    for (i, j), keys in self.cells.items()
+                    if i0 <= i <= i1 and j0 <= j <= j1
+                )
+            )
+        candidates = set()
+        for i in range(i0, i1 + 1):
+            for j in range(j0, j1 + 1):
+                candidates.update(self.cells.get((i, j), ()))
+        return candidates
+
+    def query_radius(self, center, radius):
+        """
+        Return the keys of entries with any point within `radius` of
+        `center`, nearest first.
+        """
+        center = np.asarray(center, dtype="float64")
+        found = []
+        for key in self._candidates(center, radius):
+            dist = np.linalg.norm(self.entries[key][0] - center, axis=1).min()
+            if dist <= radius:
+                found.append((dist, key))
+        return [key for (_, key) in sorted(found, key=lambda f: f[0])]
+
+    def query_view(self, pose, max_range, fov=math.radians(90)):
+        """
+        Return the keys of entries with any point inside the wedge seen
+        from `pose`, nearest first. `pose` is either a Pose2D, which faces
+        along its x axis, or (x, y, theta) in the convention of LandmarkMap
+        transforms, where the vehicle frame is x to the right and y
+        forward, so the view is centered on the vehicle's y axis.
+        """
+        if isinstance(pose, Pose2D):
+            x, y, heading = pose.x, pose.y, pose.theta
+        else:
+            x, y, theta = pose
+            heading = theta + math.pi / 2
+        found = []
+        for key in self.query_radius((x, y), max_range):
+            offsets = self.entries[key][0] - (x, y)
+            angles = np.arctan2(offsets[:, 1], offsets[:, 0]) - heading
+            angles = np.mod(angles + math.pi, 2 * math.pi) - math.pi
+            if (np.abs(angles) <= fov / 2).any():
+                found.append(key)
+        return found
@@ -0,0 +1,226 @@
+"""
+Shared AprilTag detection for calibration and SLAM.
+
+TagDetector uses every core and avoids scanning the whole full-resolution
+frame when it can: a decimated pass finds tags anywhere in the frame, and
+on later frames only the regions around previously seen tags are searched
+at full resolution. A full-frame pass is still run every so often, and
+whenever tracked tags are lost, to pick up new tags.
+
+Run this module with a video file or image directory to compare it against
+the single-threaded, undecimated settings we used before:
+
+python3 tagdetect.py video/RobotsEyeView.mov
+"""
+
+import argparse
+import camera
+import cv2
+import dt_apriltags
+import logging
+import numpy as np
+import os
+import time
+
+_logger = logging.getLogger(__name__)
+
+TAG_FAMILY = "tagStandard41h12"
+
+
+def create_detector(nthreads=None, quad_decimate=1.0):
+    return dt_apriltags.Detector(
+        searchpath=["apriltags"],
+        families=TAG_FAMILY,
+        nthreads=nthreads or os.cpu_count(),
+        quad_decimate=quad_decimate,
+        quad_sigma=0.0,
+        refine_edges=1,
+        decode_sharpening=0.25,
+        debug=0,
+    )
+
+
+def offset_detection(det, dx, dy):
+    """
+    Shift a detection found in a cropped image back into the coordinates
+    of the full image.
+    """
+    offset = np.array([dx, dy], dtype="float64")
+    det.corners = det.corners + offset
+    det.center = det.center + offset
+    det.homography = (
+        np.array([[1.0, 0.0, dx], [0.0, 1.0, dy], [0.0, 0.0, 1.0]]) @ det.homography
+    )
+    return det
+
+
+def merge_rois(rois):
+    """
+    Merge overlapping (x0, y0, x1, y1) boxes so no pixel is searched twice.
+    """
+    merged = []
+    for roi in sorted(rois):
+        for i, other in enumerate(merged):
+            if (
+                roi[0] < other[2]
+                and other[0] < roi[2]
+                and roi[1] < other[3]
+                and other[1] < roi[3]
+            ):
+                merged[i] = (
+                    min(roi[0], other[0]),
+                    min(roi[1], other[1]),
+                    max(roi[2], other[2]),
+                    max(roi[3], other[3]),
+                )
+                break
+        else:
+            merged.append(roi)
+    # A merge can make a box overlap one it was already compared to.
+    return merged if len(merged) == len(rois) else merge_rois(merged)
+
+
+class TagDetector(object):
+    """
+    - coarse_decimate: quad_decimate for full-frame passes. Corners are
+      still refined against the full-resolution image.
+    - full_scan_interval: run a full-frame pass at least this often, in frames.
+    - roi_margin: how far to grow the box around a tag's last position, as
+      a multiple of the tag's size in pixels, to allow for motion.
+    - min_roi_side: minimum side of a search region in pixels.
+    """
+
+    def __init__(
+        self,
+        nthreads=None,
+        coarse_decimate=2.0,
+        full_scan_interval=10,
+        roi_margin=1.0,
+        min_roi_side=64,
+    ):
+        self.coarse_detector = create_detector(nthreads, coarse_decimate)
+        self.roi_detector = create_detector(nthreads, 1.0)
+        self.full_scan_interval = full_scan_interval
+        self.roi_margin = roi_margin
+        self.min_roi_side = min_roi_side
+
+        self.frames_since_full_scan = None
+        self.tracked = {}  # tag_id -> corners from the last detection
+
+        self.full_scans = 0
+        self.roi_scans = 0
+
+    def reset(self):
+        """
+        Forget tracked tags, e.g. after the vehicle moves a long way.
+        """
+        self.tracked = {}
+        self.frames_since_full_scan = None
+
+    def roi_for_corners(self, corners, shape):
+        (x0, y0), (x1, y1) = corners.min(axis=0), corners.max(axis=0)
+        size = max(x1 - x0, y1 - y0)
+        grow = max(size * self.roi_margin, (self.min_roi_side - size) / 2, 0)
+        h, w = shape[:2]
+        return (
+            max(0, int(x0 - grow)),
+            max(0, int(y0 - grow)),
+            min(w, int(np.ceil(x1 + grow))),
+            min(h, int(np.ceil(y1 + grow))),
+        )
+
+    def detect(self, img_gray, full_scan=False, extra_rois=()):
+        """
+        Detect tags in a grayscale frame. Pass full_scan=True to force a
+        full-frame pass. `extra_rois` are additional (x0, y0, x1, y1)
+        regions to search, e.g. where the map predicts tags will be.
+        """
+        rois = [self.roi_for_corners(c, img_gray.shape) for c in self.tracked.values()]
+        rois.extend(extra_rois)
+        full_scan = (
+            full_scan
+            or not rois
+            or self.frames_since_full_scan is None
+            or self.frames_since_full_scan + 1 >= self.full_scan_interval
+        )
+
+        if full_scan:
+            tags = self.coarse_detector.detect(img_gray)
+            self.frames_since_full_scan = 0
+            self.full_scans += 1
+        else:
+            tags = []
+            for (x0, y0, x1, y1) in merge_rois(rois):
+                crop = np.ascontiguousarray(img_gray[y0:y1, x0:x1])
+                tags.extend(
+                    offset_detection(t, x0, y0) for t in self.roi_detector.detect(crop)
+                )
+            self.frames_since_full_scan += 1
+            self.roi_scans += 1
+
+        # The same tag can turn up in two regions; keep one.
+        tags = list({t.tag_id: t for t in tags}.values())
+
+        if not full_scan and len(tags) < len(self.tracked):
+            _logger.debug("Lost tracked tags, falling back to a full scan.")
+            return self.detect(img_gray, full_scan=True)
+
+        self.tracked = {t.tag_id: t.corners for t in tags}
+        return tags
+
+
+def benchmark(frames, detector, baseline):
+    """
+    Run both detectors over the same frames. Recall is the fraction of
+    tags found by the baseline that the detector also found.
+    """
+    results = {}
+    for name, detect in (
+        ("baseline", baseline.detect),
+        ("service", detector.detect),
+    ):
+        start = time.perf_counter()
+        results[name] = [{t.tag_id for t in detect(f)} for f in frames]
+        results[name + "_secs"] = time.perf_counter() - start
+
+    found = sum(len(b) for b in results["baseline"])
+    matched = sum(len(b & s) for (b, s) in zip(results["baseline"], results["service"]))
+    for name in ("baseline", "service"):
+        secs = results[name + "_secs"]
+        detections = sum(len(ids) for ids in results[name])
+        print(
+            f"{name}: {len(frames) / secs:.1f} frames/sec, "
+            f"{detections / secs:.1f} detections/sec"
+        )
+    print(f"recall vs baseline: {matched / found if found else 1.0:.3f}")
+    print(f"full scans: {detector.full_scans}, roi scans: {detector.roi_scans}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("source", help="Video file or image directory")
+    parser.add_argument("--max-frames", type=int, default=300)
+    parser.add_argument("--coarse-decimate", type=float, default=2.0)
+    parser.add_argument("--full-scan-interval", type=int, default=10)
+    args = parser.parse_args()
+
+    # Decode up front so only detection is timed.
+    with camera.open_camera(args.source) as source:
+        frames = []
+        for img in source:
+            frames.append(cv2.cvtColor(img, cv2.COLOR_RGB2GRAY))
+            if len(frames) >= args.max_frames:
+                break
+
+    benchmark(
+        frames,
+        TagDetector(
+            coarse_decimate=args.coarse_decimate,
+            full_scan_interval=args.full_scan_interval,
+        ),
+        create_detector(nthreads=1, quad_decimate=1.0),
+    )
+
+
+if __name__ == "__main__":
+    main()
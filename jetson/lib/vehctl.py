@@ -1,11 +1,14 @@
 import argparse
+import asyncio
+import collections
+import concurrent.futures
 import enum
 import itertools
 import logging
 import math
 import os
 import time
-from pose import Pose2D, pose_from_wheel_distances
+from pose import PoseHistory, pose_from_wheel_distances
 from simple_rpc import Interface
 from types import SimpleNamespace
 
@@ -55,6 +58,21 @@ class Direction(enum.Enum):
     RIGHT = 4
 
 
+# Same constants are defined in nav_action.h
+class ActionState(enum.Enum):
+    IDLE = 0
+    ACTIVE = 1
+    TIMED_OUT = 2
+    INTERRUPTED = 3
+    SUCCEEDED = 4
+
+
+ActionStatus = collections.namedtuple(
+    "ActionStatus",
+    ["state", "left_transitions", "left_speed", "right_transitions", "right_speed"],
+)
+
+
 class _DummyInterface:
     def __init__(self):
         self.last_dir = Direction.STOP
@@ -84,7 +102,7 @@ class _DummyInterface:
 
 
 class Vehicle:
-    def __init__(self):
+    def __init__(self, pose_hist_capacity=None):
         self.config = CONFIGS.get(os.getenv("USER"), CONFIGS["default"])
 
         try:
@@ -115,11 +133,12 @@ class Vehicle:
             self.config.rightMotor.encoderPin,
         )
 
-        self.pose_hist = [Pose2D()]
+        self.pose_hist = PoseHistory(capacity=pose_hist_capacity)
+        self._action_executor = None
 
     @property
     def curr_pose(self):
-        return self.pose_hist[-1]
+        return self.pose_hist.curr_pose
 
     def _update_pos(self, left_transitions, right_transitions):
         left_dist = (
@@ -153,66 +172,275 @@ class Vehicle:
 
     def reset(self):
         self.interface.stop()
-        self.pose_hist = [Pose2D()]
+        self.pose_hist.reset()
 
     def action_start(self, direction, transitions):
         self.interface.actionStart(direction.value, transitions)
 
     def action_status(self):
-        return self.interface.actionStatus()
+        state, *rest = self.interface.actionStatus()
+        return ActionStatus(ActionState(state), *rest)
 
-    def perform_action(self, direction, dist):
+    def transitions_goal(self, direction, dist):
         config = self.config.vehicle
 
         if direction in (Direction.FORWARD, Direction.REVERSE):
-            transitions_goal = (dist * 20) / (config.wheelDiam * math.pi)
+            return (dist * 20) / (config.wheelDiam * math.pi)
         else:
-            transitions_goal = ((dist * 20) / 360) * (
-                config.wheelBase / config.wheelDiam
+            return ((dist * 20) / 360) * (config.wheelBase / config.wheelDiam)
+
+    # Sign of each wheel's travel, (left, right), for each action direction.
+    _wheel_signs = {
+        Direction.FORWARD: (1, 1),
+        Direction.REVERSE: (-1, -1),
+        Direction.LEFT: (-1, 1),
+        Direction.RIGHT: (1, -1),
+    }
+
+    def action_displacement(self, direction, status):
+        """
+        Return the Pose2D of the vehicle relative to where it started an
+        action, given the action's final ActionStatus. The firmware only
+        counts encoder transitions, so the direction of travel comes from
+        `direction`.
+        """
+        config = self.config.vehicle
+        left_sign, right_sign = self._wheel_signs[direction]
+        dist_per_transition = config.wheelDiam * math.pi / 20
+        return pose_from_wheel_distances(
+            left_sign * status.left_transitions * dist_per_transition,
+            right_sign * status.right_transitions * dist_per_transition,
+            config.wheelBase,
+        )
+
+    def wait_for_action(
+        self,
+        transitions_goal,
+        min_interval=0.005,
+        max_interval=0.050,
+        coast_time=0.025,
+        on_status=None,
+    ):
+        """
+        Poll the current action until it leaves the active state and return
+        its final ActionStatus.
+
+        Rather than polling at a fixed rate, the interval is adapted to the
+        observed encoder rate so that we check back shortly before the goal
+        should be reached, bounded by [min_interval, max_interval]. Until
+        there's any progress to go on the interval backs off from
+        min_interval towards max_interval.
+
+        After completion, wait `coast_time` (an arbitrary 25ms by default)
+        and read the status once more to pick up transitions from the
+        wheels coasting. Pass 0 to skip the extra read.
+
+        If given, `on_status` is called with every status read.
+        """
+        interval = min_interval
+        prev = None
+        while True:
+            status = self.action_status()
+            now = time.monotonic()
+            _logger.debug(f"wait_for_action: {status}")
+            if on_status is not None:
+                on_status(status)
+            if status.state != ActionState.ACTIVE:
+                break
+
+            progress = min(status.left_transitions, status.right_transitions)
+            if prev is not None and progress > prev[1]:
+                rate = (progress - prev[1]) / (now - prev[0])
+                interval = (transitions_goal - progress) / rate / 2
+            else:
+                interval *= 2
+            interval = max(min_interval, min(max_interval, interval))
+            prev = (now, progress)
+            time.sleep(interval)
+
+        if coast_time > 0:
+            time.sleep(coast_time)
+            status = self.action_status()
+            _logger.debug(f"wait_for_action after coasting: {status}")
+            if on_status is not None:
+                on_status(status)
+
+        return status
+
+    def perform_action(self, direction, dist, **wait_kwargs):
+        """
+        Start an action and block until the firmware reports that it has
+        finished. Returns the final ActionStatus.
+
+        The encoder transitions read back while waiting are added to
+        pose_hist as they come in, so curr_pose tracks the vehicle during
+        the action rather than only between actions. PoseHistory is locked,
+        so curr_pose can be read from another thread meanwhile, as slam.py
+        does while perform_action_async runs.
+        """
+        transitions_goal = self.transitions_goal(direction, dist)
+        _logger.debug(f"{direction} {dist} transitions_goal: {transitions_goal}")
+
+        start_pose = self.curr_pose
+
+        def record(status):
+            self.pose_hist.append(
+                start_pose + self.action_displacement(direction, status)
             )
-        print(direction, dist, "transitions_goal:", transitions_goal)
 
         self.action_start(direction, transitions_goal)
-        action_state = 1
-        while action_state == 1:
-            (
-                action_state,
-                left_transitions,
-                left_speed,
-                right_transitions,
-                right_speed,
-            ) = self.action_status()
-            print(
-                dict(
-                    action_state=action_state,
-                    left_transitions=left_transitions,
-                    left_speed=left_speed,
-                    right_transitions=right_transitions,
-                    right_speed=right_speed,
-                )
-            )
-            time.sleep(0.050)
-
-        # Arbitrary wait in case of further coasting.
-        time.sleep(0.025)
-        (
-            action_state,
-            left_transitions,
-            left_speed,
-            right_transitions,
-            right_speed,
-        ) = self.action_status()
-        print(
-            dict(
-                action_state=action_state,
-                left_transitions=left_transitions,
-                left_speed=left_speed,
-                right_transitions=right_transitions,
-                right_speed=right_speed,
+        return self.wait_for_action(transitions_goal, on_status=record, **wait_kwargs)
+
+    def perform_action_async(self, direction, dist, **wait_kwargs):
+        """
+        Non-blocking variant of perform_action, returning a
+        concurrent.futures.Future for the final ActionStatus. Actions are
+        run one at a time in submission order, so a caller can queue up the
+        next action before the current one completes. From asyncio code,
+        wrap the result with asyncio.wrap_future to await it.
+        """
+        if self._action_executor is None:
+            self._action_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="vehicle-action"
             )
+        return self._action_executor.submit(
+            self.perform_action, direction, dist, **wait_kwargs
         )
 
 
+class _Command:
+    def __init__(self, method_name, args, future, coalesce=False):
+        self.method_name = method_name
+        self.args = args
+        self.futures = [future]
+        self.coalesce = coalesce
+
+
+class AsyncVehicle:
+    """
+    asyncio facade over Vehicle. A single task owns the vehicle (and so the
+    serial port) and runs commands one at a time in a dedicated thread, so
+    the blocking RPCs never stall the event loop and never interleave.
+
+    Steering commands (forward, reverse, left, right, stop) are coalesced:
+    if a steering command is still waiting at the back of the queue when a
+    new one arrives, the new one replaces it. Callers of the superseded
+    command get the result of the command that replaced it. Steering
+    commands resolve to the vehicle's current pose after they run.
+
+    Usage:
+
+    async with AsyncVehicle() as veh:
+        await veh.forward(128)
+        status = await veh.perform_action(Direction.LEFT, 90)
+    """
+
+    def __init__(self, vehicle=None):
+        self.vehicle = vehicle if vehicle is not None else Vehicle()
+        self._queue = collections.deque()
+        self._wakeup = None
+        self._task = None
+        self._closing = False
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="vehicle-serial"
+        )
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def close(self):
+        """
+        Stop the owner task once it finishes the commands already queued.
+        Commands submitted from now on raise RuntimeError.
+        """
+        self._closing = True
+        if self._task is not None:
+            self._queue.append(None)
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        self._executor.shutdown()
+
+    async def forward(self, speed):
+        return await self._submit("forward", speed, coalesce=True)
+
+    async def reverse(self, speed):
+        return await self._submit("reverse", speed, coalesce=True)
+
+    async def left(self, speed):
+        return await self._submit("left", speed, coalesce=True)
+
+    async def right(self, speed):
+        return await self._submit("right", speed, coalesce=True)
+
+    async def stop(self):
+        return await self._submit("stop", coalesce=True)
+
+    async def reset(self):
+        return await self._submit("reset")
+
+    async def perform_action(self, direction, dist):
+        return await self._submit("perform_action", direction, dist)
+
+    @property
+    def curr_pose(self):
+        return self.vehicle.curr_pose
+
+    def _submit(self, method_name, *args, coalesce=False):
+        if self._closing:
+            raise RuntimeError("AsyncVehicle is closed")
+        if self._task is None:
+            raise RuntimeError("AsyncVehicle has not been started")
+
+        future = asyncio.get_running_loop().create_future()
+        tail = self._queue[-1] if self._queue else None
+        if coalesce and tail is not None and tail.coalesce:
+            _logger.debug(
+                f"{method_name}{args} supersedes {tail.method_name}{tail.args}"
+            )
+            tail.method_name = method_name
+            tail.args = args
+            tail.futures.append(future)
+        else:
+            self._queue.append(_Command(method_name, args, future, coalesce))
+            self._wakeup.set()
+        return future
+
+    def _call(self, command):
+        result = getattr(self.vehicle, command.method_name)(*command.args)
+        return self.vehicle.curr_pose if command.coalesce else result
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            while not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+
+            command = self._queue.popleft()
+            if command is None:
+                return
+
+            try:
+                result = await loop.run_in_executor(self._executor, self._call, command)
+            except Exception as e:
+                for future in command.futures:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for future in command.futures:
+                    if not future.done():
+                        future.set_result(result)
+
+
 def drive():
     direction_map = {
         "F": Direction.FORWARD,
@@ -239,7 +467,7 @@ def drive():
     veh = Vehicle()
 
     for (dir, dist) in args.instructions:
-        veh.perform_action(dir, dist)
+        print(dir, dist, veh.perform_action(dir, dist))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,91 @@
+import calibration
+import cv2
+import numpy as np
+import pytest
+import tagdetect
+from calibration import (
+    CalibratedCamera,
+    CalibrationSession,
+    TagsNotDetectedException,
+    apply_homography,
+    deskew,
+)
+
+# A plausible homography from 640x480 image coordinates to vehicle
+# coordinates in inches, looking forward and down at the floor.
+HMAT = np.array(
+    [
+        [0.05, 0.002, -16.0],
+        [0.001, -0.02, 30.0],
+        [0.00001, 0.002, 0.1],
+    ]
+)
+
+
+def test_apply_homography_matches_extended_form():
+    points = np.array([[0.0, 0.0], [320.0, 240.0], [600.0, 450.0]])
+    extended = np.concatenate([points, np.ones((3, 1))], axis=1) @ HMAT.T
+    expected = extended[:, :2] / extended[:, 2:]
+    assert np.allclose(apply_homography(HMAT, points), expected)
+
+
+def test_to_vehicle_matches_apply_homography():
+    cam = CalibratedCamera(HMAT)
+    points = np.random.default_rng(0).uniform(0, 480, size=(50, 2))
+    out = np.empty((50, 2))
+    result = cam.to_vehicle(points, out=out)
+    assert result is out
+    assert np.allclose(out, apply_homography(HMAT, points))
+
+
+def test_deskew_matches_warp_perspective():
+    rng = np.random.default_rng(0)
+    # Smooth image so interpolation differences stay small.
+    img = cv2.GaussianBlur(rng.integers(0, 256, (480, 640, 3), dtype="uint8"), (9, 9), 3)
+
+    cam = CalibratedCamera(HMAT, output_size=(560, 440), output_y_offset=10)
+    expected = deskew(img, HMAT, (560, 440), output_y_offset=10)
+    result = cam.deskew(img)
+
+    assert result.shape == expected.shape
+    diff = np.abs(result.astype("int") - expected.astype("int"))
+    assert np.mean(diff) < 1.0
+
+
+class FakeCamera:
+    def __init__(self):
+        self.closed = False
+
+    def read(self, newer_than=None):
+        return np.zeros((48, 64, 3), dtype="uint8")
+
+    def close(self):
+        self.closed = True
+
+
+class NoTags:
+    def detect(self, img):
+        return []
+
+
+def test_calibration_session_closes_only_its_own_camera(monkeypatch):
+    monkeypatch.setattr(tagdetect, "create_detector", lambda *args: NoTags())
+    opened = []
+
+    def open_camera(**kwargs):
+        opened.append(FakeCamera())
+        return opened[-1]
+
+    monkeypatch.setattr(calibration.camera, "open_camera", open_camera)
+
+    with CalibrationSession(panel_dist=20.0) as sess:
+        with pytest.raises(TagsNotDetectedException):
+            sess.calibrate()
+        assert not opened[0].closed
+    assert opened[0].closed
+
+    cam = FakeCamera()
+    with CalibrationSession(panel_dist=20.0, cam=cam) as sess:
+        with pytest.raises(TagsNotDetectedException):
+            sess.calibrate()
+    assert not cam.closed and len(opened) == 1
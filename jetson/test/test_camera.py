@@ -0,0 +1,59 @@
+import cv2
+import numpy as np
+import pytest
+import time
+from camera import EndOfFrames, ImageDirSource, VideoFileSource, open_camera
+
+
+def write_images(tmp_path, n):
+    for i in range(n):
+        cv2.imwrite(str(tmp_path / f"frame_{i:03}.png"), np.full((8, 8, 3), i, "uint8"))
+
+
+def frame_values(frames):
+    return [int(f[0, 0, 0]) for f in frames]
+
+
+def test_image_dir_source(tmp_path):
+    write_images(tmp_path, 5)
+    with open_camera(str(tmp_path)) as source:
+        assert isinstance(source, ImageDirSource)
+        assert frame_values(source) == [0, 1, 2, 3, 4]
+        with pytest.raises(EndOfFrames):
+            source.read()
+
+
+def test_loop_and_prefetch(tmp_path):
+    write_images(tmp_path, 3)
+    with ImageDirSource(str(tmp_path), loop=True, prefetch=2) as source:
+        assert frame_values(source.read() for _ in range(7)) == [0, 1, 2, 0, 1, 2, 0]
+
+
+def test_realtime_skips_frames(tmp_path):
+    write_images(tmp_path, 20)
+    with ImageDirSource(str(tmp_path), fps=100, realtime=True) as source:
+        values = []
+        for frame in source:
+            values.append(int(frame[0, 0, 0]))
+            time.sleep(0.05)
+
+    assert values == sorted(values)
+    assert len(values) < 20
+    assert source.frames_read == len(values)
+    assert source.frames_read + source.frames_skipped == 20
+
+
+def test_video_file_source(tmp_path):
+    path = str(tmp_path / "video.avi")
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 10, (16, 16))
+    for i in range(4):
+        writer.write(np.full((16, 16, 3), i * 60, "uint8"))
+    writer.release()
+
+    with open_camera(path, prefetch=2) as source:
+        assert isinstance(source, VideoFileSource)
+        assert source.fps == 10
+        frames = list(source)
+
+    assert len(frames) == 4
+    assert frames[0].shape == (16, 16, 3)
@@ -0,0 +1,69 @@
+import threading
+import time
+from cmdmailbox import CommandMailbox
+
+
+def test_latest_command_wins():
+    release = threading.Event()
+    handled = []
+
+    def handler(command):
+        release.wait()
+        handled.append(command)
+
+    mailbox = CommandMailbox(handler)
+    mailbox.start()
+    mailbox.post(1)
+    time.sleep(0.05)  # let the worker pick up the first command and block
+    for command in range(2, 10):
+        mailbox.post(command)
+    release.set()
+    time.sleep(0.05)
+    mailbox.stop()
+
+    assert handled == [1, 9]
+    stats = mailbox.stats()
+    assert stats["posted"] == 9
+    assert stats["executed"] == 2
+    assert stats["dropped"] == 7
+    assert stats["latency_ms"]["max"] >= 50
+
+
+def test_max_rate():
+    handled = []
+    mailbox = CommandMailbox(lambda command: handled.append(time.monotonic()), max_rate=20)
+    mailbox.start()
+    for command in range(50):
+        mailbox.post(command)
+        time.sleep(0.005)
+    mailbox.stop()
+
+    # 50 posts over about 0.25 seconds at 20 per second
+    assert 2 <= len(handled) <= 7
+    assert mailbox.stats()["dropped"] >= 40
+    gaps = [b - a for (a, b) in zip(handled, handled[1:])]
+    assert min(gaps) >= 0.045
+
+
+def test_wait():
+    release = threading.Event()
+    handled = []
+
+    def handler(command):
+        release.wait()
+        handled.append(command)
+
+    mailbox = CommandMailbox(handler)
+    mailbox.start()
+    first = mailbox.post(1)
+    time.sleep(0.05)
+    assert not mailbox.wait(first, timeout=0.01)
+    second = mailbox.post(2)
+    third = mailbox.post(3)
+    release.set()
+    # The second command was dropped, but waiting on it returns once the
+    # third, which replaced it, is done.
+    assert mailbox.wait(second, timeout=1.0)
+    assert handled == [1, 3]
+    assert mailbox.wait(third, timeout=0)
+    mailbox.stop()
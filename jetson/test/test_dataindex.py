@@ -0,0 +1,89 @@
+import os
+import numpy as np
+import pytest
+
+PIL_Image = pytest.importorskip("PIL.Image")
+
+from segmentation.dataindex import DatasetIndex
+
+
+def write_item(root, name, floor_rows, shape=(8, 8), mode="L"):
+    """
+    A labelme item whose label marks the top `floor_rows` rows as class 1.
+    """
+    path = os.path.join(root, name)
+    os.makedirs(path, exist_ok=True)
+    img = np.zeros(shape + ((3,) if mode == "RGB" else ()), dtype="uint8")
+    PIL_Image.fromarray(img, mode=mode).save(os.path.join(path, "img.png"))
+    label = np.zeros(shape, dtype="uint8")
+    label[:floor_rows] = 1
+    PIL_Image.fromarray(label, mode="L").save(os.path.join(path, "label.png"))
+
+
+def test_incremental_refresh(tmp_path):
+    root = tmp_path / "items"
+    for i in range(3):
+        write_item(root, "item%d" % i, 2)
+    index = DatasetIndex(str(root))
+    assert index.refresh() == 3
+    assert len(index) == 3
+    # Nothing changed in the directory, so nothing is read.
+    assert index.refresh() == 0
+
+    write_item(root, "item3", 2)
+    assert index.refresh() == 1
+    assert [os.path.basename(p) for p in index.paths()] == [
+        "item0", "item1", "item2", "item3"]
+
+    # Editing a label in place doesn't touch the directory; only
+    # check_files notices it.
+    label = os.path.join(root, "item0", "label.png")
+    write_item(root, "item0", 8)
+    os.utime(label, (1e9, 1e9))
+    assert index.refresh() == 0
+    assert index.refresh(check_files=True) == 1
+    _, counts = index.histograms()
+    assert counts[0].tolist() == [0, 64]
+    index.close()
+
+    # The index persists beside the directory.
+    index = DatasetIndex(str(root))
+    assert index.refresh() == 0
+    assert len(index) == 4
+
+
+def test_split_strata(tmp_path):
+    root = tmp_path / "items"
+    # Ten items with no floor and ten that are all floor.
+    for i in range(10):
+        write_item(root, "empty%d" % i, 0)
+        write_item(root, "floor%d" % i, 8)
+    index = DatasetIndex(str(root))
+    index.refresh()
+
+    train, val = index.split(0.8, seed=0)
+    assert len(train) == 16 and len(val) == 4
+    assert sorted(train + val) == index.paths()
+    for side, n in ((train, 8), (val, 2)):
+        assert sum("floor" in os.path.basename(p) for p in side) == n
+    assert index.split(0.8, seed=0) == (train, val)
+
+
+def test_input_shape(tmp_path):
+    gray = tmp_path / "gray"
+    write_item(gray, "item", 2, shape=(6, 10), mode="L")
+    index = DatasetIndex(str(gray))
+    index.refresh()
+    # Like open_labelme_segmentation, single-band images have no channel axis.
+    assert index.input_shape() == (6, 10)
+
+    color = tmp_path / "color"
+    write_item(color, "item", 2, shape=(6, 10), mode="RGB")
+    write_item(color, "other", 2, shape=(6, 12), mode="RGB")
+    index = DatasetIndex(str(color))
+    index.refresh()
+    with pytest.raises(AssertionError):
+        index.input_shape()
+    os.remove(os.path.join(color, "other", "img.png"))
+    index.refresh(check_files=True)
+    assert index.input_shape() == (6, 10, 3)
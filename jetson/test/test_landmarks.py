@@ -0,0 +1,96 @@
+import math
+import numpy as np
+from landmarks import LandmarkMap, apply_transform, fit_rigid_transform, rigid_transform
+
+# Floor points of a handful of tags in world coordinates
+WORLD = {
+    tag_id: np.array([[x, y], [x + 2.0, y]])
+    for tag_id, (x, y) in enumerate([(0, 20), (10, 25), (-10, 30), (5, 40), (-5, 15)])
+}
+
+
+def observe_from(transform, tag_ids):
+    """
+    Tag points in vehicle coordinates for a vehicle placed by `transform`
+    (vehicle to world).
+    """
+    inverse = np.linalg.inv(transform)
+    return {t: apply_transform(inverse, WORLD[t]) for t in tag_ids}
+
+
+def test_fit_rigid_transform():
+    expected = rigid_transform(0.3, 5.0, -2.0)
+    src = np.random.default_rng(0).uniform(-10, 10, size=(6, 2))
+    dst = apply_transform(expected, src)
+    assert np.allclose(fit_rigid_transform(src, dst), expected)
+
+
+def test_landmark_map_tracks_vehicle():
+    lmap = LandmarkMap()
+    update = lmap.observe(observe_from(np.eye(3), [0, 1, 2]))
+    assert sorted(update.added) == [0, 1, 2]
+
+    moved = rigid_transform(math.pi / 8, 3.0, 1.0)
+    update = lmap.observe(observe_from(moved, [1, 2, 3]))
+    assert sorted(update.inliers) == [1, 2]
+    assert update.added == [3]
+    assert np.allclose(update.transform, moved)
+    assert np.allclose(lmap.landmark(3)[0], WORLD[3])
+    assert len(lmap) == 4
+
+
+def test_landmark_map_rejects_bad_detection():
+    lmap = LandmarkMap()
+    lmap.observe(observe_from(np.eye(3), [0, 1, 2, 3]))
+
+    moved = rigid_transform(-0.2, -1.0, 2.0)
+    observed = observe_from(moved, [0, 1, 2, 3])
+    observed[2] = observed[2] + 5.0  # a bad detection
+
+    update = lmap.observe(observed)
+    assert update.outliers == [2]
+    assert np.allclose(update.transform, moved)
+    assert np.allclose(lmap.landmark(2)[0], WORLD[2])
+
+
+def test_landmark_map_covariance_shrinks():
+    lmap = LandmarkMap()
+    lmap.observe(observe_from(np.eye(3), [0, 1]))
+    before = np.trace(lmap.landmark(0)[1][0])
+    for _ in range(5):
+        lmap.observe(observe_from(np.eye(3), [0, 1]))
+    assert np.trace(lmap.landmark(0)[1][0]) < before
+
+
+def test_landmark_map_without_known_tags():
+    lmap = LandmarkMap()
+    lmap.observe(observe_from(np.eye(3), [0]))
+    assert lmap.observe(observe_from(np.eye(3), [4])).transform is None
+
+    prior = rigid_transform(0.1, 1.0, 1.0)
+    update = lmap.observe(observe_from(prior, [4]), prior=prior)
+    assert update.added == [4]
+    assert np.allclose(lmap.landmark(4)[0], WORLD[4])
+
+
+def test_landmark_map_without_inliers():
+    lmap = LandmarkMap()
+    lmap.observe(observe_from(np.eye(3), [0]))
+
+    # Tag 0 detected at the wrong apparent size agrees with no transform.
+    observed = observe_from(np.eye(3), [0, 1])
+    observed[0] = observed[0] * 5.0
+    update = lmap.observe(observed)
+    assert update.transform is None and update.outliers == [0]
+    assert 1 not in lmap
+
+    prior = np.eye(3)
+    update = lmap.observe(observed, prior=prior)
+    assert update.outliers == [0] and update.added == [1]
+    assert update.rms_error is None
+    assert np.isfinite(lmap.landmark(1)[1]).all()
+
+    # The next frame seeing tag 1 is placed from it as usual.
+    update = lmap.observe(observe_from(np.eye(3), [1]))
+    assert update.inliers == [1]
+    assert np.isfinite(update.rms_error)
@@ -0,0 +1,45 @@
+import numpy as np
+from landmarks import LandmarkMap
+from maprender import RasterMapRenderer, SvgMapRenderer
+
+
+def tag_points(x, y=20.0):
+    return [(x, y), (x + 2.0, y)]
+
+
+def test_svg_appends_without_relayout():
+    lmap = LandmarkMap()
+    lmap.observe({1: tag_points(0.0), 2: tag_points(40.0, 40.0)})
+    renderer = SvgMapRenderer()
+    assert renderer.update(lmap)
+    assert renderer.layouts == 1
+    assert not renderer.update(lmap)
+
+    # A new tag inside the current view is just added.
+    lmap.observe({1: tag_points(0.0), 3: tag_points(20.0, 30.0)})
+    assert renderer.update(lmap)
+    assert renderer.layouts == 1
+    assert "00003" in renderer.svg()
+
+    # One well outside it means laying out again.
+    lmap.observe({3: tag_points(20.0, 30.0), 4: tag_points(200.0, 30.0)})
+    renderer.update(lmap)
+    assert renderer.layouts == 2
+    assert all(f"{t:05}" in renderer.svg() for t in (1, 2, 3, 4))
+
+
+def test_raster_incremental_matches_full_redraw():
+    lmap = LandmarkMap()
+    incremental = RasterMapRenderer((320, 240))
+    lmap.observe({1: tag_points(0.0), 2: tag_points(40.0, 40.0)})
+    incremental.update(lmap)
+    lmap.observe({2: tag_points(40.0, 40.0), 3: tag_points(20.0, 30.0)})
+    incremental.update(lmap)
+    assert incremental.layouts == 1
+
+    full = RasterMapRenderer((320, 240))
+    full.view, full.scale = incremental.view, incremental.scale
+    full.update_tags(lmap.world_points(), incremental.view)
+
+    assert (incremental.canvas != 255).any()
+    assert np.array_equal(incremental.canvas, full.canvas)
@@ -0,0 +1,66 @@
+import numpy as np
+from landmarks import LandmarkMap
+from mapstore import LANDMARK_DTYPE, MapWriter, load_map
+
+
+def tag_points(x):
+    return [(x, 20.0), (x + 2.0, 20.0)]
+
+
+def assert_same_map(a, b):
+    assert a.tag_ids == b.tag_ids
+    for tag_id in a.tag_ids:
+        for x, y in zip(a.landmark(tag_id), b.landmark(tag_id)):
+            assert np.array_equal(x, y)
+
+
+def test_write_and_load(tmp_path):
+    lmap = LandmarkMap()
+    with MapWriter(tmp_path, lmap) as writer:
+        lmap.observe({1: tag_points(0.0), 2: tag_points(5.0)})
+        assert writer.write_step(0, poses=[(100.0, 0.0, 0.0, 0.0)]) == 2
+        # Nothing changed, nothing written.
+        assert writer.write_step(1) == 0
+        lmap.observe({2: tag_points(5.1), 3: tag_points(10.0)})
+        assert writer.write_step(2, poses=[(101.0, 0.1, 0.0, 0.0)]) == 2
+
+    loaded, poses = load_map(tmp_path)
+    assert_same_map(lmap, loaded)
+    assert loaded.near((11.0, 20.0), 2.0) == [3]
+    assert list(poses["t"]) == [100.0, 101.0]
+    assert list(poses["step"]) == [0, 2]
+
+
+def test_resume_and_compact(tmp_path):
+    lmap = LandmarkMap()
+    with MapWriter(tmp_path, lmap) as writer:
+        lmap.observe({1: tag_points(0.0), 2: tag_points(5.0)})
+        writer.write_step(0)
+
+    # Simulate a write cut off partway through a record.
+    with open(tmp_path / "landmarks.bin", "ab") as f:
+        f.write(b"\0" * 10)
+
+    lmap, _ = load_map(tmp_path)
+    with MapWriter(tmp_path, lmap, resume=True) as writer:
+        assert writer.write_step(1) == 0
+        lmap.observe({1: tag_points(0.1), 4: tag_points(15.0)})
+        assert writer.write_step(2) == 2
+        writer.compact()
+
+    assert (tmp_path / "landmarks.bin").stat().st_size == 3 * LANDMARK_DTYPE.itemsize
+    loaded, _ = load_map(tmp_path)
+    assert_same_map(lmap, loaded)
+
+
+def test_moved_landmarks_are_written(tmp_path):
+    lmap = LandmarkMap()
+    with MapWriter(tmp_path, lmap) as writer:
+        lmap.observe({1: tag_points(0.0), 2: tag_points(5.0)})
+        writer.write_step(0)
+        lmap.move(2, tag_points(6.0))
+        assert writer.write_step(1) == 1
+
+    loaded, _ = load_map(tmp_path)
+    assert_same_map(lmap, loaded)
+    assert loaded.near((6.0, 20.0), 0.5) == [2]
@@ -0,0 +1,76 @@
+import math
+import numpy as np
+from calibration import CalibratedCamera
+from occupancy import (
+    LABEL_FLOOR,
+    LABEL_NONFLOOR,
+    LABEL_UNKNOWN,
+    FloorSampler,
+    OccupancyGrid,
+)
+from pose import Pose2D
+
+# Same homography as test_calibration: 640x480 image looking forward and
+# down at the floor.
+HMAT = np.array(
+    [
+        [0.05, 0.002, -16.0],
+        [0.001, -0.02, 30.0],
+        [0.00001, 0.002, 0.1],
+    ]
+)
+
+
+def test_update_accumulates_and_clamps():
+    grid = OccupancyGrid(cell_size=1.0, chunk_size=8, l_occupied=1.0, l_free=-0.5)
+    points = np.array([[0.5, 0.5], [0.6, 0.4], [-3.5, 20.5], [2.5, 2.5]])
+    grid.update(points, np.array([True, True, False, False]))
+
+    assert np.allclose(grid.log_odds(points), [2.0, 2.0, -0.5, -0.5])
+    assert np.allclose(grid.log_odds([[100.0, 100.0]]), [0.0])
+    # Only the chunks touched are allocated.
+    assert sorted(grid.chunks) == [(-1, 2), (0, 0)]
+
+    for _ in range(10):
+        grid.update(points[:1], [True])
+    assert np.allclose(grid.log_odds(points[:1]), [grid.l_max])
+
+
+def test_sampler_points_round_trip():
+    cam = CalibratedCamera(HMAT)
+    sampler = FloorSampler(cam, (640, 480), spacing=1.0)
+    assert len(sampler) > 0
+    # Pose2D convention: x forward, so everything sampled is ahead.
+    assert (sampler.points[:, 0] > 0).all()
+
+    # Each sample's pixel maps back to (about) its floor point.
+    veh = cam.to_vehicle(np.column_stack([sampler.cols, sampler.rows]).astype(float))
+    pose2d = np.column_stack([veh[:, 1], -veh[:, 0]])
+    assert np.abs(pose2d - sampler.points).max() < 1.0
+
+
+def test_update_from_labels_places_with_pose():
+    cam = CalibratedCamera(HMAT)
+    sampler = FloorSampler(cam, (640, 480), spacing=1.0)
+    labels = np.full((480, 640), LABEL_FLOOR, dtype="uint8")
+    labels[:, 320:] = LABEL_NONFLOOR
+    labels[:10] = LABEL_UNKNOWN
+
+    grid = OccupancyGrid(cell_size=2.0)
+    # Facing along world +y, so the vehicle's right is world +x.
+    grid.update_from_labels(sampler, labels, Pose2D(0.0, 0.0, math.pi / 2))
+
+    right_of_center = sampler.points[:, 1] < -5
+    left_of_center = sampler.points[:, 1] > 5
+    world_right = np.column_stack(
+        [-sampler.points[right_of_center, 1], sampler.points[right_of_center, 0]]
+    )
+    world_left = np.column_stack(
+        [-sampler.points[left_of_center, 1], sampler.points[left_of_center, 0]]
+    )
+    assert (grid.log_odds(world_right) > 0).mean() > 0.95
+    assert (grid.log_odds(world_left) < 0).mean() > 0.95
+
+    img, bounds = grid.to_image()
+    assert img.dtype == np.uint8 and img.size > 0
+    assert bounds[0][1] <= 0.0 < bounds[1][1]
@@ -0,0 +1,55 @@
+import pytest
+import threading
+from pipeline import Pipeline
+
+
+def test_pipeline_runs_stages_in_order():
+    results = []
+    threads = set()
+
+    def double(x):
+        threads.add(threading.current_thread().name)
+        return x * 2
+
+    def collect(x):
+        threads.add(threading.current_thread().name)
+        results.append(x)
+
+    stats = Pipeline(range(100), name="decode", queue_size=2).then(
+        "double", double
+    ).then("collect", collect).run()
+
+    assert results == [x * 2 for x in range(100)]
+    assert len(threads) == 2
+    assert list(stats) == ["decode", "double", "collect"]
+    assert all(s["items"] == 100 for s in stats.values())
+
+
+def test_pipeline_reraises_stage_errors():
+    def fail(x):
+        if x == 5:
+            raise ValueError("bad item")
+        return x
+
+    with pytest.raises(ValueError):
+        Pipeline(iter(range(1000000))).then("fail", fail).then("sink", lambda x: None).run()
+
+
+def test_pipeline_batches():
+    batches = []
+    results = []
+
+    def infer(batch):
+        batches.append(len(batch))
+        return [x + 1 for x in batch]
+
+    stats = (
+        Pipeline(range(10))
+        .then("infer", infer, batch_size=4)
+        .then("collect", results.append)
+        .run()
+    )
+
+    assert results == list(range(1, 11))
+    assert batches == [4, 4, 2]
+    assert stats["infer"]["items"] == 10
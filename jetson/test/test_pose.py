@@ -1,5 +1,13 @@
 import math
-from pose import Pose2D, pose_from_wheel_distances, reduce_angle
+import random
+import threading
+from pose import (
+    Pose2D,
+    PoseHistory,
+    pose_from_wheel_distances,
+    poses_from_wheel_distances,
+    reduce_angle,
+)
 
 
 def approx_equal(v1, v2, tol=0.001):
@@ -226,3 +234,76 @@ def test_pose_from_dist_inner_arcs():
         pose_from_wheel_distances(-math.pi, math.pi / 2, 3.0),
         Pose2D(-0.5, -0.5, 0.5 * math.pi),
     )
+
+
+def test_poses_from_wheel_distances_matches_scalar():
+    rng = random.Random(0)
+    left = [rng.uniform(-2.0, 2.0) for _ in range(500)]
+    right = [rng.uniform(-2.0, 2.0) for _ in range(500)]
+    # Mix in the special cases: straight ahead and a stationary right wheel.
+    left[10:20] = right[10:20]
+    right[30:40] = [0.0] * 10
+
+    start = Pose2D(1.0, -2.0, math.pi / 3)
+    xs, ys, thetas = poses_from_wheel_distances(left, right, 5.25, start=start)
+    assert len(xs) == len(ys) == len(thetas) == 500
+
+    pose = start
+    for i in range(500):
+        pose = pose + pose_from_wheel_distances(left[i], right[i], 5.25)
+        assert_equal_pose(Pose2D(xs[i], ys[i], thetas[i]), pose)
+
+
+def test_poses_from_wheel_distances_empty():
+    xs, ys, thetas = poses_from_wheel_distances([], [], 1.0)
+    assert len(xs) == len(ys) == len(thetas) == 0
+
+
+def test_pose_history_growth():
+    hist = PoseHistory(initial_size=4)
+    assert len(hist) == 1
+    assert_equal_pose(hist.curr_pose, Pose2D())
+
+    for i in range(1, 10):
+        hist.append(Pose2D(float(i), 0.0, 0.0), t=float(i))
+
+    assert len(hist) == 10
+    assert_equal_pose(hist.curr_pose, Pose2D(9.0, 0.0, 0.0))
+    assert_equal_pose(hist[3], Pose2D(3.0, 0.0, 0.0))
+    assert list(hist.as_arrays()["x"]) == [float(i) for i in range(10)]
+
+
+def test_pose_history_ring_buffer():
+    hist = PoseHistory(capacity=3)
+    for i in range(1, 10):
+        hist.append(Pose2D(float(i), float(-i), 0.0), t=float(i))
+
+    assert len(hist) == 3
+    assert_equal_pose(hist[0], Pose2D(7.0, -7.0, 0.0))
+    assert_equal_pose(hist.curr_pose, Pose2D(9.0, -9.0, 0.0))
+    arrays = hist.as_arrays()
+    assert list(arrays["x"]) == [7.0, 8.0, 9.0]
+    assert list(arrays["t"]) == [7.0, 8.0, 9.0]
+
+    hist.reset()
+    assert len(hist) == 1
+    assert_equal_pose(hist.curr_pose, Pose2D())
+
+
+def test_pose_history_concurrent_reads():
+    # As when perform_action_async records poses while slam.py reads them.
+    hist = PoseHistory(capacity=8)
+    done = threading.Event()
+
+    def writer():
+        for i in range(20000):
+            hist.append(Pose2D(float(i), float(i), 0.0))
+        done.set()
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    while not done.is_set():
+        pose = hist.curr_pose
+        assert pose.x == pose.y
+    thread.join()
+    assert_equal_pose(hist.curr_pose, Pose2D(19999.0, 19999.0, 0.0))
@@ -0,0 +1,39 @@
+import math
+import numpy as np
+from pose import Pose2D
+from posefilter import PoseFilter, relative_pose
+
+
+def test_relative_pose():
+    start = Pose2D(1.0, 2.0, 0.5)
+    delta = Pose2D(3.0, -1.0, 0.2)
+    result = relative_pose(start, start + delta)
+    assert math.isclose(result.x, delta.x)
+    assert math.isclose(result.y, delta.y)
+    assert math.isclose(result.theta, delta.theta)
+
+
+def test_predict_then_correct():
+    pf = PoseFilter()
+    initial_sigma = pf.sigma
+
+    # Drive forward (y in the vehicle frame) while turning left a quarter turn.
+    pf.predict([0.0, 10.0, math.pi / 2])
+    assert np.allclose(pf.mean, [0.0, 10.0, math.pi / 2])
+    assert (pf.sigma > initial_sigma).all()
+    predicted_sigma = pf.sigma
+
+    # A tag fix some way off pulls the estimate towards it, and the
+    # estimate becomes more certain.
+    pf.correct([1.0, 11.0, math.pi / 2 + 0.05], rms_error=0.5)
+    assert 0.0 < pf.mean[0] < 1.0
+    assert 10.0 < pf.mean[1] < 11.0
+    assert (pf.sigma < predicted_sigma).all()
+
+
+def test_correct_wraps_heading():
+    pf = PoseFilter(initial_sigma=(1.0, 1.0, 1.0))
+    pf.reset([0.0, 0.0, math.pi - 0.01], (1.0, 1.0, 1.0))
+    pf.correct([0.0, 0.0, -math.pi + 0.01])
+    # The two headings are 0.02 apart across the wrap, not 2 pi - 0.02.
+    assert abs(abs(pf.mean[2]) - math.pi) < 0.01
@@ -0,0 +1,41 @@
+import numpy as np
+from pose import Pose2D
+from posegraph import PoseGraph, synthetic_graph, vehicle_delta
+
+
+def test_vehicle_delta():
+    assert np.allclose(vehicle_delta(Pose2D(2.0, 1.0, 0.5)), [-1.0, 2.0, 0.5])
+
+
+def test_optimize_reduces_drift():
+    graph, true_poses, _ = synthetic_graph(200, 40)
+
+    def position_error():
+        return np.sqrt(
+            np.mean(np.sum((graph.poses[:, :2] - true_poses[:, :2]) ** 2, axis=1))
+        )
+
+    before = position_error()
+    result = graph.optimize()
+
+    assert result["final_cost"] < result["initial_cost"]
+    assert position_error() < before / 2
+    assert not graph.needs_optimization
+
+
+def test_loop_closure():
+    graph = PoseGraph(loop_closure_gap=3)
+    for i in range(5):
+        graph.add_pose([0.0, float(i), 0.0])
+        if i > 0:
+            graph.add_odometry(i - 1, i, [0.0, 1.0, 0.0])
+
+    assert not graph.add_observation(0, "tag", [0.0, 10.0])
+    assert not graph.add_observation(1, "tag", [0.0, 9.0])
+    assert not graph.needs_optimization
+    assert graph.add_observation(4, "tag", [0.0, 6.0])
+    assert graph.needs_optimization
+
+    graph.optimize_if_needed()
+    assert np.allclose(graph.landmark("tag"), [0.0, 10.0], atol=1e-3)
+    assert graph.optimize_if_needed() is None
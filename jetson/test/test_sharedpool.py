@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+from sharedpool import SharedPool, WorkerException
+
+
+def noisy_range(n, rng):
+    return np.arange(n, dtype="float32"), rng.random(3)
+
+
+def test_ordered_results_match_inputs():
+    with SharedPool(noisy_range, slot_bytes=1024, num_workers=2, slots=2) as pool:
+        results = list(pool.imap(range(20)))
+    assert [len(a) for a, _ in results] == list(range(20))
+    assert all(np.array_equal(a, np.arange(len(a))) for a, _ in results)
+
+
+def test_unordered_delivers_everything():
+    with SharedPool(noisy_range, slot_bytes=1024, num_workers=3) as pool:
+        lengths = sorted(len(a) for a, _ in pool.imap(range(30), ordered=False))
+    assert lengths == list(range(30))
+
+
+def test_seed_makes_results_reproducible():
+    def run(num_workers):
+        with SharedPool(noisy_range, 1024, num_workers=num_workers, seed=7) as pool:
+            return np.stack([noise for _, noise in pool.imap(range(10))])
+
+    first, second = run(1), run(3)
+    assert np.array_equal(first, second)
+    # Each task gets its own stream.
+    assert len(np.unique(first[:, 0])) == 10
+
+
+def test_errors_are_raised_in_parent():
+    with SharedPool(noisy_range, slot_bytes=64, num_workers=1) as pool:
+        with pytest.raises(WorkerException, match="slot_bytes"):
+            list(pool.imap([4, 100]))
@@ -0,0 +1,81 @@
+import math
+import numpy as np
+from pose import Pose2D
+from spatialindex import GridIndex
+
+
+def brute_force_radius(points, center, radius):
+    return {
+        key
+        for key, pts in points.items()
+        if np.linalg.norm(np.asarray(pts) - center, axis=1).min() <= radius
+    }
+
+
+def test_query_radius_matches_brute_force():
+    rng = np.random.default_rng(0)
+    index = GridIndex(cell_size=10.0)
+    points = {}
+    for key in range(300):
+        p = rng.uniform(-100, 100, 2)
+        points[key] = [p, p + rng.normal(0, 1, 2)]
+        index.update(key, points[key])
+
+    # Move some entries, possibly across cells.
+    for key in range(0, 300, 7):
+        points[key] = [p + 15.0 for p in points[key]]
+        index.update(key, points[key])
+
+    for radius in (5.0, 20.0, 500.0):
+        center = rng.uniform(-100, 100, 2)
+        found = index.query_radius(center, radius)
+        assert set(found) == brute_force_radius(points, center, radius)
+        dists = [
+            np.linalg.norm(np.asarray(points[k]) - center, axis=1).min() for k in found
+        ]
+        assert dists == sorted(dists)
+
+
+def test_query_view():
+    index = GridIndex()
+    index.update("ahead", [(0.0, 20.0), (2.0, 20.0)])
+    index.update("behind", [(0.0, -20.0), (2.0, -20.0)])
+    index.update("right", [(20.0, 0.5), (20.0, -0.5)])
+    index.update("far", [(0.0, 200.0), (2.0, 200.0)])
+
+    assert index.query_view((0.0, 0.0, 0.0), max_range=50.0) == ["ahead"]
+    # Turning to the right (clockwise) brings the right tag into view.
+    assert index.query_view((0.0, 0.0, -math.pi / 2), max_range=50.0) == ["right"]
+
+
+def test_query_view_from_pose2d():
+    index = GridIndex()
+    index.update("x", [(20.0, 0.5), (20.0, -0.5)])
+    index.update("y", [(0.5, 20.0), (-0.5, 20.0)])
+
+    # Pose2D faces along x, with y to its left.
+    assert index.query_view(Pose2D(0.0, 0.0, 0.0), max_range=50.0) == ["x"]
+    assert index.query_view(Pose2D(0.0, 0.0, math.pi / 2), max_range=50.0) == ["y"]
+
+
+def test_bounds_and_remove():
+    index = GridIndex()
+    assert index.bounds() is None
+    index.update(1, [(0.0, 0.0), (1.0, 2.0)])
+    index.update(2, [(-5.0, 3.0)])
+    assert index.bounds() == ((-5.0, 0.0), (1.0, 3.0))
+
+    index.remove(2)
+    assert 2 not in index
+    assert index.query_radius((-5.0, 3.0), 1.0) == []
+    assert index.bounds() == ((0.0, 0.0), (1.0, 2.0))
+
+    # Updates after a removal still count toward the recomputed bounds.
+    index.update(3, [(4.0, -1.0)])
+    index.remove(3)
+    index.update(4, [(0.5, 5.0)])
+    assert index.bounds() == ((0.0, 0.0), (1.0, 5.0))
+
+    index.remove(1)
+    index.remove(4)
+    assert index.bounds() is None
@@ -0,0 +1,80 @@
+import numpy as np
+import tagdetect
+from tagdetect import TagDetector, merge_rois
+from types import SimpleNamespace
+
+
+def test_merge_rois():
+    assert merge_rois([]) == []
+    assert merge_rois([(0, 0, 10, 10), (20, 20, 30, 30)]) == [
+        (0, 0, 10, 10),
+        (20, 20, 30, 30),
+    ]
+    assert merge_rois([(0, 0, 10, 10), (5, 5, 20, 20)]) == [(0, 0, 20, 20)]
+
+    # The last box joins the first two only after they've been merged.
+    assert merge_rois(
+        [(0, 0, 10, 10), (5, 5, 20, 20), (30, 30, 40, 40), (15, 0, 35, 35)]
+    ) == [(0, 0, 40, 40)]
+
+
+class StubDetector:
+    """
+    Stands in for dt_apriltags.Detector. Tags are drawn as blocks of
+    pixels whose value is the tag id, and are found wherever a whole
+    block is in the image searched. Records the shape of each image.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def detect(self, img):
+        self.calls.append(img.shape)
+        tags = []
+        for tag_id in np.unique(img[img > 0]):
+            ys, xs = np.nonzero(img == tag_id)
+            x0, y0, x1, y1 = xs.min(), ys.min(), xs.max() + 1, ys.max() + 1
+            corners = np.array([[x0, y1], [x1, y1], [x1, y0], [x0, y0]], "float64")
+            tags.append(
+                SimpleNamespace(
+                    tag_id=int(tag_id),
+                    corners=corners,
+                    center=corners.mean(axis=0),
+                    homography=np.eye(3),
+                )
+            )
+        return tags
+
+
+def draw_tags(tags, shape=(480, 640)):
+    img = np.zeros(shape, dtype="uint8")
+    for tag_id, (x, y) in tags.items():
+        img[y : y + 20, x : x + 20] = tag_id
+    return img
+
+
+def test_tag_detector_roi_and_fallback(monkeypatch):
+    monkeypatch.setattr(tagdetect, "create_detector", lambda *args: StubDetector())
+    detector = TagDetector(full_scan_interval=10)
+    coarse, roi = detector.coarse_detector, detector.roi_detector
+
+    frame = draw_tags({1: (100, 100), 2: (400, 300)})
+    tags = detector.detect(frame)
+    assert coarse.calls == [(480, 640)] and roi.calls == []
+    assert sorted(t.tag_id for t in tags) == [1, 2]
+
+    # Tracked tags are looked for only around where they were, and found
+    # in full-frame coordinates.
+    frame = draw_tags({1: (105, 100), 2: (400, 305)})
+    tags = {t.tag_id: t for t in detector.detect(frame)}
+    assert len(coarse.calls) == 1 and len(roi.calls) == 2
+    assert all(h < 480 and w < 640 for (h, w) in roi.calls)
+    assert tags[1].corners.min(axis=0).tolist() == [105, 100]
+    assert tags[2].corners.min(axis=0).tolist() == [400, 305]
+
+    # Tag 2 jumped out of its region, so the frame is scanned in full.
+    frame = draw_tags({1: (105, 100), 2: (50, 400)})
+    tags = {t.tag_id: t for t in detector.detect(frame)}
+    assert coarse.calls[1:] == [(480, 640)]
+    assert tags[2].corners.min(axis=0).tolist() == [50, 400]
+    assert (detector.full_scans, detector.roi_scans) == (2, 2)
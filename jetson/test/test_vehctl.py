@@ -0,0 +1,132 @@
+import asyncio
+import threading
+from pose import Pose2D
+from vehctl import ActionState, AsyncVehicle, Direction, Vehicle
+
+
+class FakeVehicle:
+    """
+    Stands in for Vehicle, recording calls. Each call blocks until
+    `release` is set so tests can control when the queue drains.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.release = threading.Event()
+        self.curr_pose = Pose2D()
+
+    def _record(self, name, *args):
+        self.release.wait()
+        self.calls.append((name,) + args)
+        self.curr_pose = Pose2D(float(len(self.calls)), 0.0, 0.0)
+
+    def forward(self, speed):
+        self._record("forward", speed)
+
+    def left(self, speed):
+        self._record("left", speed)
+
+    def stop(self):
+        self._record("stop")
+
+    def perform_action(self, direction, dist):
+        self._record("perform_action", direction, dist)
+        return "done"
+
+
+def test_async_vehicle_coalesces_steering():
+    fake = FakeVehicle()
+
+    async def run():
+        async with AsyncVehicle(fake) as veh:
+            first = asyncio.ensure_future(veh.forward(100))
+            await asyncio.sleep(0.01)  # let the owner task pick it up
+            superseded = [
+                asyncio.ensure_future(veh.forward(speed)) for speed in (110, 120)
+            ]
+            latest = asyncio.ensure_future(veh.left(130))
+            await asyncio.sleep(0)
+            fake.release.set()
+            return await asyncio.gather(first, *superseded, latest)
+
+    results = asyncio.run(run())
+
+    assert fake.calls == [("forward", 100), ("left", 130)]
+    assert results[0] == Pose2D(1.0, 0.0, 0.0)
+    assert results[1:] == [Pose2D(2.0, 0.0, 0.0)] * 3
+
+
+def test_async_vehicle_does_not_coalesce_actions():
+    fake = FakeVehicle()
+    fake.release.set()
+
+    async def run():
+        async with AsyncVehicle(fake) as veh:
+            return await asyncio.gather(
+                veh.forward(100),
+                veh.perform_action(Direction.LEFT, 90),
+                veh.stop(),
+            )
+
+    results = asyncio.run(run())
+
+    assert fake.calls == [
+        ("forward", 100),
+        ("perform_action", Direction.LEFT, 90),
+        ("stop",),
+    ]
+    assert results[1] == "done"
+
+
+def test_async_vehicle_rejects_commands_while_closing():
+    fake = FakeVehicle()
+
+    async def run():
+        veh = AsyncVehicle(fake)
+        veh.start()
+        queued = asyncio.ensure_future(veh.forward(100))
+        await asyncio.sleep(0.01)
+        closing = asyncio.ensure_future(veh.close())
+        await asyncio.sleep(0)
+        try:
+            await veh.stop()
+        except RuntimeError as e:
+            rejected = e
+        fake.release.set()
+        await closing
+        return await queued, rejected
+
+    result, rejected = asyncio.run(run())
+
+    assert "closed" in str(rejected)
+    assert result == Pose2D(1.0, 0.0, 0.0)
+    assert fake.calls == [("forward", 100)]
+
+
+class FakeInterface:
+    """
+    Replays a list of actionStatus tuples, repeating the last one.
+    """
+
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+
+    def actionStatus(self):
+        if len(self.statuses) > 1:
+            return self.statuses.pop(0)
+        return self.statuses[0]
+
+
+def test_wait_for_action_reads_status_after_coasting():
+    # Skip __init__, which configures the motors through the interface.
+    veh = Vehicle.__new__(Vehicle)
+    veh.interface = FakeInterface(
+        [(1, 5, 0, 5, 0), (4, 10, 0, 10, 0), (4, 12, 0, 11, 0)]
+    )
+    status = veh.wait_for_action(10, min_interval=0.001)
+    assert status.state == ActionState.SUCCEEDED
+    assert (status.left_transitions, status.right_transitions) == (12, 11)
+
+    veh.interface = FakeInterface([(4, 10, 0, 10, 0), (4, 12, 0, 11, 0)])
+    status = veh.wait_for_action(10, coast_time=0)
+    assert (status.left_transitions, status.right_transitions) == (10, 10)
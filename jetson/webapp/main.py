@@ -1,3 +1,4 @@
+import cmdmailbox
 import flask
 import logging
 import os
@@ -11,12 +12,39 @@ logging.basicConfig(level=logging.DEBUG)
 _logger = logging.getLogger(__name__)
 
 app = flask.Flask(__name__)
-vehicle = vehctl.Vehicle()
+# The webapp only reports the current pose, so keep a bounded history.
+vehicle = vehctl.Vehicle(pose_hist_capacity=100000)
+vehicle_lock = threading.Lock()
 capture_dir = tempfile.mkdtemp()
 capture_proc = None
 proc_lock = threading.Lock()
 
 
+def drive(command):
+    direction, speed = command
+    with vehicle_lock:
+        if direction in ("forward", "reverse", "left", "right"):
+            # method names are the same as directions:
+            getattr(vehicle, direction)(speed)
+        else:
+            vehicle.stop()
+
+
+# Browsers can post state far faster than the Arduino can respond, so
+# motor commands go through a mailbox where only the latest one survives.
+# MAX_COMMAND_RATE (commands per second) optionally limits it further.
+max_command_rate = os.getenv("MAX_COMMAND_RATE")
+drive_mailbox = cmdmailbox.CommandMailbox(
+    drive, max_rate=float(max_command_rate) if max_command_rate else None
+)
+drive_mailbox.start()
+# How long /state/ waits for its command to reach the vehicle before
+# replying with the pose. If it times out (e.g. under a low
+# MAX_COMMAND_RATE) the reply says so and the pose predates the command;
+# clients can poll /status/ for the latest.
+COMMAND_WAIT_SECS = 0.5
+
+
 @app.route("/")
 def root():
     return flask.redirect(flask.url_for("static", filename="index.html"))
@@ -30,11 +58,7 @@ def update_state():
     throttle = float(state["throttle"])
     camera_on = bool(state["camera_on"])
     speed = max(0, min(int(throttle * 255), 255))
-    if direction in ("forward", "reverse", "left", "right"):
-        # method names are the same as directions:
-        getattr(vehicle, direction)(speed)
-    else:
-        vehicle.stop()
+    ticket = drive_mailbox.post((direction, speed))
 
     with proc_lock:
         global capture_proc
@@ -59,9 +83,11 @@ def update_state():
             capture_proc.communicate("q\n".encode("ascii"))
             capture_proc = None
 
+    applied = drive_mailbox.wait(ticket, timeout=COMMAND_WAIT_SECS)
     return flask.make_response(
         {
             "status": "OK",
+            "command_applied": applied,
             "curr_pose": vehicle.curr_pose.to_json_obj(),
             "video_files": os.listdir(capture_dir),
         }
@@ -70,7 +96,8 @@ def update_state():
 
 @app.route("/reset/", methods=["POST"])
 def reset():
-    vehicle.reset()
+    with vehicle_lock:
+        vehicle.reset()
     return flask.make_response(
         {
             "status": "OK",
@@ -80,6 +107,17 @@ def reset():
     )
 
 
+@app.route("/status/")
+def status():
+    return flask.make_response(
+        {
+            "status": "OK",
+            "curr_pose": vehicle.curr_pose.to_json_obj(),
+            "commands": drive_mailbox.stats(),
+        }
+    )
+
+
 @app.route("/videos/<filename>")
 def download_video(filename):
     return flask.send_file(os.path.join(capture_dir, filename), as_attachment=True)